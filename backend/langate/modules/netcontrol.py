@@ -1,32 +1,96 @@
 import requests
 import logging
+import socket
+import time
 
-GET_REQUESTS = ["get_mac", "get_ip", '']
-POST_REQUESTS = ["connect_user"]
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+
+GET_REQUESTS = ["get_mac", "get_ip", "counters", "counters/top", "marks/latency", "marks/series", '']
+POST_REQUESTS = ["connect_user", "batch"]
 DELETE_REQUESTS = ["disconnect_user"]
 PUT_REQUESTS = ["set_mark"]
 
+# Number of times a request is retried when netcontrol's queue is full
+BUSY_RETRIES = 2
+# Longest time we accept to wait before retrying, in seconds
+MAX_RETRY_AFTER = 5
+
+class UnixSocketConnection(HTTPConnection):
+    """
+    HTTP connection over a unix socket instead of TCP.
+    """
+    def __init__(self, socket_file, **kwargs):
+        super().__init__("localhost", **kwargs)
+        self.socket_file = socket_file
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # urllib3 uses a sentinel for the default timeout
+        if isinstance(self.timeout, (int, float)):
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_file)
+
+class UnixSocketConnectionPool(HTTPConnectionPool):
+    """
+    Pool of connections to a unix socket.
+    """
+    def __init__(self, socket_file):
+        super().__init__("localhost")
+        self.socket_file = socket_file
+
+    def _new_conn(self):
+        return UnixSocketConnection(self.socket_file)
+
+class UnixSocketAdapter(HTTPAdapter):
+    """
+    Requests adapter sending every request to the given unix socket, whatever the URL host.
+    """
+    def __init__(self, socket_file):
+        super().__init__()
+        self.pool = UnixSocketConnectionPool(socket_file)
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self.pool
+
+    def close(self):
+        self.pool.close()
+        super().close()
+
 class Netcontrol:
     """
     Class which interacts with the netcontrol API.
     """
-    def request(self, endpoint='', args={}):
+    def request(self, endpoint='', args={}, body=None, retries=0, method=None):
         """
         Make a given request to the netcontrol API.
+        The body, if any, is sent as JSON. The HTTP method is deduced from the endpoint,
+        unless it is given explicitly (for endpoints accepting several methods).
         """
         response = None
 
-        # Make the request
-        try:
-            # Check the type of request
+        # Check the type of request
+        if method is None:
             if endpoint in GET_REQUESTS:
-                response = requests.get(self.REQUEST_URL + endpoint, params=args)
+                method = "GET"
             elif endpoint in POST_REQUESTS:
-                response = requests.post(self.REQUEST_URL + endpoint, params=args)
+                method = "POST"
             elif endpoint in DELETE_REQUESTS:
-                response = requests.delete(self.REQUEST_URL + endpoint, params=args)
+                method = "DELETE"
             elif endpoint in PUT_REQUESTS:
-                response = requests.put(self.REQUEST_URL + endpoint, params=args)
+                method = "PUT"
+
+        # Make the request
+        try:
+            response = self.session.request(method, self.REQUEST_URL + endpoint, params=args, json=body)
+
+            # Netcontrol's queue is full, wait as long as it asks before retrying
+            if response.status_code == 503 and retries < BUSY_RETRIES:
+                retry_after = float(response.headers.get("Retry-After", 1))
+                self.logger.warning(f"Netcontrol is busy, retrying in {retry_after}s...")
+                time.sleep(min(retry_after, MAX_RETRY_AFTER))
+                return self.request(endpoint, args, body, retries + 1, method)
 
             response.raise_for_status()
             return response.json()
@@ -57,12 +121,16 @@ class Netcontrol:
         self.logger.info(f"Getting IP address of {mac}...")
         return self.request("get_ip", {"mac": mac})["ip"]
 
-    def connect_user(self, mac: str, mark: int, name: str):
+    def connect_user(self, mac: str, mark: int, name: str, timeout: int = None):
         """
         Connect the user with the given MAC address.
+        If a timeout is given, netcontrol disconnects the device after that many seconds unless it is refreshed.
         """
         self.logger.info(f"Connecting user with MAC address {mac} ({name})...")
-        return self.request("connect_user", {"mac": mac, "mark": mark, "name": name})
+        args = {"mac": mac, "mark": mark, "name": name}
+        if timeout:
+            args["timeout"] = timeout
+        return self.request("connect_user", args)
 
     def disconnect_user(self, mac: str):
         """
@@ -78,12 +146,128 @@ class Netcontrol:
         self.logger.info(f"Setting mark of user with MAC address {mac} to {mark}...")
         return self.request("set_mark", {"mac": mac, "mark": mark})
 
-    def __init__(self):
+    def batch(self, operations: list):
+        """
+        Apply a list of operations in a single netcontrol transaction.
+        Each operation is a dict with an "action" ("connect", "disconnect", "set_mark", "upsert" or "refresh"),
+        a "mac" and, when relevant, a "mark", a "name" and a "timeout".
+        Returns one result per operation, with its "status" and "detail".
+        """
+        self.logger.info(f"Applying a batch of {len(operations)} operations...")
+        return self.request("batch", body=operations)
+
+    def connect_users(self, devices: list):
+        """
+        Connect the given devices, as a list of (mac, mark, name) tuples.
+        """
+        return self.batch([
+            {"action": "connect", "mac": mac, "mark": mark, "name": name}
+            for mac, mark, name in devices
+        ])
+
+    def disconnect_users(self, macs: list):
+        """
+        Disconnect the devices with the given MAC addresses.
+        """
+        return self.batch([{"action": "disconnect", "mac": mac} for mac in macs])
+
+    def set_marks(self, marks: dict):
+        """
+        Set the marks of the devices, given as a dict of MAC address -> mark.
+        """
+        return self.batch([
+            {"action": "set_mark", "mac": mac, "mark": mark}
+            for mac, mark in marks.items()
+        ])
+
+    def refresh_users(self, macs: list, timeout: int):
+        """
+        Restart the timeout of the devices with the given MAC addresses, so that they stay connected
+        for timeout more seconds.
+        """
+        return self.batch([{"action": "refresh", "mac": mac, "timeout": timeout} for mac in macs])
+
+    def get_state(self):
+        """
+        Get the mark of every device connected in netcontrol, as a dict of MAC address -> mark.
+        """
+        return self.request("state", method="GET")
+
+    def put_state(self, marks: dict):
+        """
+        Make the devices connected in netcontrol exactly the given ones, as a dict of MAC address -> mark.
+        Netcontrol only applies the differences with its current state, in a single transaction.
+        """
+        self.logger.info(f"Synchronizing the state of {len(marks)} devices...")
+        return self.request("state", body=marks, method="PUT")
+
+    def get_counters(self):
+        """
+        Get the traffic counters of every device, as a list of dicts with the "mac", "ip",
+        "tx_bytes", "tx_packets", "rx_bytes" and "rx_packets" of each device.
+        """
+        return self.request("counters")
+
+    def get_top_counters(self, n: int = 10, by: str = "bytes"):
+        """
+        Get the n devices with the most traffic, sent and received, in "bytes" or "packets".
+        """
+        return self.request("counters/top", {"n": n, "by": by})
+
+    def get_latency(self):
         """
-        Initialize HOST_IP to the docker's default route, set up REQUEST_URL and check the connection with the netcontrol API.
+        Get the health of the tunnel behind each mark, as a dict of mark -> estimates, with the
+        round-trip time of the probes in milliseconds ("rtt_ewma", "rtt_p50", "rtt_p90", "rtt_p99")
+        and the share of probes lost ("loss_ewma", "loss_window").
+        """
+        return {int(mark): stats for mark, stats in self.request("marks/latency").items()}
+
+    def get_mark_series(self, minutes: int = 60):
+        """
+        Get the traffic of each mark during the last minutes: the "interval" of the buckets, their start "time",
+        and for each mark the "tx_bytes", "tx_packets", "rx_bytes" and "rx_packets" of each bucket.
+        """
+        return self.request("marks/series", {"minutes": minutes})
+
+    def put_shaping(self, devices: list):
+        """
+        Replace the caps of the traffic of the devices, given as a list of dicts with the "mac",
+        and the "bytes" and "packets" per second of each device (None when not capped).
+        Netcontrol loads the whole policy in a single transaction.
+        """
+        self.logger.info(f"Applying the shaping policy of {len(devices)} devices...")
+        return self.request("shaping", body=devices, method="PUT")
+
+    def patch_shaping(self, devices: list):
+        """
+        Change the caps of the traffic of some devices, given as for put_shaping, the others keeping theirs.
+        A device whose "bytes" and "packets" are None is no longer capped.
+        """
+        self.logger.info(f"Updating the caps of {len(devices)} devices...")
+        return self.request("shaping", body=devices, method="PATCH")
+
+    def put_games(self, ports: dict):
+        """
+        Replace the ports of the games, given as a dict of protocol ("tcp" or "udp") -> list of ports
+        and ranges of ports ("27015-27030"). Netcontrol gives priority to their traffic on the tunnels.
+        """
+        self.logger.info("Applying the ports of the games...")
+        return self.request("games", body=ports, method="PUT")
+
+    def __init__(self, socket_file=None):
+        """
+        Set up REQUEST_URL and check the connection with the netcontrol API.
+        If a unix socket file is given, requests are sent to it; otherwise they are sent over TCP
+        to the docker's default route, HOST_IP.
         """
         self.HOST_IP = "host.docker.internal"
-        self.REQUEST_URL = f"http://{self.HOST_IP}:6784/"
+        self.session = requests.Session()
+
+        if socket_file:
+            self.REQUEST_URL = "http://netcontrol/"
+            self.session.mount(self.REQUEST_URL, UnixSocketAdapter(socket_file))
+        else:
+            self.REQUEST_URL = f"http://{self.HOST_IP}:6784/"
 
         self.logger = logging.getLogger(__name__)
 
@@ -0,0 +1,395 @@
+"""
+In-memory index of the devices on each mark, used to allocate marks without querying the database on login.
+The index is loaded from the database on first use, then kept up to date by the signals of the Device models.
+"""
+
+import math
+import random
+import threading
+from collections import Counter, namedtuple
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+
+class MarkIndex:
+    """
+    Number of devices on each mark, overall and for each team (tournament, team).
+    Only devices which are not whitelisted are counted.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        # Device pk -> (mark, team key or None, user pk or None)
+        self.devices = {}
+        self.marks = Counter()
+        self.teams = {}
+        # Mark -> bytes per second sent and received, as last measured by netcontrol
+        self.throughput = {}
+
+    @staticmethod
+    def team_key(user):
+        """
+        Key of the team of a user, None if the user has no team
+        """
+        if user is None or not user.team:
+            return None
+        return (user.tournament, user.team)
+
+    def reset(self):
+        """
+        Forget the index, which is loaded again from the database on next use
+        """
+        with self.lock:
+            self.loaded = False
+            self.devices = {}
+            self.marks = Counter()
+            self.teams = {}
+
+    def _load(self):
+        # prevent circular import
+        from langate.network.models import Device
+
+        rows = Device.objects.filter(whitelisted=False).values_list(
+          "pk", "mark", "userdevice__user", "userdevice__user__tournament", "userdevice__user__team"
+        )
+        for pk, mark, user, tournament, team in rows:
+            self._add(pk, mark, (tournament, team) if team else None, user)
+        self.loaded = True
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self._load()
+
+    def _add(self, pk, mark, key, user):
+        self.devices[pk] = (mark, key, user)
+        self.marks[mark] += 1
+        if key is not None:
+            self.teams.setdefault(key, Counter())[mark] += 1
+
+    def _remove(self, pk):
+        entry = self.devices.pop(pk, None)
+        if entry is None:
+            return
+        mark, key, _ = entry
+        self.marks[mark] -= 1
+        if self.marks[mark] <= 0:
+            del self.marks[mark]
+        if key is not None:
+            team = self.teams[key]
+            team[mark] -= 1
+            if team[mark] <= 0:
+                del team[mark]
+            if not team:
+                del self.teams[key]
+
+    def update_device(self, pk, mark, whitelisted, user=None):
+        """
+        Record the current mark of a device, and the team of its user if any
+        """
+        with self.lock:
+            if not self.loaded:
+                return
+            entry = self.devices.get(pk)
+            self._remove(pk)
+            if whitelisted:
+                return
+            if user is not None:
+                self._add(pk, mark, self.team_key(user), user.pk)
+            elif entry is not None:
+                self._add(pk, mark, entry[1], entry[2])
+            else:
+                self._add(pk, mark, None, None)
+
+    def remove_device(self, pk):
+        """
+        Forget a deleted device
+        """
+        with self.lock:
+            if self.loaded:
+                self._remove(pk)
+
+    def set_marks(self, marks):
+        """
+        Record the new marks of several devices, given as a dict of device pk -> mark
+        """
+        with self.lock:
+            if not self.loaded:
+                return
+            for pk, mark in marks.items():
+                if pk in self.devices:
+                    _, key, user = self.devices[pk]
+                    self._remove(pk)
+                    self._add(pk, mark, key, user)
+
+    def update_user(self, user):
+        """
+        Move the devices of a user to its current team
+        """
+        with self.lock:
+            if not self.loaded:
+                return
+            key = self.team_key(user)
+            for pk, (mark, device_key, owner) in list(self.devices.items()):
+                if owner == user.pk and device_key != key:
+                    self._remove(pk)
+                    self._add(pk, mark, key, owner)
+
+    def team_marks(self, user):
+        """
+        Number of devices of the team of a user on each mark, empty if the user has no team
+        """
+        key = self.team_key(user)
+        if key is None:
+            return Counter()
+        with self.lock:
+            self._ensure_loaded()
+            return Counter(self.teams.get(key, {}))
+
+    def mark_counts(self):
+        """
+        Number of devices on each mark
+        """
+        with self.lock:
+            self._ensure_loaded()
+            return Counter(self.marks)
+
+    def set_throughput(self, throughput):
+        """
+        Record the throughput of each mark, as a dict of mark -> bytes per second
+        """
+        with self.lock:
+            self.throughput = dict(throughput)
+
+
+def least_loaded(marks, weights, counts, throughput=None, throughput_weight=0):
+    """
+    Return the mark most under its target share among the given marks.
+    The target share of a mark is its weight over the sum of the weights, and its load is its share of the
+    devices on these marks, blended with its share of their throughput by throughput_weight (between 0 and 1).
+    Ties go to the mark with the highest weight. Marks with a weight of 0 are never chosen.
+    """
+    candidates = [(mark, weight) for mark, weight in zip(marks, weights) if weight > 0]
+    if not marks:
+        raise IndexError("No mark to choose from")
+    if not candidates:
+        raise ValueError("Total of weights must be greater than zero")
+
+    total_weight = sum(weight for _, weight in candidates)
+    total_devices = sum(counts.get(mark, 0) for mark, _ in candidates)
+    throughput = throughput or {}
+    total_throughput = sum(throughput.get(mark, 0) for mark, _ in candidates)
+
+    def deficit(candidate):
+        mark, weight = candidate
+        load = counts.get(mark, 0) / total_devices if total_devices else 0
+        if throughput_weight and total_throughput:
+            load = (1 - throughput_weight) * load + throughput_weight * throughput.get(mark, 0) / total_throughput
+        return (weight / total_weight - load, weight)
+
+    return max(candidates, key=deficit)[0]
+
+
+def plan_rebalance(counts, weights, tolerance=0):
+    """
+    Plan the fewest moves of devices between marks bringing each mark within tolerance of its target.
+    counts is the number of devices on each mark, and weights the weight of each mark: its target is its share
+    of the weights times the number of devices, and a mark with a weight of 0 is emptied. tolerance is the share
+    of the devices a mark may be away from its target (0 still allows rounding the target up or down).
+    Return the number of devices to move as a dict of (origin, destination) -> count, and the projected counts.
+    """
+    marks = sorted(set(counts) | set(weights))
+    total = sum(counts.get(mark, 0) for mark in marks)
+    total_weight = sum(weights.get(mark, 0) for mark in marks)
+    projected = {mark: counts.get(mark, 0) for mark in marks}
+    if not total or not total_weight:
+        return {}, projected
+
+    target = {mark: total * weights.get(mark, 0) / total_weight for mark in marks}
+    slack = tolerance * total
+    lower = {mark: max(0, math.floor(target[mark] - slack)) if weights.get(mark, 0) > 0 else 0 for mark in marks}
+    upper = {mark: math.ceil(target[mark] + slack) if weights.get(mark, 0) > 0 else 0 for mark in marks}
+
+    # Each move takes a device from the mark most above its target, preferably above its upper bound,
+    # to the mark most below its target, preferably below its lower bound: a move fixes a mark out
+    # of its bounds on each side whenever there is one, so the number of moves is the smallest possible
+    moves = Counter()
+    while True:
+        over = [mark for mark in marks if projected[mark] > upper[mark]]
+        under = [mark for mark in marks if projected[mark] < lower[mark]]
+        if not over and not under:
+            break
+        origins = over or [mark for mark in marks if projected[mark] > lower[mark]]
+        destinations = under or [mark for mark in marks if projected[mark] < upper[mark]]
+        origin = max(origins, key=lambda mark: (projected[mark] - target[mark], mark))
+        destination = max(destinations, key=lambda mark: (target[mark] - projected[mark], weights.get(mark, 0)))
+        projected[origin] -= 1
+        projected[destination] += 1
+        moves[(origin, destination)] += 1
+
+    return dict(moves), projected
+
+
+class AliasSampler:
+    """
+    Draw items at random based on their weights in constant time, with the alias method (Vose).
+    Each of the n slots holds an item, the probability to draw it, and the item drawn otherwise (its alias).
+    Items with a weight of 0 are never drawn.
+    """
+
+    def __init__(self, items, weights):
+        if not items:
+            raise IndexError("No item to draw from")
+        total = sum(weights)
+        if total <= 0:
+            raise ValueError("Total of weights must be greater than zero")
+
+        count = len(items)
+        self.items = list(items)
+        self.probability = [1.0] * count
+        self.alias = list(range(count))
+
+        # Weights scaled so that their mean is 1: each slot below 1 is topped up by a slot above 1
+        scaled = [weight * count / total for weight in weights]
+        small = [slot for slot, value in enumerate(scaled) if value < 1]
+        large = [slot for slot, value in enumerate(scaled) if value >= 1]
+        while small and large:
+            low = small.pop()
+            high = large.pop()
+            self.probability[low] = scaled[low]
+            self.alias[low] = high
+            scaled[high] -= 1 - scaled[low]
+            (small if scaled[high] < 1 else large).append(high)
+        # The remaining slots are full, up to rounding errors
+
+    def draw(self, rng=random):
+        """
+        Draw an item
+        """
+        # A single random number chooses both the slot and between its item and its alias
+        value = rng.random() * len(self.items)
+        # The product may round up to the number of slots
+        slot = min(int(value), len(self.items) - 1)
+        if value - slot < self.probability[slot]:
+            return self.items[slot]
+        return self.items[self.alias[slot]]
+
+
+MarkTable = namedtuple("MarkTable", ["marks", "weights", "sampler", "restricted"])
+
+
+class MarkTables:
+    """
+    Marks get_mark chooses from, with their weights and their sampler, for each tournament and set of excluded
+    marks. Tables are compiled from the settings on first use, and dropped by invalidate() when the settings
+    are saved, or if the marks or the games of the settings are replaced.
+    Drained marks are given a weight of 0 on top of the settings, which keep the priorities set by the staff.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = 0
+        # Marks and games the tables were compiled from
+        self.source = (None, None)
+        self.tables = {}
+        # Marks drained by the watchdog, whose devices were moved to the other marks
+        self.drained = frozenset()
+
+    def invalidate(self):
+        """
+        Drop the compiled tables, for instance when the settings changed
+        """
+        with self.lock:
+            self.version += 1
+            self.tables = {}
+
+    def drain(self, mark):
+        """
+        Stop giving a mark to the new devices, until it is restored
+        """
+        with self.lock:
+            self.drained = self.drained | {mark}
+            self.version += 1
+            self.tables = {}
+
+    def restore(self, mark):
+        """
+        Give a drained mark to the new devices again, according to its priority in the settings
+        """
+        with self.lock:
+            self.drained = self.drained - {mark}
+            self.version += 1
+            self.tables = {}
+
+    def priorities(self, settings):
+        """
+        Return the priority of each mark of the settings, 0 for the drained marks
+        """
+        drained = self.drained
+        return {mark["value"]: 0 if mark["value"] in drained else mark["priority"] for mark in settings["marks"]}
+
+    def get(self, settings, tournament=None, excluded=()):
+        """
+        Return the table of the marks of a tournament (of every mark if it has none, or for None),
+        without the excluded marks. The table is restricted if it holds the marks of a tournament.
+        """
+        key = (tournament, tuple(sorted(set(excluded))) if excluded else ())
+        with self.lock:
+            if self.source[0] is not settings["marks"] or self.source[1] is not settings["games"]:
+                self.source = (settings["marks"], settings["games"])
+                self.tables = {}
+            table = self.tables.get(key)
+            if table is None:
+                table = self.tables[key] = self._compile(settings, *key)
+        return table
+
+    def _compile(self, settings, tournament, excluded):
+        # prevent circular import
+        from langate.network.utils import game_marks
+
+        priorities = self.priorities(settings)
+        tournament_marks = game_marks(settings["games"].get(tournament, [])) if tournament else []
+        restricted = bool(tournament_marks)
+        marks = [
+          mark for mark in (tournament_marks if restricted else priorities)
+          if mark in priorities and mark not in excluded
+        ]
+        weights = [priorities[mark] for mark in marks]
+        try:
+            sampler = AliasSampler(marks, weights)
+        except (IndexError, ValueError):
+            # Nothing can be drawn, random.choices raises the same errors to the caller
+            sampler = None
+        return MarkTable(marks, weights, sampler, restricted)
+
+
+index = MarkIndex()
+tables = MarkTables()
+
+
+@receiver(post_save, sender="network.Device")
+@receiver(post_save, sender="network.UserDevice")
+def device_saved(sender, instance, **kwargs):
+    """
+    Keep the index up to date when a device is created or changed
+    """
+    user = instance.user if hasattr(instance, "user_id") else None
+    index.update_device(instance.pk, instance.mark, instance.whitelisted, user)
+
+
+@receiver(post_delete, sender="network.Device")
+@receiver(post_delete, sender="network.UserDevice")
+def device_deleted(sender, instance, **kwargs):
+    """
+    Keep the index up to date when a device is deleted
+    """
+    index.remove_device(instance.pk)
+
+
+@receiver(post_save, sender="user.User")
+def user_saved(sender, instance, **kwargs):
+    """
+    Keep the teams of the index up to date when a user changes team
+    """
+    index.update_user(instance)
@@ -7,10 +7,12 @@ import sys, logging
 import os
 
 from django.apps import AppConfig
+from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
 
 from langate.settings import netcontrol
 from langate.settings import SETTINGS
+from langate.settings import NETCONTROL_SESSION_TIMEOUT
 
 logger = logging.getLogger(__name__)
 
@@ -29,7 +31,8 @@ class NetworkConfig(AppConfig):
             This is important to maintain the consistency between the device state from django's point of view
             and the device state from netcontrol's point of view.
         """
-        from langate.network.models import Device, UserDevice, DeviceManager
+        from langate.network.models import Device, DeviceManager
+        from langate.network.utils import apply_game_ports
 
         if not any(
             x in sys.argv
@@ -48,20 +51,14 @@ class NetworkConfig(AppConfig):
 
             logger.info(_("[PortalConfig] Adding previously connected devices to netcontrol"))
 
-            for dev in Device.objects.all():
-                userdevice = UserDevice.objects.filter(mac=dev.mac).first()
-                try:
-                    if userdevice is not None:
-                        connect_res = netcontrol.connect_user(userdevice.mac, userdevice.mark, userdevice.user.username)
-                    else:
-                        connect_res = netcontrol.connect_user(dev.mac, dev.mark, dev.name)
-                except requests.HTTPError as e:
-                    logger.info("[PortalConfig] {e}")
-
-                try:
-                    mark_res = netcontrol.set_mark(dev.mac, dev.mark)
-                except requests.HTTPError as e:
-                    logger.info("[PortalConfig] {e}")
+            # Send the full state to netcontrol, which only applies the differences in one transaction
+            marks = dict(Device.objects.values_list("mac", "mark"))
+            try:
+                result = netcontrol.put_state(marks)
+                for failure in result["failed"]:
+                    logger.info("[PortalConfig] Could not replay %s: %s", failure["mac"], failure["detail"])
+            except requests.HTTPError as e:
+                logger.info("[PortalConfig] %s", e)
 
             logger.info(_("[PortalConfig] Adding default whitelist devices to netcontrol"))
             if os.path.exists("assets/misc/whitelist.txt"):
@@ -89,3 +86,39 @@ class NetworkConfig(AppConfig):
                                     logger.info("[PortalConfig] {e}")
                         else:
                             logger.error("[PortalConfig] Invalid line in whitelist.txt: %s", line)
+
+            logger.info(_("[PortalConfig] Applying the shaping policy"))
+            try:
+                DeviceManager.apply_shaping()
+            except ValidationError as e:
+                logger.info("[PortalConfig] %s", e.message)
+
+            logger.info(_("[PortalConfig] Applying the ports of the games"))
+            try:
+                apply_game_ports()
+            except requests.HTTPError as e:
+                logger.info("[PortalConfig] %s", e)
+
+            if NETCONTROL_SESSION_TIMEOUT:
+                from langate.network.tasks import start_keepalive
+
+                logger.info(_("[PortalConfig] Refreshing user devices every %d seconds"), NETCONTROL_SESSION_TIMEOUT // 3)
+                start_keepalive(NETCONTROL_SESSION_TIMEOUT)
+
+            if "bulk" in SETTINGS:
+                from langate.network.tasks import start_heavy_hitters
+
+                logger.info(_("[PortalConfig] Isolating heavy hitters on mark %d"), SETTINGS["bulk"]["mark"])
+                start_heavy_hitters(SETTINGS["bulk"])
+
+            if "watchdog" in SETTINGS:
+                from langate.network.tasks import start_watchdog
+
+                logger.info(_("[PortalConfig] Draining the marks whose tunnel is unhealthy"))
+                start_watchdog(SETTINGS["watchdog"])
+
+            if SETTINGS.get("allocation", {}).get("throughput"):
+                from langate.network.tasks import start_mark_load
+
+                logger.info(_("[PortalConfig] Balancing the marks by their throughput"))
+                start_mark_load(SETTINGS["allocation"])
@@ -11,8 +11,10 @@ from django.core.exceptions import ValidationError
 from langate.user.models import User
 from langate.settings import netcontrol
 from langate.settings import SETTINGS
+from langate.settings import NETCONTROL_SESSION_TIMEOUT
 
-from .utils import generate_dev_name, get_mark
+from .utils import generate_dev_name, get_mark, get_limits, shaping_configured, game_marks
+from .allocation import index, least_loaded, plan_rebalance, tables
 
 logger = logging.getLogger(__name__)
 
@@ -76,7 +78,6 @@ class DeviceManager(models.Manager):
         try:
             device = Device.objects.create(mac=mac, name=name, whitelisted=whitelisted, mark=mark)
             device.save()
-            return device
         except Exception as e:
             try:
                 netcontrol.disconnect_user(mac)
@@ -88,6 +89,9 @@ class DeviceManager(models.Manager):
               _("An error occurred while creating the device")
             ) from e
 
+        DeviceManager.try_update_shaping([(mac, mark, None)])
+        return device
+
     @staticmethod
     def delete_device(mac):
         """
@@ -126,7 +130,7 @@ class DeviceManager(models.Manager):
         mark = get_mark(user)
 
         try:
-            netcontrol.connect_user(mac, mark, user.username)
+            netcontrol.connect_user(mac, mark, user.username, NETCONTROL_SESSION_TIMEOUT)
             logger.info(
                 "Connected device %s (owned by %s) at %s to the internet.",
                 mac,
@@ -141,7 +145,6 @@ class DeviceManager(models.Manager):
         try:
             device = UserDevice.objects.create(mac=mac, name=name, user=user, ip=ip, mark=mark)
             device.save()
-            return device
         except Exception as e:
             try:
                 netcontrol.disconnect_user(mac)
@@ -153,6 +156,9 @@ class DeviceManager(models.Manager):
               _("An error occurred while creating the device")
             ) from e
 
+        DeviceManager.try_update_shaping([(mac, mark, user.role)])
+        return device
+
     @staticmethod
     def delete_user_device(Device):
         """
@@ -168,13 +174,19 @@ class DeviceManager(models.Manager):
         # If name is provided, update it
         if name and name != device.name:
             device.name = name
+        # Devices whose caps may have changed, as (MAC address, mark) pairs
+        reshape = []
         if mac and mac != device.mac:
             validate_mac(mac)
             # Disconnect the old MAC
             try:
                 netcontrol.disconnect_user(device.mac)
-                # Connect the new MAC
-                netcontrol.connect_user(mac, device.mark, device.name)
+                # Connect the new MAC, which expires like the old one if the device belongs to a user
+                user_device = isinstance(device, UserDevice) or UserDevice.objects.filter(pk=device.pk).exists()
+                timeout = NETCONTROL_SESSION_TIMEOUT if user_device else None
+                netcontrol.connect_user(mac, device.mark, device.name, timeout)
+                # The old MAC address is no longer capped, the new one is capped as the device
+                reshape.extend([(device.mac, None), (mac, device.mark)])
                 device.mac = mac
             except requests.HTTPError as e:
                 raise ValidationError(
@@ -184,6 +196,8 @@ class DeviceManager(models.Manager):
             # Check if the mark is valid
             if mark not in [m["value"] for m in SETTINGS["marks"]]:
                 raise ValidationError(_("Invalid mark"))
+            if get_limits(mark) != get_limits(device.mark):
+                reshape.append((device.mac, mark))
             device.mark = mark
             try:
                 netcontrol.set_mark(device.mac, mark)
@@ -196,3 +210,219 @@ class DeviceManager(models.Manager):
             device.save()
         except Exception as e:
             raise ValidationError(_("The data provided is invalid")) from e
+
+        # The caps of the device depend on its mark, and on the role of its user if any
+        if reshape and shaping_configured():
+            role = UserDevice.objects.filter(pk=device.pk).values_list("user__role", flat=True).first()
+            DeviceManager.try_update_shaping([(mac, mark, role if mark is not None else None) for mac, mark in reshape])
+
+    @staticmethod
+    def set_devices_mark(marks):
+        """
+        Change the mark of several devices at once, given as a dict of MAC address -> mark.
+        The marks are applied in a single netcontrol transaction, and only the devices
+        successfully updated in netcontrol are updated in the database.
+        Return the number of devices moved.
+        """
+        if not marks:
+            return 0
+
+        try:
+            results = netcontrol.set_marks(marks)
+        except requests.HTTPError as e:
+            raise ValidationError(
+                _("Could not set mark")
+            ) from e
+
+        # netcontrol answers with lowercase MAC addresses
+        macs_by_key = {mac.lower(): mac for mac in marks}
+
+        moved = {}
+        for result in results:
+            if result["status"] == 200:
+                mac = macs_by_key[result["mac"]]
+                moved.setdefault(marks[mac], []).append(mac)
+            else:
+                logger.warning("Could not set the mark of %s: %s", result["mac"], result["detail"])
+
+        for mark, macs in moved.items():
+            devices = Device.objects.filter(mac__in=macs)
+            # update() sends no signal, the index of the marks is updated by hand
+            index.set_marks({pk: mark for pk in devices.values_list("pk", flat=True)})
+            devices.update(mark=mark)
+
+        if moved:
+            DeviceManager.try_update_shaping(
+              Device.objects.filter(mac__in=[mac for macs in moved.values() for mac in macs])
+              .values_list("mac", "mark", "userdevice__user__role")
+            )
+
+        return sum(len(macs) for macs in moved.values())
+
+    @staticmethod
+    def plan_rebalance(tolerance=0, emptied=()):
+        """
+        Plan the fewest moves bringing the devices (except the whitelisted ones) on the marks with a priority
+        within tolerance of their share of the priorities, and moving every device out of the emptied marks.
+        Devices on the other marks with a priority of 0, or drained, are left where they are, and the devices
+        of a tournament are only moved to the marks of their tournament.
+        Return the plan: the moves by origin and destination, the new mark of each device moved ("devices"),
+        and the number of devices on each mark before ("current") and after ("projected") the moves.
+        """
+        weights = {mark: priority for mark, priority in tables.priorities(SETTINGS).items() if priority > 0}
+        for mark in emptied:
+            weights[mark] = 0
+
+        # Devices of each mark with the marks they may move to (None for any), those of a tournament first
+        devices = {mark: [] for mark in weights}
+        rows = Device.objects.filter(whitelisted=False, mark__in=list(weights)).order_by("pk").values_list(
+          "mac", "mark", "userdevice__user__tournament"
+        )
+        for mac, mark, tournament in rows:
+            allowed = game_marks(SETTINGS["games"].get(tournament, [])) if tournament else []
+            devices[mark].append((mac, allowed or None))
+        for candidates in devices.values():
+            candidates.sort(key=lambda device: device[1] is None)
+
+        current = {mark: len(candidates) for mark, candidates in devices.items()}
+        planned, _ = plan_rebalance(current, weights, tolerance)
+
+        projected = dict(current)
+        moves = {}
+        new_marks = {}
+
+        def move(device, origin, destination):
+            devices[origin].remove(device)
+            new_marks[device[0]] = destination
+            projected[origin] -= 1
+            projected[destination] += 1
+            moves[(origin, destination)] = moves.get((origin, destination), 0) + 1
+
+        for (origin, destination), count in sorted(planned.items()):
+            eligible = [device for device in devices[origin] if device[1] is None or destination in device[1]]
+            for device in eligible[:count]:
+                move(device, origin, destination)
+
+        # Devices of a tournament which could not follow the plan still leave the emptied marks,
+        # for the least loaded mark of their tournament, or of all the marks if none is left
+        positive = [mark for mark, weight in weights.items() if weight > 0]
+        for origin in emptied:
+            for device in list(devices.get(origin, [])):
+                marks = [mark for mark in device[1] or [] if mark in positive] or positive
+                if not marks:
+                    break
+                move(device, origin, least_loaded(marks, [weights[mark] for mark in marks], projected))
+
+        return {
+          "moves": [
+            {"from": origin, "to": destination, "count": count}
+            for (origin, destination), count in sorted(moves.items())
+          ],
+          "devices": new_marks,
+          "current": current,
+          "projected": projected,
+        }
+
+    @staticmethod
+    def rebalance(tolerance=0, emptied=()):
+        """
+        Plan the moves with plan_rebalance, and move the devices in a single netcontrol transaction.
+        Return the plan, with the number of devices actually moved ("moved").
+        """
+        plan = DeviceManager.plan_rebalance(tolerance, emptied)
+        plan["moved"] = DeviceManager.set_devices_mark(plan["devices"])
+        return plan
+
+    @staticmethod
+    def refresh_user_devices(timeout):
+        """
+        Restart the netcontrol timeout of the devices of every active user, in a single transaction.
+        Devices that netcontrol no longer knows (for instance if it was restarted) are connected again.
+        Return the number of devices refreshed or reconnected.
+        """
+        devices = {
+            mac.lower(): (mac, mark, username)
+            for mac, mark, username in UserDevice.objects.filter(user__is_active=True)
+                .values_list("mac", "mark", "user__username")
+        }
+        if not devices:
+            return 0
+
+        try:
+            results = netcontrol.refresh_users([mac for mac, _, _ in devices.values()], timeout)
+            lost = [result["mac"] for result in results if result["status"] == 404]
+            if lost:
+                logger.info("Reconnecting %d devices unknown to netcontrol", len(lost))
+                results += netcontrol.batch([
+                    {"action": "connect", "mac": mac, "mark": mark, "name": username, "timeout": timeout}
+                    for mac, mark, username in (devices[key] for key in lost)
+                ])
+        except requests.HTTPError as e:
+            raise ValidationError(
+                _("Could not refresh devices")
+            ) from e
+
+        for result in results:
+            if result["status"] not in (200, 404):
+                logger.warning("Could not refresh %s: %s", result["mac"], result["detail"])
+
+        return sum(result["status"] == 200 for result in results)
+
+    @staticmethod
+    def apply_shaping(force=False):
+        """
+        Compute the caps of the traffic of every device from its mark and the role of its user,
+        and replace the shaping policy of netcontrol with them, in a single transaction.
+        Unless forced, nothing is sent when no mark nor role is capped.
+        Return the number of devices capped.
+        """
+        if not force and not shaping_configured():
+            return 0
+
+        devices = []
+        for mac, mark, role in Device.objects.values_list("mac", "mark", "userdevice__user__role"):
+            limits = get_limits(mark, role)
+            if limits["bytes"] is not None or limits["packets"] is not None:
+                devices.append({"mac": mac, **limits})
+
+        try:
+            netcontrol.put_shaping(devices)
+        except requests.HTTPError as e:
+            raise ValidationError(
+                _("Could not apply the shaping policy")
+            ) from e
+
+        return len(devices)
+
+    @staticmethod
+    def update_shaping(devices):
+        """
+        Send the caps of some devices to netcontrol, given as (MAC address, mark, role of the user or None) tuples,
+        which only changes their elements of the shaping policy. A device with no mark is no longer capped.
+        Unless a mark or a role is capped, nothing is sent.
+        Return the number of devices sent.
+        """
+        if not shaping_configured():
+            return 0
+
+        caps = [{"mac": mac, **get_limits(mark, role)} for mac, mark, role in devices]
+        if not caps:
+            return 0
+        try:
+            netcontrol.patch_shaping(caps)
+        except requests.HTTPError as e:
+            raise ValidationError(
+                _("Could not apply the shaping policy")
+            ) from e
+
+        return len(caps)
+
+    @staticmethod
+    def try_update_shaping(devices):
+        """
+        Update the caps of some devices after they changed, which succeeded even if the caps could not be applied
+        """
+        try:
+            DeviceManager.update_shaping(devices)
+        except ValidationError as e:
+            logger.warning("%s", e.message)
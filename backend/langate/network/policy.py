@@ -0,0 +1,168 @@
+"""
+Policies moving devices between marks depending on their traffic.
+"""
+
+
+class HeavyHitterPolicy:
+    """
+    Decide which devices to isolate on the bulk mark, from successive samples of the traffic counters.
+    A device is isolated once its traffic stayed above the threshold for `sustain` samples in a row,
+    and released once it stayed below `release` times the threshold for `cooldown` seconds: the gap
+    between both thresholds and the delays keep devices from flapping between marks.
+    """
+
+    def __init__(self, threshold, sustain=3, release=0.5, cooldown=300):
+        # Bytes per second, sent and received
+        self.threshold = threshold
+        self.sustain = sustain
+        self.release = release
+        self.cooldown = cooldown
+        # MAC address -> (time, bytes) of the last sample
+        self.previous = {}
+        # MAC address -> number of samples in a row above the threshold
+        self.above = {}
+        # MAC address of the isolated devices -> time since which their traffic is below the release threshold, or None
+        self.calm_since = {}
+        # MAC address -> rate of the last sample, in bytes per second
+        self.rates = {}
+
+    def isolated(self, mac):
+        """
+        Mark the device as isolated, for instance if it was isolated before the policy started
+        """
+        self.above.pop(mac, None)
+        self.calm_since[mac] = None
+
+    def forget(self, mac):
+        """
+        Forget a device, for instance when it was deleted or moved by hand
+        """
+        self.above.pop(mac, None)
+        self.calm_since.pop(mac, None)
+
+    def step(self, now, counters):
+        """
+        Add a sample of the counters, as returned by netcontrol.get_counters().
+        Return the MAC addresses of the devices to isolate, and of the devices to release.
+        """
+        isolate = []
+        release = []
+        previous = {}
+        self.rates = {}
+        for device in counters:
+            mac = device["mac"]
+            if mac is None:
+                continue
+            total = device["tx_bytes"] + device["rx_bytes"]
+            previous[mac] = (now, total)
+            last = self.previous.get(mac)
+            # The first sample of a device, or counters which started again from 0, give no rate
+            if last is None or total < last[1] or now <= last[0]:
+                continue
+            rate = self.rates[mac] = (total - last[1]) / (now - last[0])
+
+            if mac in self.calm_since:
+                if rate >= self.threshold * self.release:
+                    self.calm_since[mac] = None
+                elif self.calm_since[mac] is None:
+                    self.calm_since[mac] = now
+                elif now - self.calm_since[mac] >= self.cooldown:
+                    release.append(mac)
+            elif rate > self.threshold:
+                self.above[mac] = self.above.get(mac, 0) + 1
+                if self.above[mac] >= self.sustain:
+                    isolate.append(mac)
+            else:
+                self.above.pop(mac, None)
+        self.previous = previous
+
+        # A device without traffic is calm, its counters may have been removed by a restart of netcontrol
+        for mac, since in self.calm_since.items():
+            if mac not in self.rates:
+                if since is None:
+                    self.calm_since[mac] = now
+                elif now - since >= self.cooldown:
+                    release.append(mac)
+
+        for mac in isolate:
+            self.isolated(mac)
+        for mac in release:
+            self.forget(mac)
+        return isolate, release
+
+
+class MarkWatchdog:
+    """
+    Decide which marks to drain, from successive health signals of their tunnels.
+    A mark is unhealthy when its loss, round-trip time or throughput is above its limit (a limit of None is not checked).
+    It is drained once it stayed unhealthy for `duration` seconds, and restored once it stayed healthy for
+    `recovery` seconds. At most `max_drained` marks are drained at once, and two marks are never drained less than
+    `min_interval` seconds apart, so that a flapping tunnel does not cause waves of moves.
+    """
+
+    def __init__(self, max_loss=None, max_rtt=None, max_throughput=None, duration=60, recovery=300, min_interval=600, max_drained=1):
+        # Share of probes lost, round-trip time in milliseconds, bytes per second sent and received
+        self.max_loss = max_loss
+        self.max_rtt = max_rtt
+        self.max_throughput = max_throughput
+        self.duration = duration
+        self.recovery = recovery
+        self.min_interval = min_interval
+        self.max_drained = max_drained
+        # Mark -> time since which it is unhealthy, or healthy
+        self.unhealthy_since = {}
+        self.healthy_since = {}
+        self.drained = set()
+        self.last_drain = None
+
+    def unhealthy(self, signals):
+        """
+        Check if the signals of a mark ("loss", "rtt" and "throughput", each optional) are above a limit
+        """
+        for key, limit in [("loss", self.max_loss), ("rtt", self.max_rtt), ("throughput", self.max_throughput)]:
+            if limit is not None and signals.get(key) is not None and signals[key] > limit:
+                return True
+        return False
+
+    def cancel(self, mark):
+        """
+        Consider a mark as not drained, for instance if it could not be drained
+        """
+        self.drained.discard(mark)
+
+    def step(self, now, signals):
+        """
+        Add the health signals of the marks, as a dict of mark -> signals.
+        Marks without signals keep their state.
+        Return the marks to drain, and the marks to restore.
+        """
+        for mark, values in signals.items():
+            if self.unhealthy(values):
+                self.healthy_since.pop(mark, None)
+                self.unhealthy_since.setdefault(mark, now)
+            else:
+                self.unhealthy_since.pop(mark, None)
+                self.healthy_since.setdefault(mark, now)
+
+        restore = [
+            mark for mark in sorted(self.drained)
+            if mark in self.healthy_since and now - self.healthy_since[mark] >= self.recovery
+        ]
+        self.drained.difference_update(restore)
+
+        drain = []
+        # The marks unhealthy for the longest first
+        candidates = sorted(
+            (since, mark) for mark, since in self.unhealthy_since.items()
+            if mark not in self.drained and now - since >= self.duration
+        )
+        for _, mark in candidates:
+            if len(self.drained) >= self.max_drained:
+                break
+            if self.last_drain is not None and now - self.last_drain < self.min_interval:
+                break
+            self.drained.add(mark)
+            self.last_drain = now
+            drain.append(mark)
+
+        return drain, restore
@@ -0,0 +1,244 @@
+"""
+Background tasks of the network module, run in daemon threads of the backend process.
+"""
+
+import logging
+import threading
+import time
+
+import requests
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections
+from django.db.models.functions import Lower
+
+logger = logging.getLogger(__name__)
+
+
+def keepalive(timeout, stop):
+    """
+    Refresh the netcontrol timeout of the user devices every third of the timeout,
+    so that a device only expires if its user is deactivated or the backend stops refreshing it.
+    """
+    from langate.network.models import DeviceManager
+
+    while not stop.wait(timeout / 3):
+        try:
+            refreshed = DeviceManager.refresh_user_devices(timeout)
+            logger.debug("[Keepalive] Refreshed %d devices", refreshed)
+        except ValidationError as e:
+            logger.warning("[Keepalive] %s", e)
+        except Exception:
+            logger.exception("[Keepalive] Unexpected error while refreshing devices")
+        finally:
+            # The thread is not a request, so Django does not close its database connection by itself
+            close_old_connections()
+
+
+def start_keepalive(timeout):
+    """
+    Start the keepalive thread, return the event stopping it
+    """
+    stop = threading.Event()
+    threading.Thread(target=keepalive, args=(timeout, stop), name="netcontrol-keepalive", daemon=True).start()
+    return stop
+
+
+def isolate_heavy_hitters(config, stop):
+    """
+    Move the devices whose traffic stays above the threshold to the bulk mark, and move them back
+    to their previous mark once their traffic stayed low for the cool-down, as decided by HeavyHitterPolicy.
+    """
+    from langate.settings import SETTINGS, netcontrol
+    from langate.network.models import Device, DeviceManager
+    from langate.network.policy import HeavyHitterPolicy
+    from langate.network.utils import get_mark
+
+    bulk = config["mark"]
+    policy = HeavyHitterPolicy(
+        config["threshold"], config.get("sustain", 3), config.get("release", 0.5), config.get("cooldown", 300)
+    )
+    # MAC address -> mark of the isolated devices before they were moved
+    origins = {}
+    # Devices already on the bulk mark were isolated before the backend restarted, or moved there by hand
+    for mac in Device.objects.filter(mark=bulk, whitelisted=False).values_list("mac", flat=True):
+        policy.isolated(mac.lower())
+    close_old_connections()
+
+    while not stop.wait(config.get("interval", 10)):
+        try:
+            counters = netcontrol.get_counters()
+            isolate, release = policy.step(time.monotonic(), counters)
+
+            macs = set(isolate) | set(release) | set(policy.calm_since)
+            devices = {
+                device.mac_lower: device
+                for device in Device.objects.annotate(mac_lower=Lower("mac")).filter(mac_lower__in=macs)
+            }
+
+            # Devices moved off the bulk mark by hand, or deleted, are no longer isolated
+            for mac in set(policy.calm_since) - set(isolate):
+                if mac not in devices or devices[mac].mark != bulk:
+                    policy.forget(mac)
+                    origins.pop(mac, None)
+
+            for mac in isolate:
+                device = devices.get(mac)
+                if device is None or device.whitelisted:
+                    policy.forget(mac)
+                    continue
+                origins[mac] = device.mark
+                DeviceManager.edit_device(device, device.mac, device.name, bulk)
+                logger.info(
+                    "[HeavyHitters] Moved %s (%s) from mark %d to bulk mark %d: %.0f bytes/s",
+                    device.mac, device.name, origins[mac], bulk, policy.rates[mac],
+                )
+
+            for mac in release:
+                device = devices.get(mac)
+                origin = origins.pop(mac, None)
+                if device is None or device.mark != bulk:
+                    continue
+                if origin not in [m["value"] for m in SETTINGS["marks"]] or origin == bulk:
+                    user = getattr(device, "userdevice", None)
+                    origin = get_mark(user.user if user is not None else None, excluded_marks=[bulk])
+                DeviceManager.edit_device(device, device.mac, device.name, origin)
+                logger.info(
+                    "[HeavyHitters] Moved %s (%s) back from bulk mark %d to mark %d after its cool-down",
+                    device.mac, device.name, bulk, origin,
+                )
+        except (requests.HTTPError, ValidationError) as e:
+            logger.warning("[HeavyHitters] %s", e)
+        except Exception:
+            logger.exception("[HeavyHitters] Unexpected error while isolating heavy hitters")
+        finally:
+            close_old_connections()
+
+
+def start_heavy_hitters(config):
+    """
+    Start the thread isolating heavy hitters on the bulk mark, return the event stopping it
+    """
+    stop = threading.Event()
+    threading.Thread(
+        target=isolate_heavy_hitters, args=(config, stop), name="heavy-hitters", daemon=True
+    ).start()
+    return stop
+
+
+def mark_signals(latency, series):
+    """
+    Merge the health estimates of netcontrol into the signals of each mark used by MarkWatchdog:
+    the share of probes lost, the round-trip time in milliseconds, and the throughput of the last bucket
+    of the series (if given) in bytes per second.
+    """
+    signals = {mark: {"loss": stats["loss_ewma"], "rtt": stats["rtt_ewma"]} for mark, stats in latency.items()}
+    if series is not None and series["time"]:
+        for mark, traffic in series["marks"].items():
+            throughput = (traffic["tx_bytes"][-1] + traffic["rx_bytes"][-1]) / series["interval"]
+            signals.setdefault(int(mark), {})["throughput"] = throughput
+    return signals
+
+
+def drain_mark(mark, drained):
+    """
+    Move the devices of a mark (except the whitelisted ones) to the marks that are not drained,
+    according to the weights of get_mark, in a single netcontrol transaction.
+    Return the number of devices moved.
+    """
+    from langate.network.models import Device, DeviceManager
+    from langate.network.utils import get_mark
+    from langate.network.allocation import index
+
+    marks = {}
+    # The devices are only saved at the end, count them on their new mark as they are allocated
+    counts = index.mark_counts()
+    for device in Device.objects.filter(mark=mark, whitelisted=False):
+        user_device = getattr(device, "userdevice", None)
+        user = user_device.user if user_device is not None else None
+        try:
+            marks[device.mac] = get_mark(user, excluded_marks=drained, counts=counts)
+        except (ValueError, IndexError):
+            # Every mark of the tournament of the user is drained
+            marks[device.mac] = get_mark(excluded_marks=drained, counts=counts)
+    return DeviceManager.set_devices_mark(marks)
+
+
+def watch_marks(config, stop):
+    """
+    Drain the marks whose tunnel is unhealthy, as decided by MarkWatchdog: no new device gets them,
+    and their devices are moved to healthy marks. They are given to new devices again once they recover.
+    The drained marks are kept in memory apart from the settings, which keep the priorities set by the staff.
+    """
+    from langate.settings import SETTINGS, netcontrol
+    from langate.network.policy import MarkWatchdog
+    from langate.network.allocation import tables
+
+    watchdog = MarkWatchdog(
+        config.get("max_loss"), config.get("max_rtt"), config.get("max_throughput"), config.get("duration", 60),
+        config.get("recovery", 300), config.get("min_interval", 600), config.get("max_drained", 1),
+    )
+
+    while not stop.wait(config.get("interval", 10)):
+        try:
+            series = netcontrol.get_mark_series(1) if config.get("max_throughput") is not None else None
+            drain, restore = watchdog.step(time.monotonic(), mark_signals(netcontrol.get_latency(), series))
+
+            for mark in restore:
+                tables.restore(mark)
+                logger.info("[Watchdog] Mark %d recovered, it is given to new devices again", mark)
+
+            for mark in drain:
+                priorities = tables.priorities(SETTINGS)
+                healthy = [
+                    value for value, priority in priorities.items()
+                    if value not in watchdog.drained and priority > 0
+                ]
+                if mark not in priorities or not healthy:
+                    watchdog.cancel(mark)
+                    logger.warning("[Watchdog] Mark %d is unhealthy, but there is no healthy mark to drain it to", mark)
+                    continue
+                tables.drain(mark)
+                moved = drain_mark(mark, sorted(watchdog.drained))
+                logger.warning("[Watchdog] Mark %d is unhealthy, drained %d devices to the other marks", mark, moved)
+        except (requests.HTTPError, ValidationError) as e:
+            logger.warning("[Watchdog] %s", e)
+        except Exception:
+            logger.exception("[Watchdog] Unexpected error while watching the marks")
+        finally:
+            close_old_connections()
+
+
+def start_watchdog(config):
+    """
+    Start the thread draining unhealthy marks, return the event stopping it
+    """
+    stop = threading.Event()
+    threading.Thread(target=watch_marks, args=(config, stop), name="mark-watchdog", daemon=True).start()
+    return stop
+
+
+def refresh_mark_load(config, stop):
+    """
+    Record the throughput of each mark measured by netcontrol in the index of the marks,
+    for the "load" allocation policy
+    """
+    from langate.settings import netcontrol
+    from langate.network.allocation import index
+
+    while not stop.wait(config.get("interval", 10)):
+        try:
+            signals = mark_signals({}, netcontrol.get_mark_series(1))
+            index.set_throughput({mark: values["throughput"] for mark, values in signals.items()})
+        except requests.HTTPError as e:
+            logger.warning("[MarkLoad] %s", e)
+        except Exception:
+            logger.exception("[MarkLoad] Unexpected error while reading the throughput of the marks")
+
+
+def start_mark_load(config):
+    """
+    Start the thread reading the throughput of the marks, return the event stopping it
+    """
+    stop = threading.Event()
+    threading.Thread(target=refresh_mark_load, args=(config, stop), name="mark-load", daemon=True).start()
+    return stop
@@ -1,16 +1,23 @@
 import json
+import random
+from collections import Counter
+
+import requests
 
 from django.test import TestCase
 from django.core.exceptions import ValidationError
 from django.urls import reverse
 
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, mock_open
 
 from rest_framework import status
 from rest_framework.test import APIClient
 
 from langate.network.models import DeviceManager, Device, UserDevice
-from langate.network.utils import get_mark
+from langate.network.utils import get_mark, save_settings
+from langate.network.policy import HeavyHitterPolicy, MarkWatchdog
+from langate.network.tasks import isolate_heavy_hitters, drain_mark, mark_signals
+from langate.network.allocation import index, least_loaded, plan_rebalance, tables, AliasSampler
 from langate.user.models import User, Role
 from .serializers import FullDeviceSerializer
 
@@ -170,6 +177,175 @@ class TestDeviceManager(TestCase):
             DeviceManager.create_device(mac="00:11:22:33:44:55", name="TestDevice")
             DeviceManager.create_device(mac="00:11:22:33:44:55", name="TestDevice2")
 
+    @patch('langate.settings.netcontrol.set_marks')
+    def test_set_devices_mark(self, mock_set_marks):
+        """
+        Test that only the devices moved by netcontrol have their mark changed
+        """
+        Device.objects.create(mac="00:11:22:33:44:AA", name="Device1", mark=100)
+        Device.objects.create(mac="00:11:22:33:44:BB", name="Device2", mark=100)
+        mock_set_marks.return_value = [
+          {"action": "set_mark", "mac": "00:11:22:33:44:aa", "status": 200, "detail": "OK"},
+          {"action": "set_mark", "mac": "00:11:22:33:44:bb", "status": 404, "detail": "Device was not previously connected"},
+        ]
+
+        moved = DeviceManager.set_devices_mark({"00:11:22:33:44:AA": 101, "00:11:22:33:44:BB": 101})
+
+        mock_set_marks.assert_called_once_with({"00:11:22:33:44:AA": 101, "00:11:22:33:44:BB": 101})
+        self.assertEqual(moved, 1)
+        self.assertEqual(Device.objects.get(mac="00:11:22:33:44:AA").mark, 101)
+        self.assertEqual(Device.objects.get(mac="00:11:22:33:44:BB").mark, 100)
+
+    def test_set_devices_mark_empty(self):
+        """
+        Test that moving no device does not call netcontrol
+        """
+        with patch('langate.settings.netcontrol.set_marks') as mock_set_marks:
+            self.assertEqual(DeviceManager.set_devices_mark({}), 0)
+            mock_set_marks.assert_not_called()
+
+    @patch('langate.network.models.NETCONTROL_SESSION_TIMEOUT', 600)
+    @patch('langate.settings.netcontrol.get_mac', return_value="00:11:22:33:44:55")
+    @patch('langate.settings.netcontrol.connect_user', return_value = None)
+    def test_create_user_device_timeout(self, mock_connect_user, mock_get_mac):
+        """
+        Test that user devices are connected with the session timeout
+        """
+        device = DeviceManager.create_user_device(
+          user=self.user, ip="123.123.123.123", name="TestDevice"
+        )
+        mock_connect_user.assert_called_once_with("00:11:22:33:44:55", device.mark, "testuser", 600)
+
+    @patch('langate.network.models.NETCONTROL_SESSION_TIMEOUT', 600)
+    @patch('langate.settings.netcontrol.disconnect_user', return_value = None)
+    @patch('langate.settings.netcontrol.connect_user', return_value = None)
+    def test_edit_device_mac_timeout(self, mock_connect_user, mock_disconnect_user):
+        """
+        Test that a user device given a new MAC address is connected again with the session timeout,
+        and that other devices are not
+        """
+        UserDevice.objects.create(mac="00:11:22:33:44:AA", name="Device1", user=self.user, ip="10.0.0.1", mark=100)
+        other = Device.objects.create(mac="00:11:22:33:44:CC", name="Device3", whitelisted=True, mark=100)
+
+        # Staff edit the devices through their Device row
+        device = Device.objects.get(mac="00:11:22:33:44:AA")
+        DeviceManager.edit_device(device, "00:11:22:33:44:BB", device.name)
+        mock_disconnect_user.assert_called_with("00:11:22:33:44:AA")
+        mock_connect_user.assert_called_with("00:11:22:33:44:BB", 100, "Device1", 600)
+        self.assertTrue(UserDevice.objects.filter(mac="00:11:22:33:44:BB").exists())
+
+        DeviceManager.edit_device(other, "00:11:22:33:44:DD", other.name)
+        mock_connect_user.assert_called_with("00:11:22:33:44:DD", 100, "Device3", None)
+
+    @patch('langate.settings.netcontrol.batch')
+    @patch('langate.settings.netcontrol.refresh_users')
+    def test_refresh_user_devices(self, mock_refresh_users, mock_batch):
+        """
+        Test that the devices of active users are refreshed, and reconnected if netcontrol lost them
+        """
+        inactive = User.objects.create(username="inactive", password="password", is_active=False)
+        UserDevice.objects.create(mac="00:11:22:33:44:AA", name="Device1", user=self.user, ip="10.0.0.1", mark=100)
+        UserDevice.objects.create(mac="00:11:22:33:44:BB", name="Device2", user=self.user, ip="10.0.0.2", mark=101)
+        UserDevice.objects.create(mac="00:11:22:33:44:CC", name="Device3", user=inactive, ip="10.0.0.3", mark=100)
+        mock_refresh_users.return_value = [
+          {"action": "refresh", "mac": "00:11:22:33:44:aa", "status": 200, "detail": "OK"},
+          {"action": "refresh", "mac": "00:11:22:33:44:bb", "status": 404, "detail": "Device was not previously connected"},
+        ]
+        mock_batch.return_value = [
+          {"action": "connect", "mac": "00:11:22:33:44:bb", "status": 200, "detail": "OK"},
+        ]
+
+        refreshed = DeviceManager.refresh_user_devices(600)
+
+        macs, timeout = mock_refresh_users.call_args[0]
+        self.assertCountEqual(macs, ["00:11:22:33:44:AA", "00:11:22:33:44:BB"])
+        self.assertEqual(timeout, 600)
+        mock_batch.assert_called_once_with([
+          {"action": "connect", "mac": "00:11:22:33:44:BB", "mark": 101, "name": "testuser", "timeout": 600}
+        ])
+        self.assertEqual(refreshed, 2)
+
+    def test_refresh_user_devices_empty(self):
+        """
+        Test that refreshing no device does not call netcontrol
+        """
+        with patch('langate.settings.netcontrol.refresh_users') as mock_refresh_users:
+            self.assertEqual(DeviceManager.refresh_user_devices(600), 0)
+            mock_refresh_users.assert_not_called()
+
+    @patch.dict('langate.settings.SETTINGS', {
+      "marks": [
+        {"name": "capped", "value": 100, "priority": 1, "limits": {"bytes": 1000}},
+        {"name": "free", "value": 101, "priority": 1},
+      ],
+      "role_limits": {"player": {"bytes": 500, "packets": 100}},
+    })
+    @patch('langate.settings.netcontrol.put_shaping')
+    def test_apply_shaping(self, mock_put_shaping):
+        """
+        Test that the caps of each device come from its mark and the role of its user, the lowest one applying
+        """
+        UserDevice.objects.create(mac="00:11:22:33:44:AA", name="Device1", user=self.user, ip="10.0.0.1", mark=100)
+        UserDevice.objects.create(mac="00:11:22:33:44:BB", name="Device2", user=self.user, ip="10.0.0.2", mark=101)
+        Device.objects.create(mac="00:11:22:33:44:CC", name="Device3", whitelisted=True, mark=100)
+        Device.objects.create(mac="00:11:22:33:44:DD", name="Device4", whitelisted=True, mark=101)
+
+        self.assertEqual(DeviceManager.apply_shaping(), 3)
+
+        mock_put_shaping.assert_called_once()
+        self.assertCountEqual(mock_put_shaping.call_args[0][0], [
+          {"mac": "00:11:22:33:44:AA", "bytes": 500, "packets": 100},
+          {"mac": "00:11:22:33:44:BB", "bytes": 500, "packets": 100},
+          {"mac": "00:11:22:33:44:CC", "bytes": 1000, "packets": None},
+        ])
+
+    def test_apply_shaping_not_configured(self):
+        """
+        Test that nothing is sent to netcontrol when no mark nor role is capped, unless forced
+        """
+        with patch('langate.settings.netcontrol.put_shaping') as mock_put_shaping:
+            self.assertEqual(DeviceManager.apply_shaping(), 0)
+            mock_put_shaping.assert_not_called()
+
+            DeviceManager.apply_shaping(force=True)
+            mock_put_shaping.assert_called_once_with([])
+
+    @patch.dict('langate.settings.SETTINGS', {
+      "marks": [
+        {"name": "capped", "value": 100, "priority": 1, "limits": {"bytes": 1000}},
+        {"name": "free", "value": 101, "priority": 1},
+      ],
+      "role_limits": {"player": {"bytes": 500, "packets": 100}},
+    })
+    @patch('langate.settings.netcontrol.put_shaping')
+    @patch('langate.settings.netcontrol.patch_shaping')
+    @patch('langate.settings.netcontrol.set_mark')
+    def test_update_shaping(self, mock_set_mark, mock_patch_shaping, mock_put_shaping):
+        """
+        Test that a change of a device only sends the caps of that device
+        """
+        device = Device.objects.create(mac="00:11:22:33:44:CC", name="Device3", whitelisted=True, mark=101)
+        UserDevice.objects.create(mac="00:11:22:33:44:AA", name="Device1", user=self.user, ip="10.0.0.1", mark=101)
+
+        DeviceManager.edit_device(device, device.mac, device.name, 100)
+
+        mock_put_shaping.assert_not_called()
+        mock_patch_shaping.assert_called_once_with([{"mac": "00:11:22:33:44:CC", "bytes": 1000, "packets": None}])
+
+        self.assertEqual(DeviceManager.update_shaping([("00:11:22:33:44:AA", 101, "player"), ("00:11:22:33:44:BB", None, None)]), 2)
+        mock_patch_shaping.assert_called_with([
+          {"mac": "00:11:22:33:44:AA", "bytes": 500, "packets": 100},
+          {"mac": "00:11:22:33:44:BB", "bytes": None, "packets": None},
+        ])
+
+    @patch('langate.settings.netcontrol.patch_shaping')
+    def test_update_shaping_not_configured(self, mock_patch_shaping):
+        """
+        Test that the caps of a device are not sent when no mark nor role is capped
+        """
+        self.assertEqual(DeviceManager.update_shaping([("00:11:22:33:44:AA", 100, None)]), 0)
+        mock_patch_shaping.assert_not_called()
+
 class TestNetworkAPI(TestCase):
     """
     Test cases for the DeviceDetail view
@@ -594,11 +770,16 @@ class TestMarkAPI(TestCase):
             self.assertEqual(response.data[i]["priority"], self.settings["marks"][i]["priority"])
             self.assertEqual(response.data[i]["devices"], Device.objects.filter(mark=self.settings["marks"][i]["value"], whitelisted=False).count())
             self.assertEqual(response.data[i]["whitelisted"], Device.objects.filter(mark=self.settings["marks"][i]["value"], whitelisted=True).count())
+            self.assertFalse(response.data[i]["drained"])
 
+    @patch('langate.settings.netcontrol.set_marks')
     @patch('langate.settings.netcontrol.set_mark', return_value=None)
     @patch('langate.network.views.save_settings')
-    def test_patch_marks(self, mock_save_settings, mock_set_mark):
+    def test_patch_marks(self, mock_save_settings, mock_set_mark, mock_set_marks):
         mock_save_settings.side_effect = lambda x: None
+        mock_set_marks.side_effect = lambda marks: [
+          {"action": "set_mark", "mac": mac.lower(), "status": 200, "detail": "OK"} for mac in marks
+        ]
 
         new_marks = [
           {"value": 102, "name": "Mark 3", "priority": 0.3},
@@ -612,6 +793,33 @@ class TestMarkAPI(TestCase):
         self.assertEqual(len(ORIGINAL_SETTINGS["marks"]), 2)
         self.assertEqual(ORIGINAL_SETTINGS["marks"][0]["value"], 102)
         self.assertEqual(ORIGINAL_SETTINGS["marks"][1]["value"], 103)
+        # The devices of the removed marks are moved at once, towards the new priorities
+        mock_set_marks.assert_called_once()
+        self.assertIn(Device.objects.get(mac="00:00:00:00:00:01").mark, [102, 103])
+
+    @patch.dict('langate.settings.SETTINGS')
+    @patch('langate.settings.netcontrol.put_shaping')
+    @patch('langate.network.views.save_settings')
+    def test_patch_marks_limits(self, mock_save_settings, mock_put_shaping):
+        new_marks = [
+          {"value": 100, "name": "Mark 1", "priority": 0.5, "limits": {"bytes": 1000, "packets": 10}},
+          {"value": 101, "name": "Mark 2", "priority": 0.5},
+        ]
+        response = self.client.patch(self.url, new_marks, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data[0]["limits"], {"bytes": 1000, "packets": 10})
+        self.assertNotIn("limits", response.data[1])
+        # The policy is recompiled with the new caps
+        mock_put_shaping.assert_called_once_with([{"mac": "00:00:00:00:00:01", "bytes": 1000, "packets": 10}])
+
+    def test_patch_invalid_limits(self):
+        invalid_marks = [
+          {"value": 100, "name": "Mark 1", "priority": 0.5, "limits": {"bytes": -1}},
+        ]
+        response = self.client.patch(self.url, invalid_marks, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data["error"], "Invalid mark")
 
     def test_patch_invalid_marks(self):
         invalid_marks = [
@@ -628,6 +836,106 @@ class TestMarkAPI(TestCase):
         response = self.client.patch(self.url, [], format='json')
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
+    @patch('langate.network.views.SETTINGS', {"marks": [
+      {"value": 100, "name": "Mark 1", "priority": 0.5},
+      {"value": 101, "name": "Mark 2", "priority": 0.5}
+    ]})
+    @patch('langate.settings.netcontrol.set_marks')
+    def test_move_mark(self, mock_set_marks):
+        mock_set_marks.side_effect = lambda marks: [
+          {"action": "set_mark", "mac": mac.lower(), "status": 200, "detail": "OK"} for mac in marks
+        ]
+
+        response = self.client.post(reverse('mark-move', args=[101, 100]))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["moved"], 1)
+        # Only the non whitelisted device is moved, in a single netcontrol call
+        mock_set_marks.assert_called_once_with({"00:00:00:00:00:03": 100})
+        self.assertEqual(Device.objects.get(mac="00:00:00:00:00:03").mark, 100)
+        self.assertEqual(Device.objects.get(mac="00:00:00:00:00:02").mark, 101)
+
+    @patch('langate.network.views.SETTINGS', {"marks": [
+      {"value": 100, "name": "Mark 1", "priority": 0.5},
+      {"value": 101, "name": "Mark 2", "priority": 0.5}
+    ]})
+    @patch('langate.settings.netcontrol.set_marks', side_effect=requests.HTTPError)
+    def test_move_mark_netcontrol_error(self, mock_set_marks):
+        response = self.client.post(reverse('mark-move', args=[101, 100]))
+
+        self.assertEqual(response.status_code, status.HTTP_502_BAD_GATEWAY)
+        self.assertEqual(Device.objects.get(mac="00:00:00:00:00:03").mark, 101)
+
+    @patch.dict('langate.settings.SETTINGS', {"marks": [
+      {"value": 100, "name": "Mark 1", "priority": 0.5},
+      {"value": 101, "name": "Mark 2", "priority": 0.5},
+      {"value": 102, "name": "Mark 3", "priority": 1},
+    ], "games": {}})
+    @patch('langate.settings.netcontrol.set_marks')
+    def test_rebalance(self, mock_set_marks):
+        mock_set_marks.side_effect = lambda marks: [
+          {"action": "set_mark", "mac": mac.lower(), "status": 200, "detail": "OK"} for mac in marks
+        ]
+        for i in range(4, 8):
+            Device.objects.create(mac=f"00:00:00:00:00:0{i}", mark=100, whitelisted=False)
+
+        # Dry run: 5 devices on 100 and 1 on 101, the third mark should hold half of them
+        response = self.client.get(reverse('mark-rebalance'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["current"], {100: 5, 101: 1, 102: 0})
+        self.assertEqual(response.data["projected"], {100: 2, 101: 1, 102: 3})
+        self.assertEqual(response.data["moves"], [{"from": 100, "to": 102, "count": 3}])
+        mock_set_marks.assert_not_called()
+
+        # Within the tolerance, nothing has to move
+        response = self.client.get(reverse('mark-rebalance'), {"tolerance": 0.5})
+        self.assertEqual(response.data["moves"], [])
+
+        response = self.client.get(reverse('mark-rebalance'), {"tolerance": 2})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(reverse('mark-rebalance'), {"tolerance": 0}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["moved"], 3)
+        mock_set_marks.assert_called_once()
+        self.assertEqual(Device.objects.filter(mark=102).count(), 3)
+        # The whitelisted device is never moved
+        self.assertEqual(Device.objects.get(mac="00:00:00:00:00:02").mark, 101)
+
+    @patch.dict('langate.settings.SETTINGS', {"marks": [
+      {"value": 100, "name": "Mark 1", "priority": 0.5},
+      {"value": 101, "name": "Mark 2", "priority": 0.5},
+      {"value": 102, "name": "Mark 3", "priority": 1},
+    ], "games": {"lol": [101]}})
+    @patch('langate.settings.netcontrol.set_marks')
+    def test_spread_mark(self, mock_set_marks):
+        mock_set_marks.side_effect = lambda marks: [
+          {"action": "set_mark", "mac": mac.lower(), "status": 200, "detail": "OK"} for mac in marks
+        ]
+        player = User.objects.create(username="player", password="password", tournament="lol")
+        for i in range(4, 8):
+            UserDevice.objects.create(mac=f"00:00:00:00:00:0{i}", name=f"Device{i}", user=player, ip=f"10.0.0.{i}", mark=100)
+
+        response = self.client.post(reverse('mark-spread', args=[100]))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["moved"], 5)
+        mock_set_marks.assert_called_once()
+        # The players stay within the marks of their tournament, the other device follows the priorities
+        self.assertEqual(UserDevice.objects.filter(mark=101).count(), 4)
+        self.assertEqual(Device.objects.get(mac="00:00:00:00:00:01").mark, 102)
+
+    @patch.dict('langate.settings.SETTINGS', {"marks": [
+      {"value": 100, "name": "Mark 1", "priority": 0.5},
+      {"value": 101, "name": "Mark 2", "priority": 0.5},
+    ], "games": {}})
+    @patch('langate.settings.netcontrol.set_marks', side_effect=requests.HTTPError)
+    def test_spread_mark_netcontrol_error(self, mock_set_marks):
+        response = self.client.post(reverse('mark-spread', args=[100]))
+
+        self.assertEqual(response.status_code, status.HTTP_502_BAD_GATEWAY)
+        self.assertEqual(Device.objects.get(mac="00:00:00:00:00:01").mark, 100)
+
 class TestsGameMarkAPI(TestCase):
   def setUp(self):
     self.settings = {
@@ -699,3 +1007,404 @@ class TestsGameMarkAPI(TestCase):
     self.client.force_authenticate(user=None)
     response = self.client.patch(self.url, data=json.dumps({}), content_type='application/json')
     self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+  @patch.dict('langate.settings.SETTINGS')
+  @patch('langate.settings.netcontrol.put_games')
+  @patch('langate.network.views.save_settings')
+  def test_patch_games_ports(self, mock_save_settings, mock_put_games):
+    from langate.settings import SETTINGS
+
+    data = {"game1": {"marks": [100], "ports": {"udp": ["27015-27030", 3478]}}}
+    response = self.client.patch(self.url, data=json.dumps(data), content_type='application/json')
+
+    self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+    # The default view only has the marks of each game
+    self.assertEqual(response.data, {"game1": [100]})
+    mock_put_games.assert_called_once_with({"tcp": [], "udp": ["27015-27030", "3478"]})
+
+    # A game given as a list of marks keeps its ports
+    response = self.client.patch(self.url + "?ports=1", data=json.dumps({"game1": [101]}), content_type='application/json')
+
+    self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+    self.assertEqual(response.data, {"game1": {"marks": [101], "ports": {"udp": ["27015-27030", 3478]}}})
+    self.assertEqual(SETTINGS["games"], response.data)
+    self.assertEqual(mock_put_games.call_count, 2)
+
+  def test_patch_games_invalid_ports(self):
+    for ports in [{"udp": ["27030-27015"]}, {"udp": [70000]}, {"sctp": [80]}, {"tcp": ["http"]}]:
+      data = {"game1": {"marks": [100], "ports": ports}}
+      response = self.client.patch(self.url, data=json.dumps(data), content_type='application/json')
+      self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestHeavyHitters(TestCase):
+    """
+    Test cases for the isolation of heavy hitters on the bulk mark
+    """
+
+    @staticmethod
+    def sample(total):
+        return [{"mac": "00:11:22:33:44:aa", "ip": None, "tx_bytes": total, "tx_packets": 0, "rx_bytes": 0, "rx_packets": 0}]
+
+    def test_policy_hysteresis(self):
+        """
+        Test that a device is isolated after staying above the threshold, and released after staying
+        below the release threshold for the cool-down
+        """
+        policy = HeavyHitterPolicy(threshold=1000, sustain=2, release=0.5, cooldown=20)
+        mac = "00:11:22:33:44:aa"
+
+        # Rates of 2000, then 0 which interrupts the streak, then 2000 twice
+        totals = [0, 20000, 20000, 40000, 60000]
+        decisions = [policy.step(10 * i, self.sample(total)) for i, total in enumerate(totals)]
+        self.assertEqual(decisions[:4], [([], [])] * 4)
+        self.assertEqual(decisions[4], ([mac], []))
+
+        # 800 bytes/s is below the threshold but above the release threshold, the device stays isolated
+        self.assertEqual(policy.step(50, self.sample(68000)), ([], []))
+        self.assertEqual(policy.step(60, self.sample(76000)), ([], []))
+
+        # Calm from t=70, released once the cool-down has passed
+        self.assertEqual(policy.step(70, self.sample(77000)), ([], []))
+        self.assertEqual(policy.step(80, self.sample(78000)), ([], []))
+        self.assertEqual(policy.step(90, self.sample(79000)), ([], [mac]))
+        self.assertNotIn(mac, policy.calm_since)
+
+    @patch.dict('langate.settings.SETTINGS', {"marks": [
+      {"name": "default", "value": 100, "priority": 1},
+      {"name": "bulk", "value": 110, "priority": 0},
+    ]})
+    @patch('langate.network.tasks.time.monotonic', side_effect=[0, 10])
+    @patch('langate.settings.netcontrol.set_mark', return_value=None)
+    @patch('langate.settings.netcontrol.get_counters')
+    def test_isolate_heavy_hitters(self, mock_get_counters, mock_set_mark, mock_monotonic):
+        """
+        Test that a device above the threshold is moved to the bulk mark, and a whitelisted one is not
+        """
+        Device.objects.create(mac="00:11:22:33:44:AA", name="Device1", mark=100)
+        Device.objects.create(mac="00:11:22:33:44:BB", name="Device2", mark=100, whitelisted=True)
+        mock_get_counters.side_effect = [
+          self.sample(0) + [{**self.sample(0)[0], "mac": "00:11:22:33:44:bb"}],
+          self.sample(100000) + [{**self.sample(100000)[0], "mac": "00:11:22:33:44:bb"}],
+        ]
+        stop = MagicMock()
+        stop.wait.side_effect = [False, False, True]
+
+        isolate_heavy_hitters({"mark": 110, "threshold": 1000, "sustain": 1}, stop)
+
+        mock_set_mark.assert_called_once_with("00:11:22:33:44:AA", 110)
+        self.assertEqual(Device.objects.get(mac="00:11:22:33:44:AA").mark, 110)
+        self.assertEqual(Device.objects.get(mac="00:11:22:33:44:BB").mark, 100)
+
+
+class TestMarkWatchdog(TestCase):
+    """
+    Test cases for the draining of the marks whose tunnel is unhealthy
+    """
+
+    def test_watchdog_rate_limit(self):
+        """
+        Test that marks are drained after staying unhealthy, one at a time, and restored after recovering
+        """
+        watchdog = MarkWatchdog(max_loss=0.1, max_rtt=200, duration=20, recovery=30, min_interval=60, max_drained=2)
+        bad = {"loss": 0.5, "rtt": 50}
+        good = {"loss": 0.0, "rtt": 50}
+
+        self.assertEqual(watchdog.step(0, {100: bad, 101: {"loss": 0.0, "rtt": 500}, 102: good}), ([], []))
+        self.assertEqual(watchdog.step(10, {100: bad, 101: {"loss": 0.0, "rtt": 500}, 102: good}), ([], []))
+        # Both marks are unhealthy for long enough, but only one is drained at a time
+        self.assertEqual(watchdog.step(20, {100: bad, 101: {"loss": 0.0, "rtt": 500}, 102: good}), ([100], []))
+        self.assertEqual(watchdog.step(50, {100: good, 101: {"loss": 0.0, "rtt": 500}, 102: good}), ([], []))
+        self.assertEqual(watchdog.step(80, {100: good, 101: {"loss": 0.0, "rtt": 500}, 102: good}), ([101], [100]))
+        # A mark flapping back does not count as recovered
+        self.assertEqual(watchdog.step(90, {101: good}), ([], []))
+        self.assertEqual(watchdog.step(100, {101: bad}), ([], []))
+        self.assertEqual(watchdog.step(130, {101: good}), ([], []))
+        self.assertEqual(watchdog.step(160, {101: good}), ([], [101]))
+
+    def test_mark_signals(self):
+        """
+        Test that the latency and the last bucket of the series are merged by mark
+        """
+        latency = {100: {"loss_ewma": 0.1, "rtt_ewma": 30.0}}
+        series = {"interval": 10, "time": [0.0, 10.0], "marks": {
+          "100": {"tx_bytes": [0, 100], "rx_bytes": [0, 900]},
+          "101": {"tx_bytes": [0, 0], "rx_bytes": [0, 50]},
+        }}
+        self.assertEqual(mark_signals(latency, series), {
+          100: {"loss": 0.1, "rtt": 30.0, "throughput": 100.0},
+          101: {"throughput": 5.0},
+        })
+
+    @patch.dict('langate.settings.SETTINGS', {
+      "marks": [
+        {"name": "sick", "value": 100, "priority": 0},
+        {"name": "healthy", "value": 101, "priority": 1},
+      ],
+      "games": {},
+    })
+    @patch('langate.settings.netcontrol.set_marks')
+    def test_drain_mark(self, mock_set_marks):
+        """
+        Test that the devices of a drained mark are moved in a single batch, except the whitelisted ones
+        """
+        mock_set_marks.side_effect = lambda marks: [
+          {"action": "set_mark", "mac": mac.lower(), "status": 200, "detail": "OK"} for mac in marks
+        ]
+        user = User.objects.create(username="player", password="password")
+        UserDevice.objects.create(mac="00:11:22:33:44:AA", name="Device1", user=user, ip="10.0.0.1", mark=100)
+        Device.objects.create(mac="00:11:22:33:44:BB", name="Device2", mark=100)
+        Device.objects.create(mac="00:11:22:33:44:CC", name="Device3", mark=100, whitelisted=True)
+
+        self.assertEqual(drain_mark(100, [100]), 2)
+
+        mock_set_marks.assert_called_once_with({"00:11:22:33:44:AA": 101, "00:11:22:33:44:BB": 101})
+        self.assertEqual(Device.objects.get(mac="00:11:22:33:44:CC").mark, 100)
+
+    @patch.dict('langate.settings.SETTINGS', {
+      "marks": [
+        {"name": "sick", "value": 100, "priority": 1},
+        {"name": "healthy", "value": 101, "priority": 1},
+      ],
+      "games": {},
+    })
+    def test_drained_marks_not_saved(self):
+        """
+        Test that a drained mark is never given, while the settings keep and save its priority
+        """
+        from langate.settings import SETTINGS
+
+        tables.drain(100)
+        self.addCleanup(tables.restore, 100)
+
+        self.assertEqual(SETTINGS["marks"][0]["priority"], 1)
+        self.assertEqual(tables.priorities(SETTINGS), {100: 0, 101: 1})
+        self.assertTrue(all(get_mark() == 101 for _ in range(20)))
+
+        Device.objects.create(mac="00:11:22:33:44:AA", name="Device1", mark=100)
+        plan = DeviceManager.plan_rebalance()
+        self.assertEqual(plan["devices"], {})
+
+        # Saving the settings during the drain, as PATCH /network/marks/ does, keeps the configured priority
+        with patch('langate.network.utils.open', mock_open(), create=True) as mock_file:
+            save_settings(SETTINGS)
+        saved = json.loads("".join(call.args[0] for call in mock_file().write.call_args_list))
+        self.assertEqual(saved["marks"][0]["priority"], 1)
+
+        tables.restore(100)
+        self.assertEqual(tables.priorities(SETTINGS), {100: 1, 101: 1})
+
+
+@patch.dict('langate.settings.SETTINGS', {
+  "marks": [
+    {"name": "sans vpn", "value": 100, "priority": 0},
+    {"name": "vpn1", "value": 101, "priority": 0.5},
+    {"name": "vpn2", "value": 102, "priority": 0.5},
+    {"name": "vpn3", "value": 103, "priority": 1},
+  ],
+  "games": {"lol": [101, 102]},
+  "team_affinity": {"max_devices": 2},
+})
+class TestTeamAffinity(TestCase):
+    """
+    Test cases for the devices of a team sticking to the same mark
+    """
+
+    def setUp(self):
+        index.reset()
+        self.players = [
+          User.objects.create(username=f"player{i}", password="password", tournament="lol", team="blue")
+          for i in range(5)
+        ]
+
+    def tearDown(self):
+        index.reset()
+
+    def test_team_sticks_to_mark(self):
+        """
+        Test that the devices of a team join the mark of the first one, and spill over once it is full
+        """
+        first = get_mark(self.players[0])
+        self.assertIn(first, [101, 102])
+        UserDevice.objects.create(mac="00:11:22:33:44:00", name="Device0", user=self.players[0], ip="10.0.0.1", mark=first)
+
+        self.assertEqual(get_mark(self.players[1]), first)
+        UserDevice.objects.create(mac="00:11:22:33:44:01", name="Device1", user=self.players[1], ip="10.0.0.2", mark=first)
+
+        # The mark is full, the team spills over to the other mark of the tournament
+        other = 203 - first
+        self.assertEqual(get_mark(self.players[2]), other)
+        UserDevice.objects.create(mac="00:11:22:33:44:02", name="Device2", user=self.players[2], ip="10.0.0.3", mark=other)
+        self.assertEqual(get_mark(self.players[3]), other)
+
+        # A device leaving the first mark makes room for the team
+        Device.objects.get(mac="00:11:22:33:44:00").delete()
+        self.assertEqual(index.team_marks(self.players[0]), {other: 1, first: 1})
+        self.assertIn(get_mark(self.players[3]), [first, other])
+        UserDevice.objects.create(mac="00:11:22:33:44:03", name="Device3", user=self.players[3], ip="10.0.0.4", mark=other)
+        self.assertEqual(get_mark(self.players[4]), first)
+
+    def test_team_without_tournament_marks(self):
+        """
+        Test that the devices of a team whose tournament has no marks stick together too, on any mark
+        """
+        players = [
+          User.objects.create(username=f"cs{i}", password="password", tournament="cs", team="green")
+          for i in range(2)
+        ]
+        first = get_mark(players[0])
+        self.assertIn(first, [101, 102, 103])
+        UserDevice.objects.create(mac="00:11:22:33:44:10", name="Device0", user=players[0], ip="10.0.0.1", mark=first)
+        for _ in range(10):
+            self.assertEqual(get_mark(players[1]), first)
+
+    def test_index_follows_changes(self):
+        """
+        Test that the index follows the changes of marks and of teams
+        """
+        index.team_marks(self.players[0])
+        UserDevice.objects.create(mac="00:11:22:33:44:00", name="Device0", user=self.players[0], ip="10.0.0.1", mark=101)
+        Device.objects.create(mac="00:11:22:33:44:01", name="Device1", mark=103)
+        Device.objects.create(mac="00:11:22:33:44:02", name="Device2", mark=103, whitelisted=True)
+        self.assertEqual(index.mark_counts(), {101: 1, 103: 1})
+
+        with patch('langate.settings.netcontrol.set_marks', side_effect=lambda marks: [
+          {"action": "set_mark", "mac": mac.lower(), "status": 200, "detail": "OK"} for mac in marks
+        ]):
+            DeviceManager.set_devices_mark({"00:11:22:33:44:00": 102})
+        self.assertEqual(index.team_marks(self.players[0]), {102: 1})
+
+        self.players[0].team = "red"
+        self.players[0].save()
+        self.assertEqual(index.team_marks(self.players[1]), {})
+        self.assertEqual(index.team_marks(self.players[0]), {102: 1})
+        self.assertEqual(index.mark_counts(), {102: 1, 103: 1})
+
+
+class TestLoadAllocation(TestCase):
+    """
+    Test cases for the allocation of the marks by their load
+    """
+
+    def setUp(self):
+        index.reset()
+
+    def tearDown(self):
+        index.reset()
+
+    def test_least_loaded(self):
+        """
+        Test that the mark most under its share is chosen, blending the throughput if asked
+        """
+        self.assertEqual(least_loaded([101, 102], [1, 3], {}), 102)
+        self.assertEqual(least_loaded([101, 102], [1, 3], {101: 1, 102: 2}), 102)
+        self.assertEqual(least_loaded([101, 102], [1, 3], {101: 0, 102: 4}), 101)
+        # A mark with a priority of 0 is never chosen
+        self.assertEqual(least_loaded([100, 101], [0, 1], {101: 10}), 101)
+        with self.assertRaises(ValueError):
+            least_loaded([100], [0], {})
+
+        # Same number of devices, but the first mark carries all the traffic
+        self.assertEqual(least_loaded([101, 102], [1, 1], {101: 1, 102: 1}, {101: 1000}, 0.5), 102)
+        self.assertEqual(least_loaded([101, 102], [1, 1], {101: 1, 102: 2}, {101: 1000}, 0.5), 102)
+        self.assertEqual(least_loaded([101, 102], [1, 1], {101: 1, 102: 2}, {101: 1000}, 0), 101)
+
+    @patch.dict('langate.settings.SETTINGS', {
+      "marks": [
+        {"name": "sans vpn", "value": 100, "priority": 0},
+        {"name": "vpn1", "value": 101, "priority": 0.25},
+        {"name": "vpn2", "value": 102, "priority": 0.75},
+        {"name": "vpn3", "value": 103, "priority": 1},
+      ],
+      "games": {"lol": [101, 102]},
+      "allocation": {"policy": "load"},
+    })
+    def test_get_mark_follows_shares(self):
+        """
+        Test that the devices are spread following the priorities, within the marks of their tournament
+        """
+        player = User.objects.create(username="player", password="password", tournament="lol")
+        for i in range(8):
+            UserDevice.objects.create(
+              mac=f"00:11:22:33:44:{i:02x}", name=f"Device{i}", user=player, ip=f"10.0.0.{i + 1}", mark=get_mark(player)
+            )
+        self.assertEqual(index.mark_counts(), {101: 2, 102: 6})
+
+        # A device leaving is replaced on its mark
+        Device.objects.filter(mark=101).first().delete()
+        self.assertEqual(get_mark(player), 101)
+
+        # Without tournament, every mark counts
+        counts = index.mark_counts()
+        marks = [get_mark(counts=counts) for _ in range(8)]
+        self.assertEqual(counts, {101: 2, 102: 6, 103: 7})
+        self.assertNotIn(100, marks)
+
+    def test_plan_rebalance(self):
+        """
+        Test that the planner moves each device at most once, and no more devices than needed
+        """
+        moves, projected = plan_rebalance({101: 7, 102: 0, 103: 0}, {101: 1, 102: 1, 103: 1})
+        self.assertEqual(moves, {(101, 102): 2, (101, 103): 2})
+        self.assertEqual(projected, {101: 3, 102: 2, 103: 2})
+
+        # An emptied mark only sends its devices, towards the marks most under their share
+        moves, projected = plan_rebalance({100: 4, 101: 10, 102: 3}, {100: 0, 101: 1, 102: 1}, tolerance=1)
+        self.assertEqual(moves, {(100, 102): 4})
+        self.assertEqual(projected, {100: 0, 101: 10, 102: 7})
+
+        moves, _ = plan_rebalance({101: 10, 102: 3}, {101: 1, 102: 1}, tolerance=0.1)
+        self.assertEqual(moves, {(101, 102): 2})
+        self.assertEqual(plan_rebalance({101: 6, 102: 7}, {101: 1, 102: 1})[0], {})
+
+
+class TestMarkSampler(TestCase):
+    """
+    Test cases for the marks compiled from the settings and their alias sampler
+    """
+
+    def test_sampler_distribution(self):
+        """
+        Test that the marks are drawn following their weights, and never with a weight of 0
+        """
+        rng = random.Random(42)
+        sampler = AliasSampler([100, 101, 102, 103], [0, 0.1, 0.2, 0.7])
+        draws = Counter(sampler.draw(rng) for _ in range(100000))
+
+        self.assertNotIn(100, draws)
+        for mark, weight in [(101, 0.1), (102, 0.2), (103, 0.7)]:
+            self.assertAlmostEqual(draws[mark] / 100000, weight, delta=0.01)
+
+        with self.assertRaises(ValueError):
+            AliasSampler([100], [0])
+        with self.assertRaises(IndexError):
+            AliasSampler([], [])
+
+    @patch.dict('langate.settings.SETTINGS', {**SETTINGS, "games": {"lol": [101, 102], "cs": []}})
+    def test_tables(self):
+        """
+        Test that the marks are compiled once, per tournament and excluded marks, until the settings are saved
+        """
+        from langate.settings import SETTINGS as CURRENT
+
+        table = tables.get(CURRENT, "lol")
+        self.assertEqual((table.marks, table.weights, table.restricted), ([101, 102], [0.1, 0.2], True))
+        self.assertIs(tables.get(CURRENT, "lol"), table)
+        # A tournament without marks draws from every mark
+        self.assertEqual(tables.get(CURRENT, "cs").marks, [100, 101, 102, 103])
+        self.assertFalse(tables.get(CURRENT, "cs").restricted)
+        self.assertEqual(tables.get(CURRENT, None, [103, 100]).marks, [101, 102])
+
+        with patch("builtins.open"):
+            save_settings(CURRENT)
+        self.assertIsNot(tables.get(CURRENT, "lol"), table)
+
+        # Marks replaced without saving are compiled again too
+        table = tables.get(CURRENT, "lol")
+        CURRENT["marks"] = [{"name": "vpn2", "value": 102, "priority": 1}]
+        self.assertEqual(tables.get(CURRENT, "lol").marks, [102])
+
+        player = User.objects.create(username="player", password="password", tournament="lol")
+        self.assertEqual(get_mark(player), 102)
+        with self.assertRaises(IndexError):
+            get_mark(player, excluded_marks=[102])
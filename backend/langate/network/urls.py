@@ -9,6 +9,7 @@ urlpatterns = [
     path("devices/<int:pk>/", views.DeviceDetail.as_view(), name="device-detail"),
     path("devices/whitelist/", views.DeviceWhitelist.as_view(), name="device-whitelist"),
     path("marks/", views.MarkList.as_view(), name="mark-list"),
+    path("marks/rebalance/", views.MarkRebalance.as_view(), name="mark-rebalance"),
     path("mark/<int:old>/move/<int:new>/", views.MarkMove.as_view(), name="mark-move"),
     path("mark/<int:old>/spread/", views.MarkSpread.as_view(), name="mark-spread"),
     path("games/", views.GameList.as_view(), name="game-list"),
@@ -25,39 +25,128 @@ def generate_dev_name():
     except FileNotFoundError:
         return "MISSINGNO"
 
-def get_mark(user=None, excluded_marks=[]):
+def get_mark(user=None, excluded_marks=[], counts=None):
     """
-        Get a mark from the settings based on random probability
+        Get a mark from the settings based on random probability, or on the load of the marks.
+        counts is a Counter of the devices on each mark to allocate from, the live ones by default:
+        it is updated with the chosen mark, for callers allocating several devices before saving them.
     """
     # prevent circular import
     from langate.settings import SETTINGS
+    from langate.network.allocation import tables
 
-    # If the user is not None, get the mark from the user's game
-    if user:
-        if user.tournament:
-            if SETTINGS["games"] and SETTINGS["games"][user.tournament]:
-
-                existing_marks = [
-                  mark
-                  for mark in SETTINGS["games"][user.tournament]
-                  if mark in [x["value"] for x in SETTINGS["marks"]] and mark not in excluded_marks
-                ]
-
-                mark_proba = [
-                  mark_data["priority"]
-                  for mark in existing_marks
-                  for mark_data in SETTINGS["marks"]
-                  if mark_data["value"] == mark and mark_data["value"] not in excluded_marks
-                ]
-
-                # Chose a random mark from the user's tournament based on the probability
-                return random.choices(existing_marks, weights=mark_proba)[0]
-
-    # Get a random mark from the settings based on the probability
-    return random.choices(
-      [mark["value"] for mark in SETTINGS["marks"] if mark["value"] not in excluded_marks],
-      weights=[mark["priority"] for mark in SETTINGS["marks"] if mark["value"] not in excluded_marks]
-    )[0]
+    # If the user is not None, get the mark from the user's game, the marks are compiled once per settings
+    table = tables.get(SETTINGS, user.tournament if user else None, excluded_marks)
+
+    # Devices of a team stick to the marks of the team
+    if "team_affinity" in SETTINGS and user and user.team:
+        return team_mark(user, table.marks, table.weights, SETTINGS["team_affinity"].get("max_devices"), counts)
+
+    # Chose a mark based on the probability
+    return choose_mark(table.marks, table.weights, counts, table.sampler)
+
+def choose_mark(marks, weights, counts=None, sampler=None):
+    """
+    Choose a mark according to the allocation policy: drawn at random based on the weights by default
+    (with the sampler compiled for these marks, if given), or the mark most under its share of the devices
+    (and of the throughput, if set) with the "load" policy.
+    """
+    # prevent circular import
+    from langate.settings import SETTINGS
+    from langate.network.allocation import index, least_loaded
+
+    allocation = SETTINGS.get("allocation", {})
+    if allocation.get("policy") != "load":
+        mark = sampler.draw() if sampler is not None else random.choices(marks, weights=weights)[0]
+    else:
+        mark = least_loaded(
+          marks, weights, counts if counts is not None else index.mark_counts(),
+          index.throughput, allocation.get("throughput", 0)
+        )
+
+    if counts is not None:
+        counts[mark] += 1
+    return mark
+
+def team_mark(user, marks, weights, max_devices=None, counts=None):
+    """
+    Choose the mark of a device of a team among the given marks, those of its tournament if it has some.
+    The device joins the mark holding the most devices of the team, or the next one once it holds max_devices
+    of them. The first device of the team, and the devices spilling over when every mark of the team is full,
+    choose a mark unused by the team with choose_mark. Marks with a priority of 0 are never chosen.
+    """
+    # prevent circular import
+    from langate.network.allocation import index
+
+    team = index.team_marks(user)
+    allowed = [(mark, weight) for mark, weight in zip(marks, weights) if weight > 0]
+    if not allowed:
+        return choose_mark(marks, weights, counts)
+
+    used = sorted(((team[mark], mark) for mark, _ in allowed if team[mark]), reverse=True)
+    mark = next((mark for count, mark in used if max_devices is None or count < max_devices), None)
+
+    if mark is None:
+        unused = [(mark, weight) for mark, weight in allowed if not team[mark]]
+        if unused:
+            return choose_mark([mark for mark, _ in unused], [weight for _, weight in unused], counts)
+
+        # Every mark is full, fill the one with the fewest devices of the team
+        mark = min(used)[1]
+
+    if counts is not None:
+        counts[mark] += 1
+    return mark
+
+def validate_team_affinity(team_affinity):
+    """
+    Validate the team affinity of the marks.
+    The team affinity data is a dictionary with optionally the maximum number of devices of a team
+    on one mark ("max_devices"), after which the devices of the team spill over to another mark.
+    For example:
+    {
+        "max_devices": 6
+    }
+    """
+    if not isinstance(team_affinity, dict) or set(team_affinity) - {"max_devices"}:
+        return False
+
+    # bool is a subclass of int
+    max_devices = team_affinity.get("max_devices", 1)
+    if isinstance(max_devices, bool) or not isinstance(max_devices, int) or max_devices < 1:
+        return False
+
+    return True
+
+def validate_allocation(allocation):
+    """
+    Validate the allocation policy of the marks.
+    The allocation data is a dictionary with the "policy": "random" to draw the mark of each device based on the
+    priorities, or "load" to give it the mark most under its share of the devices; and optionally, for the "load"
+    policy, the part of the load given by the share of the throughput of the mark ("throughput", between 0 and 1)
+    and the seconds between two reads of the throughput ("interval").
+    For example:
+    {
+        "policy": "load",
+        "throughput": 0.5,
+        "interval": 10
+    }
+    """
+    if not isinstance(allocation, dict) or set(allocation) - {"policy", "throughput", "interval"}:
+        return False
+
+    if allocation.get("policy") not in ["random", "load"]:
+        return False
+
+    # bool is a subclass of int
+    for key in ["throughput", "interval"]:
+        if key in allocation and (isinstance(allocation[key], bool) or not isinstance(allocation[key], (int, float))):
+            return False
+
+    if not 0 <= allocation.get("throughput", 0) <= 1 or allocation.get("interval", 1) <= 0:
+        return False
+
+    return True
 
 def validate_marks(marks):
     """
@@ -85,17 +174,175 @@ def validate_marks(marks):
     for mark in marks:
         if not isinstance(mark["name"], str) or not isinstance(mark["value"], int) or not (isinstance(mark["priority"], int) or isinstance(mark["priority"], float)):
             return False
+        if "limits" in mark and not validate_limits(mark["limits"]):
+            return False
+
+    return True
+
+def validate_limits(limits):
+    """
+    Validate the caps of the traffic of a device.
+    The caps are a dictionary with the "bytes" and/or "packets" the device may send and receive per second.
+    For example:
+    {
+        "bytes": 12500000,
+        "packets": 5000
+    }
+    """
+    if not isinstance(limits, dict):
+        return False
+
+    for key, value in limits.items():
+        if key not in ["bytes", "packets"]:
+            return False
+        # bool is a subclass of int
+        if not isinstance(value, int) or isinstance(value, bool) or value <= 0:
+            return False
+
+    return True
+
+def validate_role_limits(role_limits):
+    """
+    Validate the caps of the traffic of the devices of each role.
+    The role limits are a dictionary with the role as key and the caps (see validate_limits) as value.
+    For example:
+    {
+        "guest": {"bytes": 1250000}
+    }
+    """
+    if not isinstance(role_limits, dict):
+        return False
+
+    # The roles are not checked against the Role enum, which cannot be imported while the settings are loaded
+    for role, limits in role_limits.items():
+        if not isinstance(role, str):
+            return False
+        if not validate_limits(limits):
+            return False
+
+    return True
+
+def get_limits(mark, role=None):
+    """
+    Get the caps of the traffic of a device with the given mark, and owned by a user with the given role if any.
+    When both the mark and the role cap a value, the lowest cap applies.
+    Return a dictionary with the "bytes" and "packets" per second, None when not capped.
+    """
+    # prevent circular import
+    from langate.settings import SETTINGS
+
+    caps = [
+      mark_data.get("limits", {})
+      for mark_data in SETTINGS["marks"]
+      if mark_data["value"] == mark
+    ]
+    if role is not None:
+        caps.append(SETTINGS.get("role_limits", {}).get(role, {}))
+
+    limits = {}
+    for key in ["bytes", "packets"]:
+        values = [cap[key] for cap in caps if key in cap]
+        limits[key] = min(values) if values else None
+    return limits
+
+def shaping_configured():
+    """
+    Check if the traffic of some devices is capped, by their mark or their role
+    """
+    # prevent circular import
+    from langate.settings import SETTINGS
+
+    return any(mark.get("limits") for mark in SETTINGS["marks"]) or any(SETTINGS.get("role_limits", {}).values())
+
+def validate_bulk(bulk, marks):
+    """
+    Validate the isolation of heavy hitters on a bulk mark.
+    The bulk data is a dictionary with the "mark" to move the devices to (one of the marks), the "threshold"
+    of traffic (bytes per second, sent and received) above which they are moved, and optionally the number of
+    samples in a row above it ("sustain"), the share of the threshold below which their traffic must stay
+    to be moved back ("release"), for how long in seconds ("cooldown"), and the seconds between samples ("interval").
+    For example:
+    {
+        "mark": 110,
+        "threshold": 12500000,
+        "sustain": 3,
+        "release": 0.5,
+        "cooldown": 300,
+        "interval": 10
+    }
+    """
+    if not isinstance(bulk, dict):
+        return False
+
+    if set(bulk) - {"mark", "threshold", "sustain", "release", "cooldown", "interval"}:
+        return False
+
+    if bulk.get("mark") not in [mark["value"] for mark in marks]:
+        return False
+
+    # bool is a subclass of int
+    for key in ["threshold", "sustain", "release", "cooldown", "interval"]:
+        if key in bulk and (isinstance(bulk[key], bool) or not isinstance(bulk[key], (int, float))):
+            return False
+
+    if not isinstance(bulk.get("threshold"), (int, float)) or bulk["threshold"] <= 0:
+        return False
+    if not isinstance(bulk.get("sustain", 1), int) or bulk.get("sustain", 1) < 1:
+        return False
+    if not 0 < bulk.get("release", 0.5) <= 1:
+        return False
+    if bulk.get("cooldown", 0) < 0 or bulk.get("interval", 1) <= 0:
+        return False
+
+    return True
+
+def validate_watchdog(watchdog):
+    """
+    Validate the watchdog draining unhealthy marks.
+    The watchdog data is a dictionary with the limits of the health of a mark, each optional: the share of probes
+    lost ("max_loss"), their round-trip time in milliseconds ("max_rtt"), and the throughput in bytes per second
+    ("max_throughput"); and optionally the seconds a mark must stay unhealthy to be drained ("duration"), then
+    healthy to be restored ("recovery"), the minimum seconds between two drains ("min_interval"), the maximum
+    number of marks drained at once ("max_drained"), and the seconds between two checks ("interval").
+    For example:
+    {
+        "max_loss": 0.1,
+        "max_rtt": 250,
+        "duration": 60,
+        "recovery": 300,
+        "min_interval": 600,
+        "max_drained": 1,
+        "interval": 10
+    }
+    """
+    keys = {"max_loss", "max_rtt", "max_throughput", "duration", "recovery", "min_interval", "max_drained", "interval"}
+
+    if not isinstance(watchdog, dict) or set(watchdog) - keys:
+        return False
+
+    # bool is a subclass of int
+    for key, value in watchdog.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            return False
+
+    if not any(key in watchdog for key in ["max_loss", "max_rtt", "max_throughput"]):
+        return False
+    if not isinstance(watchdog.get("max_drained", 1), int) or watchdog.get("max_drained", 1) < 1:
+        return False
+    if watchdog.get("interval", 1) <= 0:
+        return False
 
     return True
 
 def validate_games(games):
     """
     Validate the games data.
-    The games data is a dictionary with the tournament name as key and a list of marks as value.
+    The games data is a dictionary with the tournament name as key and a list of marks as value,
+    or a dictionary with the marks and the ports of the game, whose traffic is given priority.
     For example:
     {
         "tournament1": [100, 101, 102],
-        "tournament2": [100, 103]
+        "tournament2": {"marks": [100, 103], "ports": {"udp": ["27015-27030"], "tcp": ["27015"]}}
     }
     """
     # Check if the games are not empty
@@ -110,17 +357,85 @@ def validate_games(games):
     for game in games:
         if not isinstance(game, str):
             return False
-        if not isinstance(games[game], list):
+        entry = games[game]
+        if isinstance(entry, dict):
+            if set(entry) - {"marks", "ports"} or "marks" not in entry:
+                return False
+            if "ports" in entry and not validate_ports(entry["ports"]):
+                return False
+            entry = entry["marks"]
+        if not isinstance(entry, list):
             return False
-        for mark in games[game]:
+        for mark in entry:
             if not isinstance(mark, int):
                 return False
 
     return True
 
+def validate_ports(ports):
+    """
+    Validate the ports of a game: a dictionary with the protocol ("tcp" or "udp") as key
+    and a list of ports (27015 or "27015") and ranges of ports ("27015-27030") as value.
+    """
+    if not isinstance(ports, dict):
+        return False
+
+    for protocol, values in ports.items():
+        if protocol not in ["tcp", "udp"] or not isinstance(values, list):
+            return False
+        for port in values:
+            if isinstance(port, bool) or not isinstance(port, (int, str)):
+                return False
+            bounds = str(port).split("-")
+            if len(bounds) > 2 or not all(bound.isdigit() for bound in bounds):
+                return False
+            if not 0 < int(bounds[0]) <= int(bounds[-1]) <= 65535:
+                return False
+
+    return True
+
+def game_marks(entry):
+    """
+    Get the marks of a game, whether its entry is a list of marks or a dictionary with its marks and ports
+    """
+    return entry["marks"] if isinstance(entry, dict) else entry
+
+def game_ports(games):
+    """
+    Get the ports of every game, by protocol, as netcontrol expects them
+    """
+    ports = {"tcp": [], "udp": []}
+    for entry in games.values():
+        if isinstance(entry, dict):
+            for protocol, values in entry.get("ports", {}).items():
+                ports[protocol].extend(str(port) for port in values)
+    return ports
+
+def apply_game_ports(force=False):
+    """
+    Send the ports of every game to netcontrol, which replaces them in a single transaction.
+    Unless forced, nothing is sent when no game has ports.
+    Return whether the ports were sent.
+    """
+    # prevent circular import
+    from langate.settings import SETTINGS, netcontrol
+
+    ports = game_ports(SETTINGS["games"])
+    if not force and not any(ports.values()):
+        return False
+
+    netcontrol.put_games(ports)
+    return True
+
 def save_settings(new_settings):
     """
     Save the settings to the settings.json file
     """
+    # prevent circular import
+    from langate.network.allocation import tables
+
     with open("assets/misc/settings.json", "w") as f:
         json.dump(new_settings, f, indent=2)
+
+    # The marks are compiled again from the new settings on next use
+    tables.invalidate()
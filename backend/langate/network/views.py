@@ -1,4 +1,5 @@
 import copy
+import requests
 from functools import reduce
 from operator import or_
 
@@ -17,7 +18,10 @@ from drf_yasg import openapi
 from langate.settings import SETTINGS
 from langate.user.models import Role
 from langate.network.models import Device, UserDevice, DeviceManager
-from langate.network.utils import validate_marks, validate_games, save_settings, get_mark
+from langate.network.allocation import tables
+from langate.network.utils import (
+  validate_marks, validate_games, save_settings, get_mark, shaping_configured, game_marks, game_ports, apply_game_ports
+)
 
 from langate.network.serializers import DeviceSerializer, UserDeviceSerializer, FullDeviceSerializer
 
@@ -297,10 +301,11 @@ class MarkList(APIView):
         # Make a copy
         marks = copy.deepcopy(SETTINGS["marks"])
 
-        # for each mark, add the number of devices with that mark
+        # for each mark, add the number of devices with that mark, and whether the watchdog drained it
         for mark in marks:
             mark["devices"] = Device.objects.filter(mark=mark["value"], whitelisted=False).count()
             mark["whitelisted"] = Device.objects.filter(mark=mark["value"], whitelisted=True).count()
+            mark["drained"] = mark["value"] in tables.drained
 
         return Response(marks)
 
@@ -322,6 +327,11 @@ class MarkList(APIView):
               "value": mark["value"],
               "priority": mark["priority"]
             })
+            if mark.get("limits"):
+                marks[-1]["limits"] = {key: mark["limits"][key] for key in ["bytes", "packets"] if key in mark["limits"]}
+
+        # The previous policy must be replaced if the old marks capped some devices, even if the new ones do not
+        was_shaping = shaping_configured()
 
         # If some marks are removed, add the new marks first, spread the devices and then remove the old marks
         old_marks = [m["value"] for m in SETTINGS["marks"]]
@@ -332,11 +342,22 @@ class MarkList(APIView):
         save_settings(SETTINGS)
 
         if removed_marks:
-            for mark in removed_marks:
-                devices = Device.objects.filter(mark=mark)
-                for device in devices:
-                    new = get_mark(excluded_marks=[mark])
-                    DeviceManager.edit_device(device, device.mac, device.name, new)
+            # Move the devices of the removed marks towards the new priorities, in a single transaction
+            try:
+                DeviceManager.rebalance(tolerance=1, emptied=removed_marks)
+            except ValidationError as e:
+                return Response({"error": e.message}, status=status.HTTP_502_BAD_GATEWAY)
+
+            # The whitelisted devices keep a mark of their own choice, drawn at random
+            for device in Device.objects.filter(mark__in=removed_marks, whitelisted=True):
+                new = get_mark(excluded_marks=removed_marks)
+                DeviceManager.edit_device(device, device.mac, device.name, new)
+
+        # Recompile the caps of every device, netcontrol swaps the whole policy at once
+        try:
+            DeviceManager.apply_shaping(force=was_shaping)
+        except ValidationError as e:
+            return Response({"error": e.message}, status=status.HTTP_502_BAD_GATEWAY)
 
         return Response(SETTINGS["marks"], status=status.HTTP_200_OK)
 
@@ -361,10 +382,12 @@ class MarkMove(APIView):
             return Response({"error": _("Invalid destination mark")}, status=status.HTTP_400_BAD_REQUEST)
 
         devices = Device.objects.filter(mark=old, whitelisted=False)
-        for device in devices:
-            DeviceManager.edit_device(device, device.mac, device.name, new)
+        try:
+            moved = DeviceManager.set_devices_mark({device.mac: new for device in devices})
+        except ValidationError as e:
+            return Response({"error": e.message}, status=status.HTTP_502_BAD_GATEWAY)
 
-        return Response(status=status.HTTP_200_OK)
+        return Response({"moved": moved}, status=status.HTTP_200_OK)
 
 class MarkSpread(APIView):
     """
@@ -383,15 +406,61 @@ class MarkSpread(APIView):
         if old not in marks:
             return Response({"error": _("Invalid origin mark")}, status=status.HTTP_400_BAD_REQUEST)
 
-        if sum([mark["priority"] for mark in SETTINGS["marks"] if mark["value"] != old]) == 0:
+        if sum([priority for mark, priority in tables.priorities(SETTINGS).items() if mark != old]) == 0:
             return Response({"error": _("No mark to spread to")}, status=status.HTTP_400_BAD_REQUEST)
 
-        devices = Device.objects.filter(mark=old, whitelisted=False)
-        for device in devices:
-            new = get_mark(excluded_marks=[old])
-            DeviceManager.edit_device(device, device.mac, device.name, new)
+        # Each device is moved once, towards the priorities of the other marks
+        try:
+            plan = DeviceManager.rebalance(tolerance=1, emptied=[old])
+        except ValidationError as e:
+            return Response({"error": e.message}, status=status.HTTP_502_BAD_GATEWAY)
+
+        return Response({"moved": plan["moved"]}, status=status.HTTP_200_OK)
+
+class MarkRebalance(APIView):
+    """
+    API endpoint that allows the devices to be rebalanced between the marks, following their priorities.
+    """
 
-        return Response(status=status.HTTP_200_OK)
+    permission_classes = [StaffPermission]
+
+    @staticmethod
+    def tolerance(value):
+        """
+        Parse the share of the devices a mark may be away from its target, None if it is invalid
+        """
+        try:
+            tolerance = float(value)
+        except (TypeError, ValueError):
+            return None
+        return tolerance if 0 <= tolerance <= 1 else None
+
+    def get(self, request):
+        """
+        Return the plan of the fewest moves bringing the marks within the tolerance of their share,
+        without moving any device
+        """
+        tolerance = self.tolerance(request.query_params.get("tolerance", 0))
+        if tolerance is None:
+            return Response({"error": _("Invalid tolerance")}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(DeviceManager.plan_rebalance(tolerance), status=status.HTTP_200_OK)
+
+    def post(self, request):
+        """
+        Plan the moves and move the devices
+        """
+        data = request.data or {}
+        tolerance = self.tolerance(data.get("tolerance", 0))
+        if tolerance is None:
+            return Response({"error": _("Invalid tolerance")}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            plan = DeviceManager.rebalance(tolerance)
+        except ValidationError as e:
+            return Response({"error": e.message}, status=status.HTTP_502_BAD_GATEWAY)
+
+        return Response(plan, status=status.HTTP_200_OK)
 
 class GameList(APIView):
     """
@@ -399,11 +468,20 @@ class GameList(APIView):
     """
     permission_classes = [StaffPermission]
 
+    @staticmethod
+    def games(request):
+        """
+        Return the games as the marks of each game, or with their ports if the "ports" query parameter is set
+        """
+        if request.query_params.get("ports"):
+            return SETTINGS["games"]
+        return {game: game_marks(entry) for game, entry in SETTINGS["games"].items()}
+
     def get(self, request):
         """
         Return a list of all games
         """
-        return Response(SETTINGS["games"])
+        return Response(self.games(request))
 
     def patch(self, request):
         """
@@ -412,11 +490,28 @@ class GameList(APIView):
         if not validate_games(request.data):
             return Response({"error": _("Invalid game")}, status=status.HTTP_400_BAD_REQUEST)
 
-        SETTINGS["games"] = request.data
+        # A game given as a list of marks keeps its ports
+        games = {}
+        for game, entry in request.data.items():
+            old = SETTINGS["games"].get(game)
+            if isinstance(entry, list) and isinstance(old, dict) and "ports" in old:
+                entry = {"marks": entry, "ports": old["ports"]}
+            games[game] = entry
+
+        # The previous ports must be replaced if some games had ports, even if the new ones do not
+        had_ports = any(game_ports(SETTINGS["games"]).values())
+
+        SETTINGS["games"] = games
 
         save_settings(SETTINGS)
 
-        return Response(SETTINGS["games"], status=status.HTTP_201_CREATED)
+        # Rebuild the priority of the game traffic, netcontrol swaps all the ports at once
+        try:
+            apply_game_ports(force=had_ports)
+        except requests.HTTPError as e:
+            return Response({"error": str(e)}, status=status.HTTP_502_BAD_GATEWAY)
+
+        return Response(self.games(request), status=status.HTTP_201_CREATED)
 
 class UserDeviceDetail(APIView):
     """
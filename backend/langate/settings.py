@@ -19,7 +19,7 @@ import logging
 from langate.modules.netcontrol import Netcontrol
 
 from django.utils.translation import gettext_lazy as _
-from langate.network.utils import validate_marks, validate_games
+from langate.network.utils import validate_marks, validate_games, validate_role_limits, validate_bulk, validate_watchdog, validate_team_affinity, validate_allocation
 
 logger = logging.getLogger(__name__)
 
@@ -257,7 +257,36 @@ else:
         logger.error("Invalid games found in settings.json, defaulting to {}")
         SETTINGS["games"] = {}
 
+    # Caps of the traffic of the devices of each role, optional
+    if "role_limits" in SETTINGS and not validate_role_limits(SETTINGS["role_limits"]):
+        logger.error("Invalid role limits found in settings.json, ignoring them")
+        del SETTINGS["role_limits"]
+
+    # Isolation of the heavy hitters on a bulk mark, optional
+    if "bulk" in SETTINGS and not validate_bulk(SETTINGS["bulk"], SETTINGS["marks"]):
+        logger.error("Invalid bulk mark found in settings.json, heavy hitters will not be isolated")
+        del SETTINGS["bulk"]
+
+    # Draining of the marks whose tunnel is unhealthy, optional
+    if "watchdog" in SETTINGS and not validate_watchdog(SETTINGS["watchdog"]):
+        logger.error("Invalid watchdog found in settings.json, unhealthy marks will not be drained")
+        del SETTINGS["watchdog"]
+
+    # Devices of a team sticking to the same mark, optional
+    if "team_affinity" in SETTINGS and not validate_team_affinity(SETTINGS["team_affinity"]):
+        logger.error("Invalid team affinity found in settings.json, the marks of the teams will be drawn per device")
+        del SETTINGS["team_affinity"]
+
+    # Policy choosing the mark of the new devices, optional
+    if "allocation" in SETTINGS and not validate_allocation(SETTINGS["allocation"]):
+        logger.error("Invalid allocation found in settings.json, the marks will be drawn at random")
+        del SETTINGS["allocation"]
+
 NETCONTROL_SOCKET_FILE = getenv("NETCONTROL_SOCKET_FILE", "/var/run/langate3000-netcontrol.sock")
+# "tcp" to reach netcontrol on port 6784 of the host, "unix" to use NETCONTROL_SOCKET_FILE
+NETCONTROL_TRANSPORT = getenv("NETCONTROL_TRANSPORT", "tcp")
+# Seconds after which netcontrol disconnects a user device that was not refreshed, 0 to keep them connected forever
+NETCONTROL_SESSION_TIMEOUT = int(getenv("NETCONTROL_SESSION_TIMEOUT") or 0)
 
 # Netcontrol interface
-netcontrol = Netcontrol()
+netcontrol = Netcontrol(NETCONTROL_SOCKET_FILE if NETCONTROL_TRANSPORT == "unix" else None)
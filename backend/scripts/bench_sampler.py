@@ -0,0 +1,68 @@
+"""
+Compares the cost of drawing a mark the way get_mark did before the marks were compiled, rebuilding the lists
+of marks and priorities from the settings for every draw, with the compiled tables and their alias sampler.
+
+Runs without a database or a Django configuration, from the backend directory:
+    python -m scripts.bench_sampler [--marks 16] [--tournaments 8] [--draws 200000]
+"""
+import argparse
+import random
+import timeit
+
+from langate.network.allocation import MarkTables
+
+
+def settings(marks, tournaments):
+    """
+    Builds settings with the given number of marks, each tournament using a quarter of them
+    """
+    rng = random.Random(0)
+    values = [100 + i for i in range(marks)]
+    return {
+        "marks": [{"name": f"vpn{value}", "value": value, "priority": rng.random()} for value in values],
+        "games": {f"game{i}": rng.sample(values, max(1, marks // 4)) for i in range(tournaments)},
+    }
+
+
+def rebuilt(settings, tournament):
+    """
+    Draws a mark of a tournament as get_mark did, joining the marks of the tournament with their priorities
+    """
+    existing_marks = [
+        mark for mark in settings["games"][tournament]
+        if mark in [x["value"] for x in settings["marks"]]
+    ]
+    mark_proba = [
+        mark_data["priority"]
+        for mark in existing_marks
+        for mark_data in settings["marks"]
+        if mark_data["value"] == mark
+    ]
+    return random.choices(existing_marks, weights=mark_proba)[0]
+
+
+def compiled(tables, settings, tournament):
+    """
+    Draws a mark of a tournament from its compiled table
+    """
+    return tables.get(settings, tournament).sampler.draw()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--marks", type=int, default=16, help="number of marks")
+    parser.add_argument("--tournaments", type=int, default=8, help="number of tournaments")
+    parser.add_argument("--draws", type=int, default=200000, help="number of draws of each method")
+    args = parser.parse_args()
+
+    data = settings(args.marks, args.tournaments)
+    tables = MarkTables()
+    tournaments = list(data["games"])
+
+    for name, draw in (("rebuilt", lambda t: rebuilt(data, t)), ("compiled", lambda t: compiled(tables, data, t))):
+        seconds = timeit.timeit(lambda: [draw(t) for t in tournaments], number=args.draws // len(tournaments))
+        print(f"{name:>9}: {seconds / args.draws * 1e9:>8,.0f} ns per draw")
+
+
+if __name__ == "__main__":
+    main()
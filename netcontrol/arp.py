@@ -1,12 +1,101 @@
-from http.client import HTTPException
+from fastapi import HTTPException
 import logging
+import os
+import socket
+import threading
+import time
+from .metrics import Histogram
+from .netlink import dump_neighbours
+
+# Time during which the ARP table read from the kernel is trusted, in seconds
+ARP_CACHE_TTL = float(os.getenv("ARP_CACHE_TTL", "2"))
+# Time during which a key missing from a fresh read is not read again, in seconds
+ARP_NEGATIVE_TTL = float(os.getenv("ARP_NEGATIVE_TTL", "0.5"))
+# Maximum time spent waiting for the answer to an ARP probe, in seconds
+ARP_PROBE_TIMEOUT = float(os.getenv("ARP_PROBE_TIMEOUT", "1"))
+# Maximum number of ARP probes in flight
+ARP_MAX_PROBES = int(os.getenv("ARP_MAX_PROBES", "32"))
+# Neighbour states in which the link-layer address can be used
+USABLE_STATES = ("REACHABLE", "STALE", "DELAY", "PROBE", "PERMANENT")
+
+ARP_READ_DURATION = Histogram("netcontrol_arp_read_duration_seconds", "Duration of the reads of the ARP table")
 
 class Arp:
     """
-    Class which interacts with the ARP table
+    Class which interacts with the ARP table.
+    The table is kept in memory, indexed both by IP and by MAC address, and is read again when
+    it expires or when a lookup misses (the entry may have appeared since the last read).
+    Misses right after a read are answered from the table, so that looking up many unknown keys
+    in a row costs a single read.
     """
-    def __init__(self, logger: logging.Logger):
+    def __init__(self, logger: logging.Logger, ttl: float = ARP_CACHE_TTL):
         self.logger = logger
+        self.ttl = ttl
+        self.ip2mac: dict[str, str] = {}
+        self.mac2ip: dict[str, str] = {}
+        self.expires = 0.0
+        self.read_at = float("-inf")
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _read_table(self) -> dict[str, str]:
+        """
+        Reads the kernel ARP table.
+
+        :return: Mac address of each resolved ip address.
+        """
+        table = {}
+        with open('/proc/net/arp', 'r') as f: # Open arp table
+            next(f) # Skip the header
+            for line in f:
+                # IP address, HW type, Flags, HW address, Mask, Device
+                fields = line.split()
+                if len(fields) >= 4 and fields[2] != "0x0": # Flags are 0x0 for incomplete entries
+                    table[fields[0]] = fields[3]
+        return table
+
+    def _refresh(self, generation: int) -> None:
+        """
+        Reads the ARP table again, unless another lookup already did it in the meantime.
+
+        :param generation: Generation of the cache seen by the caller before it missed.
+        """
+        with self._lock:
+            if self.generation != generation:
+                # Concurrent lookups wait for the one doing the read instead of reading again
+                return
+            start = time.perf_counter()
+            self.ip2mac = self._read_table()
+            ARP_READ_DURATION.observe(time.perf_counter() - start)
+            self.mac2ip = {mac: ip for ip, mac in self.ip2mac.items()}
+            self.read_at = time.monotonic()
+            self.expires = self.read_at + self.ttl
+            self.generation += 1
+
+    def _lookup(self, index: str, key: str):
+        """
+        Looks a key up in one of the indexes, reading the table again if needed.
+
+        :param index: Name of the index, "ip2mac" or "mac2ip".
+        :param key: Key to look up.
+        :return: The value found, or None.
+        """
+        generation = self.generation
+        now = time.monotonic()
+        if now < self.expires:
+            value = getattr(self, index).get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+            if now - self.read_at < ARP_NEGATIVE_TTL:
+                # The table was just read, reading it again for each unknown key would not find more
+                self.misses += 1
+                return None
+        self.misses += 1
+        self._refresh(generation)
+        return getattr(self, index).get(key)
 
     def get_mac(self, ip: str):
         """
@@ -16,38 +105,140 @@ class Arp:
         :return: Mac address of the machine.
         """
         self.logger.info("Querying MAC for IP %s", ip)
-        with open('/proc/net/arp', 'r') as f: # Open arp table
-            lines = f.readlines()[1:]
-            for line in lines:
-                if line.startswith(ip + " "):
-                    mac = line[41:].split(" ")[0] # 41 is the position of the MAC address in the line
-                    self.logger.info("Found MAC %s for IP %s", mac, ip)
-                    return { "mac" : mac }
+        mac = self._lookup("ip2mac", ip)
+        if mac is None:
             raise HTTPException(status_code=404, detail="MAC not found")
-    
+        self.logger.info("Found MAC %s for IP %s", mac, ip)
+        return { "mac" : mac }
+
     def get_ip(self, mac: str):
         """
-        Get the mac address associated with a given ip address.
+        Get the ip address associated with a given mac address.
 
-        :param ip: Ip address of the machine.
-        :return: Mac address of the machine.
+        :param mac: Mac address of the machine.
+        :return: Ip address of the machine.
         """
         self.logger.info("Querying IP for MAC %s", mac)
-        with open('/proc/net/arp', 'r') as f: # Open arp table
-            lines = f.readlines()[1:]
-            for line in lines:
-                if line[41:].split(" ")[0] == mac:
-                    ip = line.split(" ")[0] # Extracting IP address
-                    self.logger.info("Found IP %s for MAC %s", ip, mac)
-                    return { "ip" : ip }
+        ip = self._lookup("mac2ip", mac.lower())
+        if ip is None:
             raise HTTPException(status_code=404, detail="IP not found")
+        self.logger.info("Found IP %s for MAC %s", ip, mac)
+        return { "ip" : ip }
+
+    def stats(self):
+        """
+        Get the cache counters.
+
+        :return: Number of hits, misses, and entries in the cache.
+        """
+        return { "hits" : self.hits, "misses" : self.misses, "entries" : len(self.ip2mac) }
+
+class NetlinkArp(Arp):
+    """
+    Class which queries the kernel neighbour table over netlink instead of reading /proc/net/arp.
+    When an ip address is missing, an ARP probe is sent and the table is read again until the
+    entry is resolved, or the probe times out.
+    """
+    def __init__(self, logger: logging.Logger, ttl: float = ARP_CACHE_TTL):
+        super().__init__(logger, ttl)
+        self.states: dict[str, str] = {}
+        self.probes = 0
+        self.probe_failures = 0
+        self._probing: dict[str, threading.Event] = {}
+        self._probing_lock = threading.Lock()
+        self._probe_slots = threading.BoundedSemaphore(ARP_MAX_PROBES)
+
+    def _read_table(self) -> dict[str, str]:
+        """
+        Reads the kernel neighbour table over netlink.
+
+        :return: Mac address of each ip address whose entry is usable.
+        """
+        table = {}
+        states = {}
+        for neighbour in dump_neighbours():
+            states[neighbour.ip] = neighbour.state
+            if neighbour.state in USABLE_STATES:
+                table[neighbour.ip] = neighbour.mac
+        self.states = states
+        return table
+
+    def _probe(self, ip: str) -> None:
+        """
+        Makes the kernel resolve the given ip address, and waits for the resolution.
+        Concurrent probes for the same ip address wait for the first one.
+
+        :param ip: Ip address of the machine.
+        """
+        with self._probing_lock:
+            event = self._probing.get(ip)
+            owner = event is None
+            if owner:
+                event = self._probing[ip] = threading.Event()
+
+        if not owner:
+            event.wait(ARP_PROBE_TIMEOUT)
+            return
+
+        try:
+            if not self._probe_slots.acquire(blocking=False):
+                self.logger.warning("Too many ARP probes in flight, not probing %s", ip)
+                return
+            try:
+                self.probes += 1
+                # Sending a datagram to the discard port makes the kernel send an ARP request
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                    sock.sendto(b"", (ip, 9))
+
+                deadline = time.monotonic() + ARP_PROBE_TIMEOUT
+                while time.monotonic() < deadline:
+                    time.sleep(0.05)
+                    self._refresh(self.generation)
+                    if ip in self.ip2mac:
+                        return
+                self.probe_failures += 1
+                self.logger.info("ARP probe for %s timed out (state: %s)", ip, self.states.get(ip, "NONE"))
+            finally:
+                self._probe_slots.release()
+        except OSError as e:
+            self.probe_failures += 1
+            self.logger.warning("Could not probe %s: %s", ip, e)
+        finally:
+            with self._probing_lock:
+                del self._probing[ip]
+            event.set()
+
+    def get_mac(self, ip: str):
+        """
+        Get the mac address associated with a given ip address, probing for it if needed.
+
+        :param ip: Ip address of the machine.
+        :return: Mac address of the machine, and the state of its neighbour entry.
+        """
+        self.logger.info("Querying MAC for IP %s", ip)
+        mac = self._lookup("ip2mac", ip)
+        if mac is None:
+            self._probe(ip)
+            mac = self.ip2mac.get(ip)
+        if mac is None:
+            raise HTTPException(status_code=404, detail="MAC not found")
+        self.logger.info("Found MAC %s for IP %s", mac, ip)
+        return { "mac" : mac, "state" : self.states.get(ip) }
+
+    def stats(self):
+        """
+        Get the cache and probe counters.
+
+        :return: Number of hits, misses, entries in the cache, probes and failed probes.
+        """
+        return { **super().stats(), "probes" : self.probes, "probe_failures" : self.probe_failures }
 
 class MockedArp(Arp):
     """
     Class which *doesn't* interact with the ARP table
     """
     def __init__(self, logger: logging.Logger):
-        self.logger = logger
+        super().__init__(logger)
     
     def get_mac(self, ip: str):
         self.logger.info("Querying MAC for IP %s", ip)
@@ -59,4 +250,4 @@ class MockedArp(Arp):
         self.logger.info("Querying IP for MAC %s", mac)
         ip = "127.0.0.1"
         self.logger.info("Found IP %s for MAC %s", ip, mac)
-        return { "ip" : "127.0.0.1" }
\ No newline at end of file
+        return { "ip" : "127.0.0.1" }
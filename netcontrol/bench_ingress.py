@@ -0,0 +1,167 @@
+"""
+Compares the packets per second the network head handles from a device, depending on whether its
+traffic is filtered by the forward chain or dropped by the ingress chain (NFT_INGRESS_INTERFACE).
+
+Three network namespaces are created: a client flooding UDP packets to the internet, a head
+forwarding them with the netcontrol ruleset loaded, and an uplink dropping them. The sender and the
+kernel processing of its packets are pinned to the same CPU, so the rate it reaches is bounded by the
+cost of each packet on the head. The head is first measured without any ruleset, as a baseline.
+
+Must be run as root, with nft, ip and taskset available (--baseline only needs ip and taskset):
+    python bench_ingress.py [--duration 10] [--authenticated] [--baseline]
+"""
+import argparse
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from ruleset import portail_ruleset
+
+CLIENT_NS = "ncbench-client"
+HEAD_NS = "ncbench-head"
+UPLINK_NS = "ncbench-uplink"
+CLIENT_MAC = "02:00:00:00:00:02"
+HEAD_MAC = "02:00:00:00:00:01"
+UPLINK_MAC = "02:00:00:00:00:03"
+CLIENT_IP = "10.0.0.2"
+HEAD_IP = "10.0.0.1"
+UPLINK_IP = "192.0.2.1"
+GATEWAY_IP = "192.0.2.2"
+# Destination of the flood, routed through the uplink
+TARGET_IP = "198.51.100.1"
+
+def run(*command: str, namespace: str | None = None, capture: bool = False) -> str:
+    if namespace is not None:
+        command = ("ip", "netns", "exec", namespace, *command)
+    result = subprocess.run(command, check=True, text=True, capture_output=capture)
+    return result.stdout if capture else ""
+
+def setup() -> None:
+    """
+    Creates the namespaces: client (c0) <-> (h0) head (up0) <-> (u0) uplink
+    """
+    for namespace in (CLIENT_NS, HEAD_NS, UPLINK_NS):
+        run("ip", "netns", "add", namespace)
+    run("ip", "link", "add", "c0", "netns", CLIENT_NS, "address", CLIENT_MAC,
+        "type", "veth", "peer", "name", "h0", "netns", HEAD_NS, "address", HEAD_MAC)
+    run("ip", "addr", "add", f"{CLIENT_IP}/24", "dev", "c0", namespace=CLIENT_NS)
+    run("ip", "link", "set", "c0", "up", namespace=CLIENT_NS)
+
+    run("ip", "addr", "add", f"{HEAD_IP}/24", "dev", "h0", namespace=HEAD_NS)
+    run("ip", "link", "set", "h0", "up", namespace=HEAD_NS)
+    run("ip", "link", "add", "up0", "netns", HEAD_NS, "type", "veth", "peer", "name", "u0", "netns", UPLINK_NS, "address", UPLINK_MAC)
+    run("ip", "addr", "add", f"{UPLINK_IP}/24", "dev", "up0", namespace=HEAD_NS)
+    run("ip", "link", "set", "up0", "up", namespace=HEAD_NS)
+    # A permanent neighbour avoids resolving the gateway while forwarding
+    run("ip", "neigh", "add", GATEWAY_IP, "lladdr", UPLINK_MAC, "dev", "up0", "nud", "permanent", namespace=HEAD_NS)
+    run("ip", "route", "add", "default", "via", GATEWAY_IP, namespace=HEAD_NS)
+    run("sysctl", "-qw", "net.ipv4.ip_forward=1", namespace=HEAD_NS)
+
+    # The uplink does not forward, so it drops the packets sent to TARGET_IP
+    run("ip", "addr", "add", f"{GATEWAY_IP}/24", "dev", "u0", namespace=UPLINK_NS)
+    run("ip", "link", "set", "u0", "up", namespace=UPLINK_NS)
+
+def teardown() -> None:
+    for namespace in (CLIENT_NS, HEAD_NS, UPLINK_NS):
+        subprocess.run(("ip", "netns", "del", namespace), stderr=subprocess.DEVNULL)
+
+def load_ruleset(ingress: bool | None, authenticated: bool) -> None:
+    """
+    Replaces the ruleset of the head by the netcontrol one, with or without the ingress chain,
+    or leaves the head without any ruleset if ingress is None
+    """
+    if ingress is None:
+        return
+    document = portail_ruleset([HEAD_IP, UPLINK_IP], None, "10.0.0.0/24", False, False, "h0" if ingress else None)
+    if authenticated:
+        elements = [{"add": {"element": {"family": "ip", "table": "insalan", "name": "netcontrol-auth", "elem": [CLIENT_MAC]}}},
+                    {"add": {"element": {"family": "ip", "table": "insalan", "name": "netcontrol-mac2mark", "elem": [[CLIENT_MAC, 100]]}}}]
+        if ingress:
+            elements.append({"add": {"element": {"family": "netdev", "table": "insalan", "name": "netcontrol-auth", "elem": [CLIENT_MAC]}}})
+        document["nftables"].extend(elements)
+
+    run("nft", "flush", "ruleset", namespace=HEAD_NS)
+    with tempfile.NamedTemporaryFile("w", suffix=".json") as file:
+        json.dump(document, file)
+        file.flush()
+        run("nft", "-j", "-f", file.name, namespace=HEAD_NS)
+
+def checksum(header: bytes) -> int:
+    total = sum(struct.unpack(f"!{len(header) // 2}H", header))
+    total = (total & 0xFFFF) + (total >> 16)
+    total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+def frame() -> bytes:
+    """
+    Builds an Ethernet frame carrying an empty UDP datagram from the client to TARGET_IP
+    """
+    ether = bytes.fromhex(HEAD_MAC.replace(":", "")) + bytes.fromhex(CLIENT_MAC.replace(":", "")) + b"\x08\x00"
+    udp = struct.pack("!HHHH", 40000, 9, 8, 0)
+    ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(udp), 0, 0, 64, socket.IPPROTO_UDP, 0,
+                     socket.inet_aton(CLIENT_IP), socket.inet_aton(TARGET_IP))
+    ip = ip[:10] + struct.pack("!H", checksum(ip)) + ip[12:]
+    return ether + ip + udp
+
+def send(duration: float) -> None:
+    """
+    Floods the head from the client namespace for duration seconds, and prints the number of packets sent
+    """
+    packet = frame()
+    sent = 0
+    with socket.socket(socket.AF_PACKET, socket.SOCK_RAW) as sock:
+        sock.bind(("c0", 0))
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            # Checking the clock on every packet would be measured too
+            for _ in range(1000):
+                sock.send(packet)
+            sent += 1000
+    print(sent)
+
+def rx_packets() -> int:
+    return int(run("cat", "/sys/class/net/h0/statistics/rx_packets", namespace=HEAD_NS, capture=True))
+
+def measure(duration: float) -> tuple[float, float]:
+    """
+    Floods the head and returns the packets per second sent by the client and received by the head
+    """
+    received = rx_packets()
+    start = time.perf_counter()
+    output = run("taskset", "-c", "0", sys.executable, os.path.abspath(__file__), "--send", "--duration", str(duration),
+                 namespace=CLIENT_NS, capture=True)
+    elapsed = time.perf_counter() - start
+    return int(output) / elapsed, (rx_packets() - received) / elapsed
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=10, help="seconds of each measure")
+    parser.add_argument("--authenticated", action="store_true", help="authenticate the client, to measure the cost of the ingress chain on allowed traffic")
+    parser.add_argument("--baseline", action="store_true", help="only measure the head without any ruleset, which does not need nft")
+    parser.add_argument("--send", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.send:
+        send(args.duration)
+        return
+
+    teardown()
+    try:
+        setup()
+        layouts = [("none", None)]
+        if not args.baseline:
+            layouts.extend((("forward", False), ("ingress", True)))
+        for layout, ingress in layouts:
+            load_ruleset(ingress, args.authenticated)
+            sent, received = measure(args.duration)
+            print(f"{layout:>8} layout: {sent:>12,.0f} packets/s sent, {received:>12,.0f} packets/s received by the head")
+    finally:
+        teardown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+#!/bin/sh
+
+# Listen on a unix socket if asked to, otherwise run the given command (TCP on port 6784)
+if [ "$NETCONTROL_TRANSPORT" = "unix" ]; then
+    echo "=== STARTING NETCONTROL ON $NETCONTROL_SOCKET_FILE ==="
+    exec python serve.py
+fi
+
+echo "=== STARTING NETCONTROL ON PORT 6784 ==="
+exec "$@"
@@ -1,11 +1,20 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
 from contextlib import asynccontextmanager
+from typing import Literal, Optional
+from pydantic import BaseModel, Field
 import os
 import logging
-from .nft import Nft, MockedNft
-from .arp import Arp, MockedArp
+from .nft import NFT_SHAPING_REFRESH, Nft, MockedNft
+from .arp import Arp, NetlinkArp, MockedArp
+from .writer import NftWriter
+from .series import MarkSeries
+from .prober import Prober
+from .metrics import Counter, Gauge, MetricsMiddleware, render
 
 mock = os.getenv("MOCK_NETWORK", "0") == "1"
+# "procfs" reads /proc/net/arp, "netlink" queries the kernel neighbour table and probes missing entries
+arp_resolver = os.getenv("ARP_RESOLVER", "procfs")
 
 logger = logging.getLogger('uvicorn.error')
 # for some reason, default loggers are not working with FastAPI
@@ -16,11 +25,30 @@ if mock:
     arp = MockedArp(logger)
 else:
     nft = Nft(logger)
-    arp = Arp(logger)
+    if arp_resolver == "netlink":
+        arp = NetlinkArp(logger)
+    else:
+        arp = Arp(logger)
+
+def resolve_ip(mac: str) -> Optional[str]:
+    try:
+        return arp.get_ip(mac)["ip"]
+    except HTTPException:
+        return None
+
+# Used to end the offloaded connections of disconnected devices
+nft.resolve_ip = resolve_ip
 
 logger.info("Checking that nftables is working...")
 nft.check_nftables()
 
+# Every change to the ruleset goes through the writer, which owns the nft handle
+writer = NftWriter(nft, logger)
+# Traffic of each mark over time, sampled from the counters of the devices
+series = MarkSeries(nft, logger)
+# Latency and loss of the tunnel behind each mark
+prober = Prober(lambda: nft.state().values(), logger)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
@@ -30,28 +58,144 @@ async def lifespan(app: FastAPI):
     """
     
     nft.setup_portail()
+    writer.start()
+    if nft.shaping and NFT_SHAPING_REFRESH > 0:
+        # The traffic received by the capped devices is matched by IP address, which DHCP may give to another device
+        writer.every(NFT_SHAPING_REFRESH, nft.refresh_shaping)
+    series.start()
+    prober.start()
     
     yield
     
+    await prober.stop()
+    await series.stop()
+    await writer.stop()
     nft.remove_portail()
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+
+# Values read from their owner when /metrics is rendered, they cost nothing until then
+Counter(
+    "netcontrol_arp_lookups_total", "Number of ARP lookups, by cache result", ("result",),
+    function=lambda: {("hit",): arp.hits, ("miss",): arp.misses},
+)
+# The auth set, when there is one, always holds the keys of the map
+Gauge("netcontrol_auth_set_size", "Number of authenticated devices, the keys of the netcontrol-mac2mark map", function=lambda: len(nft.state()))
+Gauge("netcontrol_single_map", "Whether the map is the only source of truth, without the netcontrol-auth set", function=lambda: int(nft.single_map))
+Gauge(
+    "netcontrol_reject_policy", "Policy applied to the forwarded traffic of unauthenticated devices", ("policy",),
+    function=lambda: {(nft.reject_policy,): 1},
+)
+Gauge("netcontrol_shaping_classes", "Number of classes of the shaping policy", function=lambda: len(nft.shaping_classes))
+Gauge("netcontrol_game_priority", "Whether the traffic of the games is given priority", function=lambda: int(nft.games))
+Gauge(
+    "netcontrol_mark_rtt_seconds", "Moving average of the round-trip time of the probes of each mark", ("mark",),
+    function=lambda: {(mark,): stats.rtt for mark, stats in prober.stats.items() if stats.rtt is not None},
+)
+Gauge(
+    "netcontrol_mark_loss_ratio", "Moving average of the share of probes lost by each mark", ("mark",),
+    function=lambda: {(mark,): stats.loss for mark, stats in prober.stats.items()},
+)
+Gauge("netcontrol_queue_depth", "Number of operations waiting for the nftables writer", function=lambda: writer.pending)
+
+class BatchOperation(BaseModel):
+    """
+    One operation of a batch request
+    """
+    action: Literal["connect", "disconnect", "set_mark", "upsert", "refresh"]
+    mac: str
+    mark: Optional[int] = None
+    # Seconds after which the kernel disconnects the device, unless refreshed
+    timeout: Optional[int] = None
+    name: str = "batch"
 
 @app.get("/")
 def root():
     return "netcontrol is running"
  
 @app.post("/connect_user")
-def connect_user(mac: str, mark: int, name: str):
-    return nft.connect_user(mac, mark, name)
+async def connect_user(mac: str, mark: int, name: str, timeout: Optional[int] = None):
+    return await writer.submit_one({"action": "connect", "mac": mac, "mark": mark, "name": name, "timeout": timeout})
 
 @app.delete("/disconnect_user")
-def delete_user(mac: str):
-    return nft.delete_user(mac)
+async def delete_user(mac: str):
+    return await writer.submit_one({"action": "disconnect", "mac": mac})
 
 @app.put("/set_mark")
-def set_mark(mac: str, mark: int):
-    return nft.set_mark(mac, mark)
+async def set_mark(mac: str, mark: int):
+    return await writer.submit_one({"action": "set_mark", "mac": mac, "mark": mark})
+
+@app.post("/batch")
+async def batch(operations: list[BatchOperation]):
+    return await writer.submit([operation.model_dump() for operation in operations])
+
+@app.get("/state")
+def get_state():
+    return nft.state()
+
+@app.put("/state")
+async def put_state(desired: dict[str, int]):
+    operations = nft.diff_state(desired)
+    results = await writer.submit(operations) if operations else []
+    return {
+        "applied": sum(result["status"] == 200 for result in results),
+        "failed": [result for result in results if result["status"] != 200],
+    }
+
+@app.get("/counters")
+def counters():
+    return nft.read_counters()
+
+@app.get("/counters/top")
+def top_counters(n: int = 10, by: Literal["bytes", "packets"] = "bytes"):
+    devices = nft.read_counters()
+    return sorted(devices, key=lambda device: device[f"tx_{by}"] + device[f"rx_{by}"], reverse=True)[:n]
+
+@app.get("/marks/series")
+async def marks_series(minutes: int = 60):
+    # Run in the event loop, where the series are written, so that they are never read halfway through
+    return series.series(minutes)
+
+@app.get("/marks/latency")
+async def marks_latency():
+    return prober.summary()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
+
+class ShapingRule(BaseModel):
+    """
+    Caps of the traffic of a device, in each direction
+    """
+    mac: str
+    # Per second, None when not capped
+    bytes: Optional[int] = Field(default=None, gt=0)
+    packets: Optional[int] = Field(default=None, gt=0)
+
+@app.put("/shaping")
+async def put_shaping(devices: list[ShapingRule]):
+    return await writer.call(nft.set_shaping, [device.model_dump() for device in devices])
+
+@app.patch("/shaping")
+async def patch_shaping(devices: list[ShapingRule]):
+    return await writer.call(nft.patch_shaping, [device.model_dump() for device in devices])
+
+class GamePorts(BaseModel):
+    """
+    Ports ("27015") and ranges of ports ("27015-27030") of the games, by protocol
+    """
+    tcp: list[str] = []
+    udp: list[str] = []
+
+@app.put("/games")
+async def put_games(ports: GamePorts):
+    return await writer.call(nft.set_game_ports, ports.model_dump())
+
+@app.get("/queue")
+def queue():
+    return writer.depth()
 
 @app.get("/get_mac")
 def get_mac(ip: str):
@@ -59,4 +203,8 @@ def get_mac(ip: str):
 
 @app.get("/get_ip")
 def get_ip(mac: str):
-    return arp.get_ip(mac)
\ No newline at end of file
+    return arp.get_ip(mac)
+
+@app.get("/arp_stats")
+def arp_stats():
+    return arp.stats()
\ No newline at end of file
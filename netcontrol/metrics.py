@@ -0,0 +1,146 @@
+"""
+Minimal Prometheus-style metrics, exposed in the text format at /metrics.
+Recording a value is a dict lookup and an addition; everything else is done when rendering.
+"""
+from bisect import bisect_left
+from time import perf_counter
+from typing import Callable
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+def escape(value: str, quote: bool = True) -> str:
+    """
+    Escapes the backslashes and line feeds of a help text or label value, and the double quotes of a label value
+    """
+    value = value.replace("\\", "\\\\").replace("\n", "\\n")
+    return value.replace('"', '\\"') if quote else value
+
+class Metric:
+    """
+    Base class of the metrics: a name, a help text, and label names
+    """
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), function: Callable | None = None) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        # If given, called at rendering time to get the values instead of recording them
+        self.function = function
+        self.values: dict[tuple, float] = {}
+        REGISTRY.append(self)
+
+    def _label_string(self, values: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{escape(str(value))}"' for name, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> list[str]:
+        values = self.values
+        if self.function is not None:
+            result = self.function()
+            values = result if isinstance(result, dict) else {(): result}
+        return [f"{self.name}{self._label_string(labels)} {value}" for labels, value in values.items()]
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {escape(self.help, quote=False)}", f"# TYPE {self.name} {self.kind}", *self.samples()])
+
+class Counter(Metric):
+    """
+    Value which only goes up
+    """
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    """
+    Value which can go up and down
+    """
+    kind = "gauge"
+
+    def set(self, value: float, *labels) -> None:
+        self.values[labels] = value
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, counted in buckets
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # Labels -> [count of each bucket (the last one being +Inf), sum]
+        self.series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self) -> list[str]:
+        lines = []
+        for labels, series in self.series.items():
+            cumulated = 0
+            for bound, count in zip((*self.buckets, "+Inf"), series):
+                cumulated += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{self._label_string(labels, le)} {cumulated}")
+            lines.append(f"{self.name}_sum{self._label_string(labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{self._label_string(labels)} {cumulated}")
+        return lines
+
+REGISTRY: list[Metric] = []
+
+def render() -> str:
+    """
+    Renders every metric in the Prometheus text format
+    """
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+NFT_COMMAND_DURATION = Histogram(
+    "netcontrol_nft_command_duration_seconds", "Duration of the nftables commands", ("command",)
+)
+REQUEST_DURATION = Histogram(
+    "netcontrol_request_duration_seconds", "Duration of the API requests", ("endpoint",)
+)
+REQUESTS = Counter("netcontrol_requests_total", "Number of API requests", ("endpoint",))
+REQUEST_ERRORS = Counter("netcontrol_request_errors_total", "Number of API requests answered with an error", ("endpoint",))
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting and timing the requests of each endpoint
+    """
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = perf_counter()
+        status = 500
+
+        async def send_with_status(message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The route is set by the router once matched, its path keeps the label count bounded
+            route = scope.get("route")
+            endpoint = route.path if route is not None else "unmatched"
+            REQUEST_DURATION.observe(perf_counter() - start, endpoint)
+            REQUESTS.inc(endpoint)
+            if status >= 400:
+                REQUEST_ERRORS.inc(endpoint)
@@ -0,0 +1,270 @@
+import errno
+import socket
+import struct
+from typing import Iterator, NamedTuple
+
+# Netlink message header: length, type, flags, sequence number, port id
+NLMSG_HEADER = struct.Struct("=LHHLL")
+# Route attribute header: length, type
+RTA_HEADER = struct.Struct("=HH")
+# Neighbour message: family, (padding), interface index, state, flags, type
+NDMSG = struct.Struct("=BxxxiHBB")
+# Address message: family, prefix length, flags, scope, interface index
+IFADDRMSG = struct.Struct("=BBBBI")
+# Netfilter message: family, version, resource id (big endian)
+NFGENMSG = struct.Struct("=BBH")
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+# Flags of the attribute type, which are not part of the type itself
+NLA_F_NESTED = 0x8000
+NLA_TYPE_MASK = 0x3FFF
+
+RTM_NEWADDR = 20
+RTM_GETADDR = 22
+RTM_NEWNEIGH = 28
+RTM_GETNEIGH = 30
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_LABEL = 3
+
+NDA_DST = 1
+NDA_LLADDR = 2
+
+NETLINK_NETFILTER = 12
+NFNETLINK_V0 = 0
+# Conntrack messages are IPCTNL_MSG_CT_* of the NFNL_SUBSYS_CTNETLINK subsystem
+IPCTNL_MSG_CT_GET = (1 << 8) | 1
+IPCTNL_MSG_CT_DELETE = (1 << 8) | 2
+
+CTA_TUPLE_ORIG = 1
+CTA_TUPLE_IP = 1
+CTA_IP_V4_SRC = 1
+# Number of conntrack deletions sent before reading their acknowledgements
+CONNTRACK_DELETE_WINDOW = 64
+
+# Neighbour states (NUD_*)
+NUD_STATES = {
+    0x01: "INCOMPLETE",
+    0x02: "REACHABLE",
+    0x04: "STALE",
+    0x08: "DELAY",
+    0x10: "PROBE",
+    0x20: "FAILED",
+    0x40: "NOARP",
+    0x80: "PERMANENT",
+}
+
+class NetlinkException(Exception):
+    pass
+
+class Neighbour(NamedTuple):
+    """
+    An entry of the kernel neighbour table
+    """
+    ip: str
+    mac: str
+    state: str
+    ifindex: int
+
+class Address(NamedTuple):
+    """
+    An address assigned to an interface
+    """
+    ifname: str
+    ip: str
+    prefixlen: int
+
+def _align(length: int) -> int:
+    return (length + 3) & ~3
+
+def parse_attributes(data: bytes, offset: int = 0) -> dict[int, bytes]:
+    """
+    Parses a list of netlink route attributes
+
+    Args:
+        data (bytes): buffer containing the attributes
+        offset (int): position of the first attribute in the buffer
+
+    Returns:
+        dict[int, bytes]: attribute type -> payload
+    """
+    attributes = {}
+    while offset + RTA_HEADER.size <= len(data):
+        length, kind = RTA_HEADER.unpack_from(data, offset)
+        if length < RTA_HEADER.size:
+            break
+        attributes[kind & NLA_TYPE_MASK] = data[offset + RTA_HEADER.size:offset + length]
+        offset += _align(length)
+    return attributes
+
+def dump(protocol: int, msg_type: int, payload: bytes) -> Iterator[tuple[int, bytes]]:
+    """
+    Sends a netlink dump request and yields the messages of the answer
+
+    Args:
+        protocol (int): netlink protocol (socket.NETLINK_ROUTE, ...)
+        msg_type (int): type of the request
+        payload (bytes): body of the request
+
+    Raises:
+        NetlinkException: if the kernel answered with an error
+
+    Yields:
+        tuple[int, bytes]: type and body of each message
+    """
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, protocol) as sock:
+        sock.bind((0, 0))
+        header = NLMSG_HEADER.pack(NLMSG_HEADER.size + len(payload), msg_type, NLM_F_REQUEST | NLM_F_DUMP, 1, 0)
+        sock.send(header + payload)
+
+        while True:
+            data = sock.recv(65536)
+            offset = 0
+            while offset + NLMSG_HEADER.size <= len(data):
+                length, kind, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+                body = data[offset + NLMSG_HEADER.size:offset + length]
+                offset += _align(length)
+
+                if kind == NLMSG_DONE:
+                    return
+                if kind == NLMSG_ERROR:
+                    error = struct.unpack_from("=i", body)[0]
+                    if error != 0:
+                        raise NetlinkException(-error, f"netlink request {msg_type} failed with error {-error}")
+                    continue
+                yield kind, body
+
+def dump_neighbours(family: int = socket.AF_INET) -> list[Neighbour]:
+    """
+    Reads the kernel neighbour table (the ARP table for IPv4)
+
+    Args:
+        family (int): address family of the entries
+
+    Returns:
+        list[Neighbour]: the entries of the table which have a link-layer address
+    """
+    neighbours = []
+    for kind, body in dump(socket.NETLINK_ROUTE, RTM_GETNEIGH, NDMSG.pack(family, 0, 0, 0, 0)):
+        if kind != RTM_NEWNEIGH:
+            continue
+        ndm_family, ifindex, state, _, _ = NDMSG.unpack_from(body)
+        if ndm_family != family:
+            continue
+        attributes = parse_attributes(body, NDMSG.size)
+        if NDA_DST not in attributes or NDA_LLADDR not in attributes:
+            continue
+        neighbours.append(Neighbour(
+            ip=socket.inet_ntop(family, attributes[NDA_DST]),
+            mac=attributes[NDA_LLADDR].hex(":"),
+            state=NUD_STATES.get(state, hex(state)),
+            ifindex=ifindex,
+        ))
+    return neighbours
+
+def dump_addresses(family: int = socket.AF_INET) -> list[Address]:
+    """
+    Reads the addresses assigned to the interfaces of the host
+
+    Args:
+        family (int): address family of the addresses
+
+    Returns:
+        list[Address]: the addresses, with the name of their interface
+    """
+    addresses = []
+    for kind, body in dump(socket.NETLINK_ROUTE, RTM_GETADDR, IFADDRMSG.pack(family, 0, 0, 0, 0)):
+        if kind != RTM_NEWADDR:
+            continue
+        ifa_family, prefixlen, _, _, _ = IFADDRMSG.unpack_from(body)
+        if ifa_family != family:
+            continue
+        attributes = parse_attributes(body, IFADDRMSG.size)
+        # IFA_LOCAL is the address of the interface, IFA_ADDRESS the peer's on point-to-point links
+        address = attributes.get(IFA_LOCAL, attributes.get(IFA_ADDRESS))
+        if address is None:
+            continue
+        addresses.append(Address(
+            ifname=attributes.get(IFA_LABEL, b"").rstrip(b"\0").decode(),
+            ip=socket.inet_ntop(family, address),
+            prefixlen=prefixlen,
+        ))
+    return addresses
+
+def flush_conntrack(sources: set[str], family: int = socket.AF_INET) -> int:
+    """
+    Deletes the conntrack entries of the connections opened by the given addresses,
+    which also removes them from the flowtables
+
+    Args:
+        sources (set[str]): source addresses of the connections
+        family (int): address family of the addresses
+
+    Raises:
+        NetlinkException: if the kernel refused to delete an entry
+
+    Returns:
+        int: number of entries deleted
+    """
+    # Entries can only be deleted by their tuple, which the dump gives as is
+    tuples = []
+    for _, body in dump(NETLINK_NETFILTER, IPCTNL_MSG_CT_GET, NFGENMSG.pack(family, NFNETLINK_V0, 0)):
+        tuple_orig = parse_attributes(body, NFGENMSG.size).get(CTA_TUPLE_ORIG)
+        if tuple_orig is None:
+            continue
+        source = parse_attributes(parse_attributes(tuple_orig).get(CTA_TUPLE_IP, b"")).get(CTA_IP_V4_SRC)
+        if source is not None and socket.inet_ntop(family, source) in sources:
+            tuples.append(tuple_orig)
+
+    if not tuples:
+        return 0
+
+    deleted = 0
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_NETFILTER) as sock:
+        sock.bind((0, 0))
+        # Acknowledgements are read after each window of requests, so that they never overflow the socket buffer
+        for start in range(0, len(tuples), CONNTRACK_DELETE_WINDOW):
+            window = tuples[start:start + CONNTRACK_DELETE_WINDOW]
+            for sequence, tuple_orig in enumerate(window, start=start + 1):
+                attribute = RTA_HEADER.pack(RTA_HEADER.size + len(tuple_orig), CTA_TUPLE_ORIG | NLA_F_NESTED) + tuple_orig
+                payload = NFGENMSG.pack(family, NFNETLINK_V0, 0) + attribute + b"\0" * (_align(len(attribute)) - len(attribute))
+                header = NLMSG_HEADER.pack(NLMSG_HEADER.size + len(payload), IPCTNL_MSG_CT_DELETE, NLM_F_REQUEST | NLM_F_ACK, sequence, 0)
+                sock.send(header + payload)
+            deleted += _read_acks(sock, len(window))
+    return deleted
+
+def _read_acks(sock: socket.socket, count: int) -> int:
+    """
+    Reads the acknowledgements of count requests
+
+    Raises:
+        NetlinkException: if the kernel refused a request, unless the entry was already gone
+
+    Returns:
+        int: number of requests which succeeded
+    """
+    succeeded = 0
+    # One acknowledgement per request, possibly several per read
+    acknowledged = 0
+    while acknowledged < count:
+        data = sock.recv(65536)
+        offset = 0
+        while offset + NLMSG_HEADER.size <= len(data):
+            length, kind, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+            body = data[offset + NLMSG_HEADER.size:offset + length]
+            offset += _align(length)
+            if kind != NLMSG_ERROR:
+                continue
+            acknowledged += 1
+            error = -struct.unpack_from("=i", body)[0]
+            if error == 0:
+                succeeded += 1
+            # ENOENT: the connection ended in the meantime
+            elif error != errno.ENOENT:
+                raise NetlinkException(error, f"conntrack deletion failed with error {error}")
+    return succeeded
@@ -1,12 +1,48 @@
 import nftables
 import json
 import logging
-import subprocess
+import os
+import queue
+import re
+import threading
+import time
+from typing import Callable
+from .metrics import NFT_COMMAND_DURATION
+from .netlink import NetlinkException, dump_addresses, flush_conntrack
+from .ruleset import (
+    COUNTERS_RX, COUNTERS_TX, GAMES_SETS, REJECT_METER, REJECT_POLICIES, SHAPING_PREFIX, SHAPING_RX, SHAPING_TX,
+    games_ruleset, port_ranges, portail_ruleset, remove_portail_ruleset, shaping_cleanup, shaping_elements, shaping_ruleset,
+    single_map_probe,
+)
 from .variables import Variables
 from fastapi import HTTPException
 
 variables = Variables()
 
+# "single" to use the map alone, "legacy" to keep the netcontrol-auth set, "auto" to use the map alone if nftables supports it
+NFT_MAP_MODE = os.getenv("NFT_MAP_MODE", "auto")
+# LAN interface on which the traffic of unauthenticated devices is dropped at ingress, empty to only filter it in forward
+NFT_INGRESS_INTERFACE = os.getenv("NFT_INGRESS_INTERFACE", "")
+# Comma-separated interfaces (LAN and uplink) of the flowtable offloading established connections, empty to disable it
+NFT_FLOWTABLE_INTERFACES = [name for name in os.getenv("NFT_FLOWTABLE_INTERFACES", "").split(",") if name]
+# Whether to count the traffic of each device
+NFT_COUNTERS = os.getenv("NFT_COUNTERS", "0") == "1"
+# Whether the traffic of the devices can be capped, as pushed by the backend on /shaping
+NFT_SHAPING = os.getenv("NFT_SHAPING", "0") == "1"
+# Seconds between two checks of the IP addresses of the capped devices, whose received traffic is matched by IP, 0 to disable
+NFT_SHAPING_REFRESH = float(os.getenv("NFT_SHAPING_REFRESH", "30"))
+# Whether the traffic of the games, whose ports are pushed by the backend on /games, is given priority
+NFT_GAME_PRIORITY = os.getenv("NFT_GAME_PRIORITY", "0") == "1"
+# Rate of the rate-limited reject policy, as "<packets>/<unit>"
+REJECT_RATE = re.compile(r"[1-9][0-9]*/(second|minute|hour|day)")
+# Seconds between two checks for devices removed by the kernel on timeout, whose offloaded connections must end
+NFT_FLUSH_INTERVAL = float(os.getenv("NFT_FLUSH_INTERVAL", "1"))
+
+# Actions accepted by apply_batch
+ACTIONS = ("connect", "disconnect", "set_mark", "upsert", "refresh")
+# Timeout of a change keeping the remaining time of the device, if any, as opposed to None which removes it
+KEEP_TIMEOUT = object()
+
 class Nft:
     """
     Class which interacts with the nftables backend
@@ -15,6 +51,40 @@ class Nft:
         self.logger = logger
         self.nft = nftables.Nftables()
         self.nft.set_json_output(True)
+        # The handle is used by the writer and by the endpoints reading counters, one at a time
+        self.lock = threading.Lock()
+        # Mirror of the netcontrol-mac2mark map, only updated once a transaction succeeded
+        self.mac2mark: dict[str, int] = {}
+        # Deadline (time.monotonic) of the devices connected with a timeout, the kernel removes them by itself
+        self.expires: dict[str, float] = {}
+        # Whether the map is the only source of truth, without the netcontrol-auth set
+        self.single_map = False
+        # LAN interface of the ingress chain, if any
+        self.ingress: str | None = None
+        # Interfaces of the flowtable, empty if there is none
+        self.flowtable: list[str] = []
+        # Gives the IP address of a MAC address (or None), to end the offloaded connections of a device
+        self.resolve_ip: Callable[[str], str | None] | None = None
+        # Devices whose offloaded connections must end, flushed by a thread so that the writer never waits for conntrack
+        self.flush_queue: queue.Queue = queue.Queue()
+        self.flusher: threading.Thread | None = None
+        # Deadlines of the expired devices whose connections were already ended, only used by the flusher
+        self.flushed_deadlines: dict[str, float] = {}
+        # What happens to the forwarded traffic of unauthenticated devices
+        self.reject_policy = "reject"
+        # Whether the traffic of each device is counted
+        self.counters = False
+        # Whether the traffic of the devices can be capped, and the generation and (bytes, packets) classes of the current policy
+        self.shaping = False
+        self.shaping_generation = 0
+        self.shaping_classes: list[tuple] = []
+        # (bytes, packets) caps of each capped device, and the IP address matched for the traffic it receives, if known
+        self.shaping_devices: dict[str, tuple] = {}
+        self.shaping_ips: dict[str, str] = {}
+        # Policies are built from the current generation, so they are replaced one at a time
+        self.shaping_lock = threading.Lock()
+        # Whether the traffic of the games is given priority
+        self.games = False
 
     def check_nftables(self) -> None:
         data = self._execute_nft_cmd("list ruleset")
@@ -35,7 +105,13 @@ class Nft:
             dict: parsed JSON output
         """
         output: str
-        rc, output, error = self.nft.cmd(cmd)
+        start = time.perf_counter()
+        with self.lock:
+            rc, output, error = self.nft.cmd(cmd)
+        # Label by the first two words ("add element", "list map"...), and command buffers by those of their
+        # lines ("add element+delete element"), so that the slow kinds of transactions can be told apart
+        label = "+".join(sorted({" ".join(line.split(" ", 2)[:2]) for line in cmd.split("\n")}))
+        NFT_COMMAND_DURATION.observe(time.perf_counter() - start, label)
         if rc != 0 or (error is not None and error != ""):
             raise NftablesException(rc, error)
         if output == "":
@@ -43,77 +119,166 @@ class Nft:
         else:
             return json.loads(output)["nftables"]
 
+    def _execute_nft_json(self, document: dict, label: str = "json") -> dict:
+        """
+        Executes an nft JSON document in a single transaction, handles the exception properly and returns an object
+
+        Args:
+            document (dict): JSON document, see libnftables-json(5)
+            label (str): what the document does ("setup", "shaping"...), to label its duration
+
+        Raises:
+            NftablesException: if the document returned an exception
+
+        Returns:
+            dict: parsed JSON output
+        """
+        start = time.perf_counter()
+        with self.lock:
+            rc, output, error = self.nft.json_cmd(document)
+        NFT_COMMAND_DURATION.observe(time.perf_counter() - start, f"json {label}")
+        if rc != 0 or (error is not None and error != ""):
+            raise NftablesException(rc, error)
+        if not output:
+            return {}
+        else:
+            return output["nftables"]
+
+    def _supports_single_map(self) -> bool:
+        """
+        Checks in dry-run mode whether nftables accepts the keys of a map in a match, as needed by the single map mode
+
+        Returns:
+            bool: whether the single map mode can be used
+        """
+        self.nft.set_dry_run(True)
+        try:
+            self._execute_nft_json(single_map_probe(), "probe")
+            return True
+        except NftablesException as e:
+            self.logger.info(f"nftables cannot match on the keys of a map, using the legacy layout ({e})")
+            return False
+        finally:
+            self.nft.set_dry_run(False)
+
     def setup_portail(self) -> None:
         """
-        Sets up the necessary nftables rules that block network access to unauthenticated devices, and marks packets based on the map
+        Sets up the necessary nftables rules that block network access to unauthenticated devices, and marks packets based on the map.
+        The whole layout is loaded at once, so a failure leaves the ruleset untouched.
         """
-        
-        # Set up table, set and map
-        self._execute_nft_cmd("add table ip insalan")
-        self._execute_nft_cmd("add set insalan netcontrol-auth { type ether_addr; }")
-        self._execute_nft_cmd("add map insalan netcontrol-mac2mark { type ether_addr : mark; }")
-        
-        # Marks packets from authenticated users using the map
-        self._execute_nft_cmd("add chain insalan netcontrol-filter { type filter hook prerouting priority 0; }")
-        self._execute_nft_cmd("add rule insalan netcontrol-filter ip daddr != 172.16.1.0/24 ether saddr @netcontrol-auth meta mark set ether saddr map @netcontrol-mac2mark")
-
-        # Block external requests to the netcontrol module
-        ips = subprocess.run('ip addr | grep -o "[0-9]*\\.[0-9]*\\.[0-9]*\\.[0-9]*/[0-9]*" | grep -o "[0-9]*\\.[0-9]*\\.[0-9]*\\.[0-9]*"', shell=True, capture_output=True).stdout.decode("utf-8").split("\n")[:-1]
-        docker0_ip = subprocess.run("ip addr show docker0 | awk '/inet / {print $2}' | cut -d'/' -f1", shell=True, capture_output=True).stdout.decode("utf-8").strip()
-        self._execute_nft_cmd(f"add rule insalan netcontrol-filter ip daddr {{ {docker0_ip},172.16.1.1 }} tcp dport 6784 ip saddr != {{ {','.join(ips)} }} drop")
-        
-        # Allow traffic to port 80 from unauthenticated devices and redirect it to the network head, to allow access to the langate webpage
-        self._execute_nft_cmd("add chain insalan netcontrol-nat { type nat hook prerouting priority 0; }")
-        self._execute_nft_cmd("add rule insalan netcontrol-nat ip daddr != 172.16.1.0/24 ether saddr != @netcontrol-auth tcp dport 80 redirect to :80")
-        
-        # Block other traffic from users that are not authenticated
-        self._execute_nft_cmd("add chain insalan netcontrol-forward { type filter hook forward priority 0; }")
-        docker_subnet = ".".join(docker0_ip.split(".")[:2]) + ".0.0/16"
-        self._execute_nft_cmd(f"add rule insalan netcontrol-forward ip daddr != {{ 172.16.1.1,{docker_subnet} }} ip saddr {variables.ip_range()} ip saddr != {{ 172.16.1.1,{docker_subnet} }} ether saddr != @netcontrol-auth reject")
+        start = time.perf_counter()
 
-        self.logger.info("Gate nftables set up")
+        # Addresses of the network head, allowed to reach netcontrol
+        host_addresses = dump_addresses()
+        ips = [addr.ip for addr in host_addresses]
+        docker0_ip = next((addr.ip for addr in host_addresses if addr.ifname == "docker0"), None)
+        if docker0_ip is None:
+            self.logger.warning("No address found on docker0, netcontrol will only be reachable through 172.16.1.1")
+        discovered = time.perf_counter()
+
+        if NFT_MAP_MODE == "auto":
+            self.single_map = self._supports_single_map()
+        else:
+            self.single_map = NFT_MAP_MODE == "single"
+
+        self.ingress = NFT_INGRESS_INTERFACE or None
+        self.flowtable = NFT_FLOWTABLE_INTERFACES
+        if self.flowtable and NFT_COUNTERS:
+            # Offloaded packets skip the meters, the counters (and what is measured from them) would miss most of the traffic
+            self.logger.warning("NFT_COUNTERS is set, the flowtable is disabled so that every packet is counted")
+            self.flowtable = []
+        self.reject_policy = variables.reject_policy()
+        if self.reject_policy not in REJECT_POLICIES:
+            self.logger.warning(f"Unknown reject_policy {self.reject_policy} in variables.json, rejecting unauthenticated traffic")
+            self.reject_policy = "reject"
+        reject_rate = variables.reject_rate()
+        if REJECT_RATE.fullmatch(reject_rate) is None:
+            self.logger.warning(f"Invalid reject_rate {reject_rate} in variables.json, using 10/second")
+            reject_rate = "10/second"
+
+        self.counters = NFT_COUNTERS
+        self.shaping = NFT_SHAPING
+        self.games = NFT_GAME_PRIORITY
+        tcp_api = os.getenv("NETCONTROL_TRANSPORT", "tcp") != "unix"
+        document = portail_ruleset(
+            ips, docker0_ip, variables.ip_range(), tcp_api, self.single_map, self.ingress, self.flowtable,
+            self.reject_policy, reject_rate, self.counters, self.shaping, self.games,
+        )
+        self._execute_nft_json(document, "setup")
+        # The classes are only known to the backend, which pushes them again
+        self._clear_leftovers()
+        loaded = time.perf_counter()
+
+        # The map may already hold devices if netcontrol was restarted without removing it
+        self._read_map()
+        if self.mac2mark and self.auth_sets():
+            # The sets may be missing devices of the map, if the previous run used another layout
+            now = time.monotonic()
+            elements = ", ".join(
+                f"{mac} timeout {max(1, int(self.expires[mac] - now))}s" if mac in self.expires else mac
+                for mac in self.mac2mark
+            )
+            self._execute_nft_cmd("\n".join(f"add element {name} {{ {elements} }}" for name in self.auth_sets()))
+        if self.flowtable and self.flusher is None:
+            self.flusher = threading.Thread(target=self._flush_loop, name="conntrack-flusher", daemon=True)
+            self.flusher.start()
+        end = time.perf_counter()
+
+        self.logger.info(
+            f"Gate nftables set up in {(end - start) * 1000:.1f} ms "
+            f"({'single map' if self.single_map else 'legacy'} layout, "
+            f"{f'ingress filtering on {self.ingress}' if self.ingress else 'no ingress filtering'}, "
+            f"{f'flowtable on {len(self.flowtable)} interfaces' if self.flowtable else 'no flowtable'}, "
+            f"{self.reject_policy} policy, "
+            f"{'shaping' if self.shaping else 'no shaping'}, "
+            f"{'game priority' if self.games else 'no game priority'}, "
+            f"address discovery: {(discovered - start) * 1000:.1f} ms, "
+            f"ruleset load of {len(document['nftables'])} commands: {(loaded - discovered) * 1000:.1f} ms, "
+            f"map read of {len(self.mac2mark)} devices: {(end - loaded) * 1000:.1f} ms)"
+        )
         
     def remove_portail(self) -> None:
         """
         Removes netcontrol-related chains, sets and maps from insalan table
         """
-        self._execute_nft_cmd("delete chain insalan netcontrol-filter")
-        self._execute_nft_cmd("delete chain insalan netcontrol-nat")
-        self._execute_nft_cmd("delete chain insalan netcontrol-forward")
-        self._execute_nft_cmd("delete set insalan netcontrol-auth")
-        self._execute_nft_cmd("delete map insalan netcontrol-mac2mark")
+        self._execute_nft_json(remove_portail_ruleset(
+            self.single_map, self.ingress is not None, bool(self.flowtable), self.reject_policy == "rate-limited", self.counters,
+            (self.shaping_generation, self.shaping_classes) if self.shaping else None, self.games,
+        ), "remove")
+        if self.flusher is not None:
+            self.flush_queue.put(None)
+            self.flusher.join()
+            self.flusher = None
+        self.mac2mark = {}
+        self.expires = {}
+        self.shaping_classes = []
+        self.shaping_devices = {}
+        self.shaping_ips = {}
         
         self.logger.info("Gate nftables removed")
 
     def set_mark(self, mac: str, mark: int) -> None:
         """
-        Changes mark of the given MAC address
+        Changes mark of the given MAC address, without disconnecting it.
+        Setting the mark the device already has does nothing.
         
         Args:
             mac (str): MAC address
             mark (int): mark to set
         """
         
-        self.delete_user(mac)
-        self.connect_user(mac, mark, "previously_connected_device")
+        self._apply_one({"action": "set_mark", "mac": mac, "mark": mark})
 
-    def connect_user(self, mac: str, mark: int, name: str) -> None:
+    def connect_user(self, mac: str, mark: int, name: str, timeout: int | None = None) -> None:
         """
         Connects given device with given mark
         
         Args:
             mac (str): MAC address
+            timeout (int | None): seconds after which the kernel disconnects the device, unless refreshed
         """
        
-        mac = mac.lower()
-        try:
-            self._execute_nft_cmd(f"add element insalan netcontrol-mac2mark {{ {mac} : {str(mark)} }}")
-            self._execute_nft_cmd(f"add element insalan netcontrol-auth {{ {mac} }}")
-        except NftablesException:
-            self.logger.error(f"Tried to add device {mac} (name: {name}), unexpected nftables error occurred")
-            raise HTTPException(status_code=500, detail="Unexpected nftables error occurred")
-        
-        self.logger.info(f"Device {mac} (name: {name}) connected with mark {mark}")
+        self._apply_one({"action": "connect", "mac": mac, "mark": mark, "name": name, "timeout": timeout})
 
     def delete_user(self, mac: str) -> None:
         """
@@ -123,15 +288,608 @@ class Nft:
             mac (str): MAC address
         """
         
-        mac = mac.lower()
+        self._apply_one({"action": "disconnect", "mac": mac})
+
+    def _apply_one(self, operation: dict) -> None:
+        """
+        Applies a single operation, raising its error if it failed
+
+        Args:
+            operation (dict): operation, as accepted by apply_batch
+
+        Raises:
+            HTTPException: if the operation failed, with its status and detail
+        """
+        result = self.apply_batch([operation])[0]
+        if result["status"] != 200:
+            raise HTTPException(status_code=result["status"], detail=result["detail"])
+
+    def _read_map(self) -> None:
+        """
+        Reads the current content of the netcontrol-mac2mark map into the mirror
+        """
+        data = self._execute_nft_cmd("list map insalan netcontrol-mac2mark")
+        now = time.monotonic()
+        mac2mark = {}
+        expires = {}
+        for entry in data:
+            if "map" not in entry:
+                continue
+            for key, mark in entry["map"].get("elem", []):
+                # Elements with a timeout are listed as {"elem": {"val": ..., "timeout": ..., "expires": ...}}
+                if isinstance(key, dict):
+                    elem = key["elem"]
+                    key = elem["val"]
+                    if "expires" in elem:
+                        expires[key.lower()] = now + elem["expires"]
+                mac2mark[key.lower()] = mark
+        self.mac2mark = mac2mark
+        self.expires = expires
+
+    def read_counters(self) -> list[dict]:
+        """
+        Reads the traffic counters of every device, both meters being listed in a single nft call
+
+        Raises:
+            HTTPException: if the counters are disabled
+
+        Returns:
+            list[dict]: one entry per device, with its "mac", "ip" (None if unknown), "tx_bytes",
+                "tx_packets", "rx_bytes" and "rx_packets"
+        """
+        if not self.counters:
+            raise HTTPException(status_code=404, detail="Counters are disabled (NFT_COUNTERS)")
+
+        data = self._execute_nft_cmd(f"list meter insalan {COUNTERS_TX}\nlist meter insalan {COUNTERS_RX}")
+        meters = {}
+        for entry in data:
+            meter = entry.get("meter", entry.get("set"))
+            if meter is None:
+                continue
+            meters[meter["name"]] = {
+                elem["elem"]["val"]: elem["elem"]["counter"]
+                for elem in meter.get("elem", [])
+                if isinstance(elem, dict) and "counter" in elem.get("elem", {})
+            }
+
+        received = meters.get(COUNTERS_RX, {})
+        devices = []
+        for mac, sent in meters.get(COUNTERS_TX, {}).items():
+            ip = self.resolve_ip(mac) if self.resolve_ip is not None else None
+            got = received.pop(ip, {"bytes": 0, "packets": 0}) if ip is not None else {"bytes": 0, "packets": 0}
+            devices.append({
+                "mac": mac, "ip": ip,
+                "tx_bytes": sent["bytes"], "tx_packets": sent["packets"],
+                "rx_bytes": got["bytes"], "rx_packets": got["packets"],
+            })
+        # Addresses whose MAC address is unknown, which only received traffic so far
+        for ip, got in received.items():
+            devices.append({
+                "mac": None, "ip": ip,
+                "tx_bytes": 0, "tx_packets": 0,
+                "rx_bytes": got["bytes"], "rx_packets": got["packets"],
+            })
+        return devices
+
+    def _clear_leftovers(self) -> None:
+        """
+        Removes the shaping classes left in the table by a previous run, the verdict maps if shaping is now disabled,
+        and the meters of the reject policy and of the counters if they are now disabled
+        """
+        data = self._execute_nft_cmd("list table insalan")
+        maps = False
+        chains = []
+        meters = []
+        # The rules using them were flushed with their chains, so they can be deleted
+        unused = {COUNTERS_TX, COUNTERS_RX} if not self.counters else set()
+        if self.reject_policy != "rate-limited":
+            unused.add(REJECT_METER)
+        stale = []
+        for entry in data:
+            if "map" in entry:
+                maps = maps or entry["map"]["name"] in (SHAPING_TX, SHAPING_RX)
+            elif "chain" in entry and entry["chain"]["name"].startswith(SHAPING_PREFIX):
+                chains.append(entry["chain"]["name"])
+            elif "set" in entry or "meter" in entry:
+                name = entry.get("set", entry.get("meter"))["name"]
+                if name.startswith(SHAPING_PREFIX):
+                    meters.append(name)
+                elif name in unused:
+                    stale.append(name)
+        if chains or meters or (maps and not self.shaping):
+            self._execute_nft_json(shaping_cleanup(chains, meters, self.shaping), "shaping cleanup")
+            self.logger.info(f"Removed {len(chains)} shaping chains left by a previous run")
+        if stale:
+            self._execute_nft_cmd("\n".join(f"delete set insalan {name}" for name in stale))
+            self.logger.info(f"Removed the meters {', '.join(stale)} left by a previous run")
+        self.shaping_generation = 0
+        self.shaping_classes = []
+        self.shaping_devices = {}
+        self.shaping_ips = {}
+
+    def set_shaping(self, devices: list[dict]) -> dict:
+        """
+        Replaces the caps of the devices in a single transaction. Devices with the same caps share a class,
+        whose chains drop the packets of each device over its rates: the traffic it sends is matched by its
+        MAC address, and the traffic it receives by its IP address, if known.
+
+        Args:
+            devices (list[dict]): "mac", and "bytes" and "packets" per second of each device, None when not capped
+
+        Raises:
+            HTTPException: if shaping is disabled, or the policy could not be loaded
+
+        Returns:
+            dict: the number of "classes" and "devices" of the policy, and the devices whose IP address is
+                unknown, whose received traffic is not capped ("unresolved")
+        """
+        if not self.shaping:
+            raise HTTPException(status_code=404, detail="Shaping is disabled (NFT_SHAPING)")
+
+        caps = {}
+        for device in devices:
+            limits = (device.get("bytes"), device.get("packets"))
+            if limits != (None, None):
+                caps[device["mac"].lower()] = limits
+        return self._load_shaping(caps)
+
+    def patch_shaping(self, devices: list[dict]) -> dict:
+        """
+        Changes the caps of some devices, leaving the others as they are. Devices are moved between the classes
+        of the current policy, and the policy is only loaded again if they need a new class.
+
+        Args:
+            devices (list[dict]): "mac", and "bytes" and "packets" per second of each device, None when not capped
+
+        Raises:
+            HTTPException: if shaping is disabled, or the changes could not be loaded
+
+        Returns:
+            dict: same as set_shaping
+        """
+        if not self.shaping:
+            raise HTTPException(status_code=404, detail="Shaping is disabled (NFT_SHAPING)")
+
+        changes = {}
+        for device in devices:
+            limits = (device.get("bytes"), device.get("packets"))
+            changes[device["mac"].lower()] = None if limits == (None, None) else limits
+
+        if any(limits is not None and limits not in self.shaping_classes for limits in changes.values()):
+            caps = dict(self.shaping_devices)
+            for mac, limits in changes.items():
+                if limits is None:
+                    caps.pop(mac, None)
+                else:
+                    caps[mac] = limits
+            return self._load_shaping(caps)
+        return self._update_shaping(changes)
+
+    def refresh_shaping(self) -> None:
+        """
+        Matches the traffic received by the capped devices with their current IP addresses, for those whose
+        address changed (or became known) since their caps were loaded
+        """
+        if not self.shaping_devices:
+            return
+        changes = {
+            mac: limits for mac, limits in self.shaping_devices.items()
+            if (self.resolve_ip(mac) if self.resolve_ip is not None else None) != self.shaping_ips.get(mac)
+        }
+        if changes:
+            self._update_shaping(changes)
+            self.logger.info(f"IP addresses of {len(changes)} capped devices updated")
+
+    def _load_shaping(self, caps: dict[str, tuple]) -> dict:
+        """
+        Loads a new shaping policy, replacing the previous one in a single transaction
+
+        Args:
+            caps (dict[str, tuple]): MAC address -> (bytes, packets) per second of each capped device
+        """
+        classes: dict[tuple, int] = {}
+        tx = {}
+        # IP address -> MAC address of the device it is matched for
+        owners = {}
+        unresolved = []
+        for mac, limits in caps.items():
+            tx[mac] = classes.setdefault(limits, len(classes))
+            ip = self.resolve_ip(mac) if self.resolve_ip is not None else None
+            if ip is None:
+                unresolved.append(mac)
+            else:
+                owners[ip] = mac
+        rx = {ip: tx[mac] for ip, mac in owners.items()}
+
+        with self.shaping_lock:
+            generation = self.shaping_generation + 1
+            previous = (self.shaping_generation, self.shaping_classes) if self.shaping_classes else None
+            try:
+                self._execute_nft_json(shaping_ruleset(generation, list(classes), tx, rx, previous), "shaping")
+            except NftablesException as e:
+                raise HTTPException(status_code=500, detail=f"Could not load the shaping policy: {e}")
+            self.shaping_generation = generation
+            self.shaping_classes = list(classes)
+            self.shaping_devices = caps
+            self.shaping_ips = {mac: ip for ip, mac in owners.items()}
+
+        self.logger.info(f"Shaping policy {generation} loaded: {len(tx)} devices in {len(classes)} classes")
+        return {"classes": len(classes), "devices": len(tx), "unresolved": unresolved}
+
+    def _update_shaping(self, changes: dict[str, tuple | None]) -> dict:
+        """
+        Moves devices between the classes of the current policy in a single transaction
+
+        Args:
+            changes (dict[str, tuple | None]): MAC address -> (bytes, packets) per second of the device,
+                which must be a class of the policy, or None to stop capping it
+        """
+        with self.shaping_lock:
+            classes = {limits: index for index, limits in enumerate(self.shaping_classes)}
+            caps = dict(self.shaping_devices)
+            ips = dict(self.shaping_ips)
+            owners = {ip: mac for mac, ip in ips.items()}
+            removed_tx, added_tx, removed_rx, added_rx = [], {}, [], {}
+            unresolved = []
+            for mac, limits in changes.items():
+                ip = (self.resolve_ip(mac) if self.resolve_ip is not None else None) if limits is not None else None
+                if caps.get(mac) == limits and ips.get(mac) == ip:
+                    continue
+                if mac in caps:
+                    removed_tx.append(mac)
+                if mac in ips:
+                    previous_ip = ips.pop(mac)
+                    del owners[previous_ip]
+                    removed_rx.append(previous_ip)
+                if limits is None:
+                    caps.pop(mac, None)
+                    continue
+                caps[mac] = limits
+                added_tx[mac] = classes[limits]
+                if ip is None:
+                    unresolved.append(mac)
+                    continue
+                if ip in owners:
+                    # The address was given to this device, the previous one no longer has it
+                    removed_rx.append(ip)
+                    del ips[owners[ip]]
+                added_rx[ip] = classes[limits]
+                ips[mac] = ip
+                owners[ip] = mac
+
+            if removed_tx or added_tx or removed_rx or added_rx:
+                document = shaping_elements(self.shaping_generation, self.shaping_classes, removed_tx, added_tx, removed_rx, added_rx)
+                try:
+                    self._execute_nft_json(document, "shaping update")
+                except NftablesException as e:
+                    raise HTTPException(status_code=500, detail=f"Could not update the shaping policy: {e}")
+            self.shaping_devices = caps
+            self.shaping_ips = ips
+
+        self.logger.info(f"Shaping policy {self.shaping_generation} updated: {len(added_tx)} devices added, {len(removed_tx)} removed")
+        return {"classes": len(self.shaping_classes), "devices": len(caps), "unresolved": unresolved}
+
+    def set_game_ports(self, ports: dict[str, list]) -> dict:
+        """
+        Replaces the ports of the games in a single transaction, their traffic being given priority on the tunnels
+
+        Args:
+            ports (dict[str, list]): ports ("27015") and ranges of ports ("27015-27030") of the games, by protocol ("tcp" and "udp")
+
+        Raises:
+            HTTPException: if game priority is disabled, a port is invalid, or the ports could not be loaded
+
+        Returns:
+            dict: the number of ranges of ports, by protocol
+        """
+        if not self.games:
+            raise HTTPException(status_code=404, detail="Game priority is disabled (NFT_GAME_PRIORITY)")
+
+        try:
+            ranges = {protocol: port_ranges(ports.get(protocol, [])) for protocol in GAMES_SETS}
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid port")
+        if any(not 0 < first <= last <= 65535 for protocol in ranges.values() for first, last in protocol):
+            raise HTTPException(status_code=400, detail="Invalid port")
+
+        try:
+            self._execute_nft_json(games_ruleset(ports), "games")
+        except NftablesException as e:
+            raise HTTPException(status_code=500, detail=f"Could not load the ports of the games: {e}")
+
+        self.logger.info("Game ports loaded: " + ", ".join(f"{len(value)} {protocol} ranges" for protocol, value in ranges.items()))
+        return {protocol: len(value) for protocol, value in ranges.items()}
+
+    def auth_sets(self) -> list[str]:
+        """
+        Returns the sets which must hold the authenticated devices, besides the keys of the map
+        """
+        sets = []
+        if not self.single_map:
+            sets.append("insalan netcontrol-auth")
+        if self.ingress is not None:
+            sets.append("netdev insalan netcontrol-auth")
+        return sets
+
+    def _current_mark(self, mac: str, now: float) -> int | None:
+        """
+        Returns the mark of a device according to the mirror, or None if it is not connected or expired
+        """
+        mark = self.mac2mark.get(mac)
+        if mark is not None and mac in self.expires and self.expires[mac] <= now:
+            # The deadline is taken after the kernel applied the timeout, so it has already removed the device
+            return None
+        return mark
+
+    def state(self) -> dict[str, int]:
+        """
+        Returns the mark of every connected device
+        """
+        now = time.monotonic()
+        # Copying the dicts is atomic, the writer may be updating the mirror in the meantime
+        mac2mark, expires = dict(self.mac2mark), dict(self.expires)
+        return {mac: mark for mac, mark in mac2mark.items() if expires.get(mac, now + 1) > now}
+
+    def _diff_commands(self, changes: dict[str, tuple | None], now: float) -> list[str]:
+        """
+        Computes the nft commands applying changes to the map
+
+        Args:
+            changes (dict[str, tuple | None]): MAC address -> (new mark, new timeout, None for no timeout or
+                KEEP_TIMEOUT to keep the current one), or None to remove it
+            now (float): time.monotonic() at which expiry is checked
+
+        Returns:
+            list[str]: commands to apply, in order
+        """
+        commands = []
+        auth_sets = self.auth_sets()
+        sets = ["insalan netcontrol-mac2mark", *auth_sets]
+        for mac, new in changes.items():
+            old = self._current_mark(mac, now)
+            if new is None:
+                if old is not None:
+                    commands.extend(f"delete element {name} {{ {mac} }}" for name in sets)
+                continue
+
+            mark, timeout = new
+            if old is not None and (timeout not in (None, KEEP_TIMEOUT) or (timeout is None and mac in self.expires)):
+                # The timeout of an existing element cannot be changed or removed, replace it in the same transaction
+                commands.extend(f"delete element {name} {{ {mac} }}" for name in sets)
+            elif old is not None:
+                if old != mark:
+                    # Only replace the value in the map: the device stays in the auth sets, and since
+                    # both commands are in the same transaction, packets see either mark but never none
+                    remaining = ""
+                    if mac in self.expires:
+                        remaining = f" timeout {max(1, int(self.expires[mac] - now))}s"
+                    commands.append(f"delete element insalan netcontrol-mac2mark {{ {mac} }}")
+                    commands.append(f"add element insalan netcontrol-mac2mark {{ {mac}{remaining} : {mark} }}")
+                continue
+
+            expiry = f" timeout {timeout}s" if timeout not in (None, KEEP_TIMEOUT) else ""
+            commands.append(f"add element insalan netcontrol-mac2mark {{ {mac}{expiry} : {mark} }}")
+            commands.extend(f"add element {name} {{ {mac}{expiry} }}" for name in auth_sets)
+        return commands
+
+    def apply_batch(self, operations: list[dict]) -> list[dict]:
+        """
+        Applies a list of connect/disconnect/set_mark/upsert/refresh operations in a single nftables transaction.
+        Operations are checked in order against the mirror of the map, so that each one gets its own
+        result, then only the net change of each MAC address is sent to nftables: for instance a
+        connect followed by a set_mark becomes a single insertion with the final mark.
+        If the transaction fails, the mirror is read again from the kernel and the batch is retried once.
+
+        Args:
+            operations (list[dict]): operations, each one with an "action" ("connect", "disconnect",
+                "set_mark", "upsert" or "refresh"), a "mac", and a "mark", a "timeout" (and optionally
+                a "name") when relevant
+
+        Raises:
+            HTTPException: if the nftables transaction failed, in which case nothing was applied
+
+        Returns:
+            list[dict]: one result per operation, with its MAC address, HTTP-like status and detail
+        """
         try:
-            self._execute_nft_cmd(f"delete element insalan netcontrol-mac2mark {{ {mac} }}")
-            self._execute_nft_cmd(f"delete element insalan netcontrol-auth {{ {mac} }}")
+            return self._apply_batch(operations)
         except NftablesException:
-            self.logger.error(f"Tried to delete device {mac} which was not previously connected")
-            raise HTTPException(status_code=404, detail="Device was not previously connected")
-        
-        self.logger.info(f"Device {mac} disconnected")
+            # The mirror may be out of date, for instance if the kernel removed an expired device
+            # a few milliseconds before the deadline we noted
+            self.logger.warning(f"Batch of {len(operations)} operations failed, reading the map again and retrying")
+
+        try:
+            self._read_map()
+            return self._apply_batch(operations)
+        except NftablesException:
+            self.logger.error(f"Batch of {len(operations)} operations failed, unexpected nftables error occurred")
+            raise HTTPException(status_code=500, detail="Unexpected nftables error occurred")
+
+    def _apply_batch(self, operations: list[dict]) -> list[dict]:
+        """
+        Applies a list of operations in a single nftables transaction, see apply_batch
+
+        Raises:
+            NftablesException: if the nftables transaction failed
+        """
+        now = time.monotonic()
+        # The kernel already removed the expired devices, forget them too
+        expired = [mac for mac, deadline in self.expires.items() if deadline <= now]
+        # Unless the flusher already saw them expire, their offloaded connections are still forwarded
+        unflushed = [mac for mac in expired if self.flushed_deadlines.get(mac) != self.expires[mac]]
+        if self.flowtable and unflushed:
+            self.flush_queue.put(unflushed)
+        for mac in expired:
+            del self.mac2mark[mac], self.expires[mac]
+
+        # Pending changes on top of the mirror: MAC address -> (mark, timeout), or None once removed
+        changes: dict[str, tuple | None] = {}
+        results = []
+        messages = []
+
+        for operation in operations:
+            action = operation["action"]
+            mac = operation["mac"].lower()
+            mark = operation.get("mark")
+            timeout = operation.get("timeout")
+            if mac in changes:
+                current = changes[mac][0] if changes[mac] is not None else None
+            else:
+                current = self._current_mark(mac, now)
+            result = {"action": action, "mac": mac, "status": 200, "detail": "OK"}
+            results.append(result)
+
+            if action not in ACTIONS:
+                result.update(status=400, detail="Unknown action")
+            elif action in ("connect", "set_mark", "upsert") and mark is None:
+                result.update(status=400, detail="Missing mark")
+            elif timeout is not None and timeout <= 0:
+                result.update(status=400, detail="Invalid timeout")
+            elif action == "refresh" and timeout is None:
+                result.update(status=400, detail="Missing timeout")
+            elif action == "upsert":
+                changes[mac] = (mark, timeout)
+                messages.append(f"Device {mac} (name: {operation.get('name')}) set with mark {mark}")
+            elif action == "connect":
+                if current is not None and current != mark:
+                    result.update(status=409, detail="Device already connected with another mark")
+                else:
+                    changes[mac] = (mark, timeout)
+                    messages.append(f"Device {mac} (name: {operation.get('name')}) connected with mark {mark}")
+            elif current is None:
+                result.update(status=404, detail="Device was not previously connected")
+            elif action == "disconnect":
+                changes[mac] = None
+                messages.append(f"Device {mac} disconnected")
+            elif action == "set_mark":
+                changes[mac] = (mark, changes[mac][1] if mac in changes else KEEP_TIMEOUT)
+                messages.append(f"Device {mac} moved to mark {mark}")
+            elif action == "refresh":
+                changes[mac] = (current, timeout)
+
+        commands = self._diff_commands(changes, now)
+        if commands:
+            # A multi-line command buffer is committed by nftables as one transaction
+            self._execute_nft_cmd("\n".join(commands))
+
+        # Deadlines are taken once the kernel applied the timeouts, so they are never earlier than its own
+        applied = time.monotonic()
+        # Devices disconnected or moved to another mark, whose offloaded connections must end
+        evicted = []
+        for mac, change in changes.items():
+            old = self._current_mark(mac, now)
+            if old is not None and (change is None or change[0] != old):
+                evicted.append(mac)
+            if change is None:
+                self.mac2mark.pop(mac, None)
+                self.expires.pop(mac, None)
+                continue
+            mark, timeout = change
+            if timeout is None:
+                self.expires.pop(mac, None)
+            elif timeout is not KEEP_TIMEOUT:
+                self.expires[mac] = applied + timeout
+            self.mac2mark[mac] = mark
+
+        for message in messages:
+            self.logger.info(message)
+        self.logger.info(f"Batch of {len(operations)} operations applied with {len(commands)} nftables commands")
+
+        if self.flowtable and evicted:
+            self.flush_queue.put(evicted)
+        return results
+
+    def _flush_loop(self) -> None:
+        """
+        Ends the connections of the devices queued by the writer, and of those the kernel removed on timeout,
+        until None is queued. Everything waiting is flushed at once, with a single dump of conntrack.
+        """
+        running = True
+        while running:
+            try:
+                waiting = [self.flush_queue.get(timeout=NFT_FLUSH_INTERVAL)]
+            except queue.Empty:
+                waiting = []
+            while True:
+                try:
+                    waiting.append(self.flush_queue.get_nowait())
+                except queue.Empty:
+                    break
+            running = None not in waiting
+            macs = {mac for macs in waiting if macs is not None for mac in macs}
+            macs.update(self._expired_devices())
+            if macs:
+                try:
+                    self._flush_connections(sorted(macs))
+                except Exception:
+                    # The thread must outlive a bad flush, or the next ones would never happen
+                    self.logger.exception(f"Could not end the connections of {len(macs)} devices")
+
+    def _expired_devices(self) -> list[str]:
+        """
+        Returns the devices which expired since the last call, the kernel removed them from the map
+        but not from the flowtable
+        """
+        now = time.monotonic()
+        # Copying the dict is atomic, the writer may be updating the mirror in the meantime
+        expires = dict(self.expires)
+        expired = {mac: deadline for mac, deadline in expires.items() if deadline <= now}
+        new = [mac for mac, deadline in expired.items() if self.flushed_deadlines.get(mac) != deadline]
+        self.flushed_deadlines = expired
+        return new
+
+    def _flush_connections(self, macs: list[str]) -> None:
+        """
+        Ends the connections of the given devices, so that they leave the flowtable: offloaded packets
+        skip the ruleset, so they would not see a disconnection or a new mark otherwise.
+        The connections which are still allowed go through the ruleset again with their next packet.
+
+        Args:
+            macs (list[str]): MAC addresses of the devices
+        """
+        ips = set()
+        for mac in macs:
+            ip = self.resolve_ip(mac) if self.resolve_ip is not None else None
+            if ip is None:
+                self.logger.warning(f"No IP address known for {mac}, its offloaded connections are kept until they end")
+            else:
+                ips.add(ip)
+        if not ips:
+            return
+
+        start = time.perf_counter()
+        try:
+            deleted = flush_conntrack(ips)
+        except (NetlinkException, OSError) as e:
+            self.logger.error(f"Could not end the connections of {len(ips)} devices: {e}")
+            return
+        self.logger.info(f"Ended {deleted} connections of {len(ips)} devices in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    def diff_state(self, desired: dict[str, int]) -> list[dict]:
+        """
+        Computes the operations turning the current map into the desired one
+
+        Args:
+            desired (dict[str, int]): MAC address -> mark of every device that should be connected
+
+        Returns:
+            list[dict]: upsert and disconnect operations, as accepted by apply_batch
+        """
+        current = self.state()
+        desired = {mac.lower(): mark for mac, mark in desired.items()}
+
+        operations = [
+            {"action": "disconnect", "mac": mac}
+            for mac in current
+            if mac not in desired
+        ]
+        # Devices of the desired state are connected without a timeout
+        operations.extend(
+            {"action": "upsert", "mac": mac, "mark": mark, "name": "state"}
+            for mac, mark in desired.items()
+            if current.get(mac) != mark or mac in self.expires
+        )
+        return operations
 
 class NftablesException(Exception):
     pass
@@ -142,12 +900,37 @@ class MockedNft(Nft):
     """
     def __init__(self, logger: logging.Logger) -> None:
         self.logger = logger
+        self.mac2mark = {}
+        self.expires = {}
+        self.single_map = False
+        self.ingress = None
+        self.flowtable = []
+        self.resolve_ip = None
+        self.flush_queue = queue.Queue()
+        self.flusher = None
+        self.flushed_deadlines = {}
+        self.reject_policy = "reject"
+        self.counters = False
+        # Policies and ports are accepted and forgotten
+        self.games = NFT_GAME_PRIORITY
+        self.shaping = NFT_SHAPING
+        self.shaping_generation = 0
+        self.shaping_classes = []
+        self.shaping_devices = {}
+        self.shaping_ips = {}
+        self.shaping_lock = threading.Lock()
     
     def check_nftables(self) -> None:
         self.logger.info("Mocked nftables OK")
     
     def _execute_nft_cmd(self, cmd: str) -> dict:
         return {}
+
+    def _execute_nft_json(self, document: dict, label: str = "json") -> dict:
+        return {}
     
     def setup_portail(self) -> None:
-        self.logger.info("Gate nftables set up")
\ No newline at end of file
+        self.logger.info("Gate nftables set up")
+
+    def _read_map(self) -> None:
+        pass
\ No newline at end of file
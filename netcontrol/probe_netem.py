@@ -0,0 +1,97 @@
+"""
+Checks the latency prober against tunnels of known quality, emulated with netem.
+
+Two network namespaces are created: a head, with one link per mark standing for the VPN tunnels, and
+the internet behind them. Each link delays (and drops) packets with netem, and an ip rule routes the
+packets of each mark through its link, as on the real head. The prober then probes a target of the
+internet with each mark, and its estimates are printed next to the emulated values.
+
+Must be run as root, with ip and tc available:
+    python probe_netem.py [--rounds 20]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+
+from prober import Prober
+
+HEAD_NS = "ncprobe-head"
+NET_NS = "ncprobe-net"
+TARGET = "198.51.100.1"
+TARGET_PORT = 443
+# mark -> (delay in ms, loss in %) of its tunnel
+TUNNELS = {101: (20, 0), 102: (80, 10)}
+
+def run(*command: str, namespace: str | None = None) -> None:
+    if namespace is not None:
+        command = ("ip", "netns", "exec", namespace, *command)
+    subprocess.run(command, check=True)
+
+def setup() -> None:
+    """
+    Creates the namespaces: head (t<mark>) <-> (n<mark>) internet, for each mark
+    """
+    run("ip", "netns", "add", HEAD_NS)
+    run("ip", "netns", "add", NET_NS)
+    run("ip", "addr", "add", f"{TARGET}/32", "dev", "lo", namespace=NET_NS)
+    run("ip", "link", "set", "lo", "up", namespace=NET_NS)
+    run("ip", "link", "set", "lo", "up", namespace=HEAD_NS)
+    for index, (mark, (delay, loss)) in enumerate(TUNNELS.items()):
+        head_ip, net_ip = f"10.{index}.0.1", f"10.{index}.0.2"
+        run("ip", "link", "add", f"t{mark}", "netns", HEAD_NS, "type", "veth", "peer", "name", f"n{mark}", "netns", NET_NS)
+        run("ip", "addr", "add", f"{head_ip}/30", "dev", f"t{mark}", namespace=HEAD_NS)
+        run("ip", "link", "set", f"t{mark}", "up", namespace=HEAD_NS)
+        run("ip", "addr", "add", f"{net_ip}/30", "dev", f"n{mark}", namespace=NET_NS)
+        run("ip", "link", "set", f"n{mark}", "up", namespace=NET_NS)
+        # The whole delay on the way out, the answers come back at once
+        run("tc", "qdisc", "add", "dev", f"t{mark}", "root", "netem", "delay", f"{delay}ms", "loss", f"{loss}%", namespace=HEAD_NS)
+        run("ip", "route", "add", "default", "via", net_ip, "table", str(mark), namespace=HEAD_NS)
+        run("ip", "rule", "add", "fwmark", str(mark), "lookup", str(mark), namespace=HEAD_NS)
+        run("ip", "route", "add", f"{head_ip}/32", "dev", f"n{mark}", namespace=NET_NS)
+
+def teardown() -> None:
+    for namespace in (HEAD_NS, NET_NS):
+        subprocess.run(("ip", "netns", "del", namespace), stderr=subprocess.DEVNULL)
+
+async def probe(rounds: int) -> dict:
+    """
+    Runs rounds of probes with every mark, and returns the estimates
+    """
+    prober = Prober(lambda: TUNNELS.keys(), logging.getLogger(__name__), [f"{TARGET}:{TARGET_PORT}"], [], timeout=1)
+    for _ in range(rounds):
+        await prober.round()
+    return prober.summary()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=20, help="rounds of probes")
+    parser.add_argument("--probe", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.probe:
+        print(json.dumps(asyncio.run(probe(args.rounds))))
+        return
+
+    teardown()
+    try:
+        setup()
+        output = subprocess.run(
+            ("ip", "netns", "exec", HEAD_NS, sys.executable, os.path.abspath(__file__), "--probe", "--rounds", str(args.rounds)),
+            check=True, text=True, capture_output=True,
+        ).stdout
+        for mark, summary in json.loads(output).items():
+            delay, loss = TUNNELS[int(mark)]
+            print(
+                f"mark {mark}: emulated {delay} ms, {loss}% loss; "
+                f"measured p50 {summary['rtt_p50'] or 0:.1f} ms, ewma {summary['rtt_ewma'] or 0:.1f} ms, "
+                f"{summary['loss_window'] * 100:.0f}% loss over {summary['sent']} probes"
+            )
+    finally:
+        teardown()
+
+if __name__ == "__main__":
+    main()
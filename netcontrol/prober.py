@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from collections import deque
+from typing import Callable, Iterable
+
+# Comma-separated "host:port" reached through the tunnel of each mark, empty to disable probing
+PROBE_TARGETS = [target for target in os.getenv("PROBE_TARGETS", "").split(",") if target]
+# Comma-separated marks to probe even if no device uses them, besides the marks of the connected devices
+PROBE_MARKS = [int(mark) for mark in os.getenv("PROBE_MARKS", "").split(",") if mark]
+# Seconds between two rounds of probes, and after which a probe is lost
+PROBE_INTERVAL = float(os.getenv("PROBE_INTERVAL") or "5")
+PROBE_TIMEOUT = float(os.getenv("PROBE_TIMEOUT") or "2")
+# Weight of the last probe in the moving averages, and number of probes kept for the percentiles
+EWMA_ALPHA = 0.2
+WINDOW = 120
+
+class MarkStats:
+    """
+    Latency and loss of the probes sent with a mark: moving averages, and the last probes for the percentiles
+    """
+    def __init__(self) -> None:
+        self.rtt: float | None = None
+        self.loss = 0.0
+        self.sent = 0
+        self.lost = 0
+        # Round-trip time of the last probes, None for the lost ones
+        self.window: deque[float | None] = deque(maxlen=WINDOW)
+
+    def add(self, rtt: float | None) -> None:
+        """
+        Adds the result of a probe
+
+        Args:
+            rtt (float | None): round-trip time in seconds, None if the probe was lost
+        """
+        self.sent += 1
+        self.window.append(rtt)
+        self.loss = EWMA_ALPHA * (rtt is None) + (1 - EWMA_ALPHA) * self.loss
+        if rtt is None:
+            self.lost += 1
+        else:
+            self.rtt = rtt if self.rtt is None else EWMA_ALPHA * rtt + (1 - EWMA_ALPHA) * self.rtt
+
+    def summary(self) -> dict:
+        """
+        Returns the estimates, the times being in milliseconds
+        """
+        rtts = sorted(rtt for rtt in self.window if rtt is not None)
+
+        def percentile(p: float) -> float | None:
+            # Nearest rank
+            return rtts[min(len(rtts) - 1, int(p / 100 * len(rtts)))] * 1000 if rtts else None
+
+        return {
+            "rtt_ewma": self.rtt * 1000 if self.rtt is not None else None,
+            "rtt_p50": percentile(50),
+            "rtt_p90": percentile(90),
+            "rtt_p99": percentile(99),
+            "loss_ewma": self.loss,
+            "loss_window": sum(rtt is None for rtt in self.window) / len(self.window) if self.window else 0.0,
+            "sent": self.sent,
+            "lost": self.lost,
+        }
+
+class Prober:
+    """
+    Measures the health of the tunnel behind each mark: TCP connections are opened to the targets from
+    sockets carrying the mark (SO_MARK), so they follow the same ip rule as the traffic of the devices.
+    The time to the SYN-ACK (or RST) is the round-trip time, and no answer within the timeout is a loss.
+    """
+    def __init__(self, marks_in_use: Callable[[], Iterable[int]], logger: logging.Logger, targets: list[str] = PROBE_TARGETS,
+                 marks: list[int] = PROBE_MARKS, interval: float = PROBE_INTERVAL, timeout: float = PROBE_TIMEOUT) -> None:
+        # Marks of the connected devices
+        self.marks_in_use = marks_in_use
+        self.logger = logger
+        self.targets = [(host, int(port)) for host, port in (target.rsplit(":", 1) for target in targets)]
+        self.marks = marks
+        self.interval = interval
+        self.timeout = timeout
+        self.stats: dict[int, MarkStats] = {}
+        self.task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        """
+        Starts the probing task, if there are targets
+        """
+        if not self.targets:
+            self.logger.info("No probe targets (PROBE_TARGETS), the latency of the marks will not be measured")
+            return
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops the probing task
+        """
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    async def probe(self, mark: int, host: str, port: int) -> float | None:
+        """
+        Opens a TCP connection to the target with the mark, and closes it as soon as it is answered
+
+        Returns:
+            float | None: round-trip time in seconds, None if the probe was lost
+        """
+        loop = asyncio.get_running_loop()
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_MARK, mark)
+            sock.setblocking(False)
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(loop.sock_connect(sock, (host, port)), self.timeout)
+            except ConnectionRefusedError:
+                # A reset is an answer from the target too
+                pass
+            except (OSError, asyncio.TimeoutError):
+                return None
+            return time.perf_counter() - start
+
+    async def round(self) -> None:
+        """
+        Probes every target with every mark, all at once
+        """
+        marks = sorted(set(self.marks) | set(self.marks_in_use()))
+        probes = [(mark, host, port) for mark in marks for host, port in self.targets]
+        results = await asyncio.gather(*(self.probe(*probe) for probe in probes))
+        for (mark, _, _), rtt in zip(probes, results):
+            self.stats.setdefault(mark, MarkStats()).add(rtt)
+
+    def summary(self) -> dict[int, dict]:
+        """
+        Returns the estimates of each mark
+        """
+        return {mark: stats.summary() for mark, stats in sorted(self.stats.items())}
+
+    async def _run(self) -> None:
+        """
+        Sends a round of probes every interval
+        """
+        while True:
+            try:
+                await self.round()
+            except Exception as e:
+                self.logger.warning(f"Could not probe the marks: {e}")
+            await asyncio.sleep(self.interval)
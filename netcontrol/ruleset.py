@@ -0,0 +1,536 @@
+"""
+Generation of the netcontrol ruleset as an nftables JSON document (see libnftables-json(5)),
+so that it can be loaded in a single transaction.
+"""
+import ipaddress
+
+FAMILY = "ip"
+TABLE = "insalan"
+# Local network of the network head
+LOCAL_NETWORK = "172.16.1.0/24"
+# Address of the network head on the local network
+HEAD_IP = "172.16.1.1"
+NETCONTROL_PORT = 6784
+
+# Table of the ingress chain, which must belong to the netdev family
+INGRESS_FAMILY = "netdev"
+INGRESS_CHAIN = "netcontrol-ingress"
+
+# Chain deciding what happens to the forwarded traffic of unauthenticated devices
+REJECT_CHAIN = "netcontrol-reject"
+REJECT_METER = "netcontrol-reject-rate"
+REJECT_POLICIES = ("drop", "reject", "rate-limited")
+# Meters counting the traffic sent by each device (by MAC address) and received by it (by IP address)
+COUNTERS_TX = "netcontrol-counters-tx"
+COUNTERS_RX = "netcontrol-counters-rx"
+# Verdict maps sending the traffic of capped devices to the chain of their class, by MAC address
+# for the traffic they send and by IP address for the traffic they receive
+SHAPING_TX = "netcontrol-shaping-tx"
+SHAPING_RX = "netcontrol-shaping-rx"
+# Prefix of the chains and meters of the shaping classes
+SHAPING_PREFIX = "netcontrol-shaping-"
+# Seconds after which the element of a device that sent no packet is removed from a meter, so that the
+# devices which left do not pile up in the meters for the whole event
+METER_TIMEOUT = 3600
+# Chain giving priority to the traffic of the games, and the sets of their ports by protocol
+GAMES_CHAIN = "netcontrol-games"
+GAMES_SETS = {"tcp": "netcontrol-games-tcp", "udp": "netcontrol-games-udp"}
+# DSCP of the game traffic (expedited forwarding), and priority of its packets, as a tc class
+GAMES_DSCP = "ef"
+GAMES_PRIORITY = "1:1"
+
+CHAINS = {
+    "netcontrol-filter": {"type": "filter", "hook": "prerouting", "prio": 0},
+    "netcontrol-nat": {"type": "nat", "hook": "prerouting", "prio": 0},
+    "netcontrol-forward": {"type": "filter", "hook": "forward", "prio": 0},
+}
+
+def address(value: str):
+    """
+    Converts an address, a prefix ("a.b.c.d/n") or a range ("a.b.c.d-e.f.g.h") to its JSON expression
+    """
+    if "/" in value:
+        addr, length = value.split("/")
+        return {"prefix": {"addr": addr, "len": int(length)}}
+    if "-" in value:
+        return {"range": value.split("-")}
+    return value
+
+def addresses(values: list[str]):
+    """
+    Converts a list of addresses to an anonymous set
+    """
+    return {"set": [address(value) for value in values]}
+
+def payload(protocol: str, field: str) -> dict:
+    return {"payload": {"protocol": protocol, "field": field}}
+
+def match(left, right, op: str = "==") -> dict:
+    return {"match": {"op": op, "left": left, "right": right}}
+
+def rule(chain: str, *expr) -> dict:
+    return {"add": {"rule": {"family": FAMILY, "table": TABLE, "chain": chain, "expr": list(expr)}}}
+
+def meter(name: str, key: dict, stmt: dict) -> dict:
+    """
+    Applies a statement per device, each packet restarting the timeout of the element of its device
+    """
+    return {"meter": {"name": name, "key": {"elem": {"val": key, "timeout": METER_TIMEOUT}}, "stmt": stmt}}
+
+ETHER_SADDR = payload("ether", "saddr")
+IP_SADDR = payload("ip", "saddr")
+IP_DADDR = payload("ip", "daddr")
+TCP_DPORT = payload("tcp", "dport")
+META_MARK = {"meta": {"key": "mark"}}
+META_PROTOCOL = {"meta": {"key": "protocol"}}
+META_PKTTYPE = {"meta": {"key": "pkttype"}}
+META_L4PROTO = {"meta": {"key": "l4proto"}}
+META_PRIORITY = {"meta": {"key": "priority"}}
+CT_STATE = {"ct": {"key": "state"}}
+FLOWTABLE = "netcontrol-ft"
+
+def single_map_probe() -> dict:
+    """
+    Builds a document using a map in a membership match, which older nftables versions reject.
+    It is meant to be checked in dry-run mode, nothing of it is kept.
+    """
+    return {"nftables": [
+        {"add": {"table": {"family": FAMILY, "name": TABLE}}},
+        {"add": {"map": {"family": FAMILY, "table": TABLE, "name": "netcontrol-probe", "type": "ether_addr", "map": "mark"}}},
+        {"add": {"chain": {"family": FAMILY, "table": TABLE, "name": "netcontrol-probe"}}},
+        rule("netcontrol-probe", match(ETHER_SADDR, "@netcontrol-probe"), {"accept": None}),
+    ]}
+
+def ingress_ruleset(interface: str, allowed: list[str], ip_range: str) -> list[dict]:
+    """
+    Builds the netdev table dropping the traffic of unauthenticated devices as soon as it enters the LAN
+    interface, before conntrack, routing and nat spend time on it. It has its own netcontrol-auth set,
+    since a chain can only use the sets of its table.
+
+    Args:
+        interface (str): LAN interface, on which the devices are
+        allowed (list[str]): destinations unauthenticated devices may reach (the network head, netcontrol, the backend)
+        ip_range (str): addresses of the devices of the local network
+
+    Returns:
+        list[dict]: the commands, to be added to a JSON document
+    """
+    table = {"family": INGRESS_FAMILY, "table": TABLE}
+    # Overlapping elements are refused in an anonymous set, the docker0 address is in the docker subnet
+    allowed = [str(network) for network in ipaddress.collapse_addresses(ipaddress.ip_network(value) for value in allowed)]
+    return [
+        {"add": {"table": {"family": INGRESS_FAMILY, "name": TABLE}}},
+        {"add": {"set": {**table, "name": "netcontrol-auth", "type": "ether_addr", "flags": ["timeout"]}}},
+        {"add": {"chain": {**table, "name": INGRESS_CHAIN, "type": "filter", "hook": "ingress", "dev": interface, "prio": 0}}},
+        {"flush": {"chain": {**table, "name": INGRESS_CHAIN}}},
+        # Requests to port 80 are redirected to the langate by the nat chain
+        {"add": {"rule": {**table, "chain": INGRESS_CHAIN, "expr": [
+            match(META_PROTOCOL, "ip"),
+            match(TCP_DPORT, 80),
+            {"accept": None},
+        ]}}},
+        # Same decision as the forward chain, but only unicast packets sent to the head are candidates,
+        # and traffic to any address of the head is kept since it is not forwarded
+        {"add": {"rule": {**table, "chain": INGRESS_CHAIN, "expr": [
+            match(META_PROTOCOL, "ip"),
+            match(META_PKTTYPE, "host"),
+            match(IP_SADDR, address(ip_range)),
+            match(IP_DADDR, addresses(allowed), "!="),
+            match(ETHER_SADDR, "@netcontrol-auth", "!="),
+            {"drop": None},
+        ]}}},
+    ]
+
+def portail_ruleset(
+    host_ips: list[str],
+    docker0_ip: str | None,
+    ip_range: str,
+    tcp_api: bool = True,
+    single_map: bool = False,
+    ingress: str | None = None,
+    flowtable: list[str] | None = None,
+    reject_policy: str = "reject",
+    reject_rate: str = "10/second",
+    counters: bool = False,
+    shaping: bool = False,
+    games: bool = False,
+) -> dict:
+    """
+    Builds the whole netcontrol layout: table, set, map, chains and rules.
+    Chains are flushed before their rules are added, so that loading the document again
+    replaces the rules instead of duplicating them, while the set and map keep their elements.
+
+    In single map mode, the map is the only source of truth: authenticated devices are the keys
+    of the map, and forwarded packets of authenticated devices are recognised by the mark set in
+    prerouting, so that each packet does a single lookup. The legacy layout keeps a separate
+    netcontrol-auth set for nftables versions which cannot match on the keys of a map.
+
+    Args:
+        host_ips (list[str]): addresses of the network head, allowed to reach netcontrol
+        docker0_ip (str | None): address of the docker0 interface, if any
+        ip_range (str): addresses of the devices of the local network
+        tcp_api (bool): whether netcontrol listens on TCP, and must be protected from the network
+        single_map (bool): whether to use the map alone instead of the map and the netcontrol-auth set
+        ingress (str | None): LAN interface on which to drop the traffic of unauthenticated devices at ingress, if any
+        flowtable (list[str] | None): interfaces (LAN and uplink) of the flowtable offloading the established
+            connections of authenticated devices, if any
+        reject_policy (str): "drop", "reject", or "rate-limited" to reject at most reject_rate packets per device and drop the others
+        reject_rate (str): rate of the rate-limited policy, as "<packets>/<second|minute|hour>"
+        counters (bool): whether to count the bytes and packets sent and received by each device
+        shaping (bool): whether to cap the traffic of the devices given by shaping_ruleset
+        games (bool): whether to give priority to the traffic of the ports given by games_ruleset
+
+    Returns:
+        dict: the JSON document, to be loaded with Nftables.json_cmd
+    """
+    # Authenticated devices are the keys of the map in single map mode, the elements of the set otherwise
+    auth = "@netcontrol-mac2mark" if single_map else "@netcontrol-auth"
+    auth_set = {"set": {"family": FAMILY, "table": TABLE, "name": "netcontrol-auth", "type": "ether_addr", "flags": ["timeout"]}}
+    commands = [
+        {"add": {"table": {"family": FAMILY, "name": TABLE}}},
+        # Elements may be given a timeout, after which the kernel removes them by itself
+        {"add": auth_set},
+        {"add": {"map": {"family": FAMILY, "table": TABLE, "name": "netcontrol-mac2mark", "type": "ether_addr", "map": "mark", "flags": ["timeout"]}}},
+    ]
+    if shaping:
+        for name, key in ((SHAPING_TX, "ether_addr"), (SHAPING_RX, "ipv4_addr")):
+            commands.append({"add": {"map": {"family": FAMILY, "table": TABLE, "name": name, "type": key, "map": "verdict"}}})
+    if games:
+        for name in GAMES_SETS.values():
+            commands.append({"add": {"set": {"family": FAMILY, "table": TABLE, "name": name, "type": "inet_service", "flags": ["interval"]}}})
+    if flowtable:
+        commands.append({"add": {"flowtable": {"family": FAMILY, "table": TABLE, "name": FLOWTABLE, "hook": "ingress", "prio": 0, "dev": flowtable}}})
+    for name, hook in CHAINS.items():
+        commands.append({"add": {"chain": {"family": FAMILY, "table": TABLE, "name": name, **hook}}})
+        commands.append({"flush": {"chain": {"family": FAMILY, "table": TABLE, "name": name}}})
+    commands.append({"add": {"chain": {"family": FAMILY, "table": TABLE, "name": REJECT_CHAIN}}})
+    commands.append({"flush": {"chain": {"family": FAMILY, "table": TABLE, "name": REJECT_CHAIN}}})
+    if games:
+        commands.append({"add": {"chain": {"family": FAMILY, "table": TABLE, "name": GAMES_CHAIN}}})
+        commands.append({"flush": {"chain": {"family": FAMILY, "table": TABLE, "name": GAMES_CHAIN}}})
+
+    # Marks packets from authenticated users using the map
+    mark = [match(IP_DADDR, address(LOCAL_NETWORK), "!=")]
+    if not single_map:
+        mark.append(match(ETHER_SADDR, "@netcontrol-auth"))
+    # In single map mode, a lookup that misses ends the rule, so unauthenticated devices are left unmarked
+    mark.append({"mangle": {"key": META_MARK, "value": {"map": {"key": ETHER_SADDR, "data": "@netcontrol-mac2mark"}}}})
+    commands.append(rule("netcontrol-filter", *mark))
+
+    # The head only sees the IP address of the destination of forwarded packets, not yet its MAC address
+    if counters:
+        commands.append(rule(
+            "netcontrol-filter",
+            match(IP_SADDR, address(ip_range)),
+            meter(COUNTERS_TX, ETHER_SADDR, {"counter": None}),
+        ))
+        commands.append(rule(
+            "netcontrol-forward",
+            match(IP_DADDR, address(ip_range)),
+            meter(COUNTERS_RX, IP_DADDR, {"counter": None}),
+        ))
+
+    # Block external requests to the netcontrol module (on a unix socket, its permissions do the job)
+    if tcp_api:
+        netcontrol_ips = [HEAD_IP] if docker0_ip is None else [docker0_ip, HEAD_IP]
+        commands.append(rule(
+            "netcontrol-filter",
+            match(IP_DADDR, addresses(netcontrol_ips)),
+            match(TCP_DPORT, NETCONTROL_PORT),
+            match(IP_SADDR, addresses(host_ips), "!="),
+            {"drop": None},
+        ))
+
+    # Allow traffic to port 80 from unauthenticated devices and redirect it to the network head, to allow access to the langate webpage
+    commands.append(rule(
+        "netcontrol-nat",
+        match(IP_DADDR, address(LOCAL_NETWORK), "!="),
+        match(ETHER_SADDR, auth, "!="),
+        match(TCP_DPORT, 80),
+        {"redirect": {"port": 80}},
+    ))
+
+    # Block other traffic from users that are not authenticated
+    allowed = [HEAD_IP]
+    if docker0_ip is not None:
+        allowed.append(".".join(docker0_ip.split(".")[:2]) + ".0.0/16")
+    forward = [
+        match(IP_DADDR, addresses(allowed), "!="),
+        match(IP_SADDR, address(ip_range)),
+        match(IP_SADDR, addresses(allowed), "!="),
+    ]
+    if single_map:
+        # Packets marked in prerouting come from authenticated devices, only the others need a lookup
+        forward.append(match(META_MARK, 0))
+    forward.append(match(ETHER_SADDR, auth, "!="))
+    commands.append(rule("netcontrol-forward", *forward, {"goto": {"target": REJECT_CHAIN}}))
+
+    # Each reject sends a reply, so a client retrying aggressively would make the head amplify its traffic
+    if reject_policy == "drop":
+        commands.append(rule(REJECT_CHAIN, {"drop": None}))
+    elif reject_policy == "rate-limited":
+        rate, per = reject_rate.split("/")
+        commands.append(rule(
+            REJECT_CHAIN,
+            meter(REJECT_METER, ETHER_SADDR, {"limit": {"rate": int(rate), "per": per}}),
+            {"reject": None},
+        ))
+        commands.append(rule(REJECT_CHAIN, {"drop": None}))
+    else:
+        commands.append(rule(REJECT_CHAIN, {"reject": None}))
+
+    # Packets of the games, both ways, are queued ahead of the others on the tunnel of their mark. They are
+    # accepted, so that they are neither capped nor offloaded, which would skip the rules setting their priority
+    if games:
+        commands.append(rule("netcontrol-forward", {"jump": {"target": GAMES_CHAIN}}))
+        for protocol, name in GAMES_SETS.items():
+            for field in ("dport", "sport"):
+                commands.append(rule(
+                    GAMES_CHAIN,
+                    match(META_L4PROTO, protocol),
+                    match(payload("th", field), f"@{name}"),
+                    {"mangle": {"key": payload("ip", "dscp"), "value": GAMES_DSCP}},
+                    {"mangle": {"key": META_PRIORITY, "value": GAMES_PRIORITY}},
+                    {"accept": None},
+                ))
+
+    # Class chains accept the packets they do not drop, so the connections of capped devices are never offloaded
+    if shaping:
+        commands.append(rule("netcontrol-forward", {"vmap": {"key": ETHER_SADDR, "data": f"@{SHAPING_TX}"}}))
+        commands.append(rule("netcontrol-forward", {"vmap": {"key": IP_DADDR, "data": f"@{SHAPING_RX}"}}))
+
+    # Established connections of authenticated devices skip the rules from now on. Packets are only
+    # marked if their device is authenticated, which saves a lookup. Replies come from the uplink,
+    # so the connection is offloaded by the next packet of the device.
+    if flowtable:
+        commands.append(rule(
+            "netcontrol-forward",
+            match(META_L4PROTO, {"set": ["tcp", "udp"]}),
+            match(CT_STATE, "established", "in"),
+            match(META_MARK, 0, "!="),
+            {"flow": {"op": "add", "flowtable": f"@{FLOWTABLE}"}},
+        ))
+
+    if not games:
+        # Adding then deleting the chain and sets removes those of a previous run, if any
+        games_objects = [{"chain": {"family": FAMILY, "table": TABLE, "name": GAMES_CHAIN}}]
+        games_objects.extend({"set": {"family": FAMILY, "table": TABLE, "name": name, "type": "inet_service", "flags": ["interval"]}} for name in GAMES_SETS.values())
+        commands.extend({"add": item} for item in games_objects)
+        commands.extend({"delete": item} for item in games_objects)
+
+    if single_map:
+        # Adding then deleting the set removes the one left by the legacy layout, if any
+        commands.append({"delete": auth_set})
+
+    if ingress is not None:
+        commands.extend(ingress_ruleset(ingress, [*host_ips, *allowed], ip_range))
+    else:
+        # Adding then deleting the table removes the ingress chain of a previous run, if any
+        ingress_table = {"table": {"family": INGRESS_FAMILY, "name": TABLE}}
+        commands.extend([{"add": ingress_table}, {"delete": ingress_table}])
+
+    return {"nftables": commands}
+
+def port_ranges(ports: list) -> list[tuple[int, int]]:
+    """
+    Merges ports ("27015", 27015 or "27015-27030") into sorted ranges which neither overlap nor touch,
+    since an interval set refuses overlapping elements
+
+    Args:
+        ports (list): ports and ranges of ports
+
+    Returns:
+        list[tuple[int, int]]: the first and last port of each range
+    """
+    ranges = []
+    for port in ports:
+        first, _, last = str(port).partition("-")
+        ranges.append((int(first), int(last or first)))
+    merged: list[tuple[int, int]] = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+def games_ruleset(ports: dict[str, list]) -> dict:
+    """
+    Builds the document replacing the ports of the games in a single transaction
+
+    Args:
+        ports (dict[str, list]): ports and ranges of ports of the games, by protocol ("tcp" and "udp")
+
+    Returns:
+        dict: the JSON document, to be loaded with Nftables.json_cmd
+    """
+    commands = []
+    for protocol, name in GAMES_SETS.items():
+        commands.append({"flush": {"set": {"family": FAMILY, "table": TABLE, "name": name}}})
+        ranges = port_ranges(ports.get(protocol, []))
+        if ranges:
+            commands.append({"add": {"element": {"family": FAMILY, "table": TABLE, "name": name, "elem": [
+                first if first == last else {"range": [first, last]} for first, last in ranges
+            ]}}})
+    return {"nftables": commands}
+
+def shaping_objects(generation: int, classes: list[tuple]) -> tuple[list[str], list[str]]:
+    """
+    Returns the names of the chains and meters of the shaping classes of a generation.
+    Each policy gets new names, so that it can be loaded while the previous one is deleted in the same transaction.
+
+    Args:
+        generation (int): number of the policy
+        classes (list[tuple]): (bytes, packets) per second of each class, None when not capped
+
+    Returns:
+        tuple[list[str], list[str]]: the chains, and the meters
+    """
+    chains = []
+    meters = []
+    for index, limits in enumerate(classes):
+        for direction in ("tx", "rx"):
+            chain = f"{SHAPING_PREFIX}{generation}-{index}-{direction}"
+            chains.append(chain)
+            meters.extend(f"{chain}-{unit}" for unit, limit in zip(("bytes", "packets"), limits) if limit is not None)
+    return chains, meters
+
+def shaping_ruleset(
+    generation: int, classes: list[tuple], tx: dict[str, int], rx: dict[str, int], previous: tuple[int, list[tuple]] | None = None,
+) -> dict:
+    """
+    Builds the document replacing the shaping policy in a single transaction: the chains of the new classes
+    are added, the verdict maps are filled again, and the chains and meters of the previous policy are deleted.
+
+    Each class has a chain per direction, whose meters drop the packets of a device over its rate:
+    devices are the keys of the meters, so each one gets the whole rate of its class.
+
+    Args:
+        generation (int): number of the new policy
+        classes (list[tuple]): (bytes, packets) per second of each class, None when not capped
+        tx (dict[str, int]): MAC address -> class of the devices, for the traffic they send
+        rx (dict[str, int]): IP address -> class of the devices, for the traffic they receive
+        previous (tuple[int, list[tuple]] | None): generation and classes of the policy to replace, if any
+
+    Returns:
+        dict: the JSON document, to be loaded with Nftables.json_cmd
+    """
+    commands = []
+    chains, _ = shaping_objects(generation, classes)
+    for index, limits in enumerate(classes):
+        for chain, key in zip(chains[2 * index:2 * index + 2], (ETHER_SADDR, IP_DADDR)):
+            commands.append({"add": {"chain": {"family": FAMILY, "table": TABLE, "name": chain}}})
+            bytes_rate, packets_rate = limits
+            if bytes_rate is not None:
+                # Allow a second of traffic at once, a burst of 0 bytes would drop every packet
+                limit = {"rate": bytes_rate, "rate_unit": "bytes", "per": "second", "burst": bytes_rate, "burst_unit": "bytes", "inv": True}
+                commands.append(rule(chain, meter(f"{chain}-bytes", key, {"limit": limit}), {"drop": None}))
+            if packets_rate is not None:
+                limit = {"rate": packets_rate, "per": "second", "inv": True}
+                commands.append(rule(chain, meter(f"{chain}-packets", key, {"limit": limit}), {"drop": None}))
+            commands.append(rule(chain, {"accept": None}))
+
+    for name, elements in ((SHAPING_TX, tx), (SHAPING_RX, rx)):
+        commands.append({"flush": {"map": {"family": FAMILY, "table": TABLE, "name": name}}})
+        if elements:
+            commands.append({"add": {"element": {"family": FAMILY, "table": TABLE, "name": name, "elem": [
+                [key, {"jump": {"target": chains[2 * index + (name == SHAPING_RX)]}}]
+                for key, index in elements.items()
+            ]}}})
+
+    # The previous chains are no longer referenced once the maps are flushed, and their meters once they are deleted
+    if previous is not None:
+        old_chains, old_meters = shaping_objects(*previous)
+        commands.extend({"delete": {"chain": {"family": FAMILY, "table": TABLE, "name": name}}} for name in old_chains)
+        commands.extend({"delete": {"set": {"family": FAMILY, "table": TABLE, "name": name}}} for name in old_meters)
+    return {"nftables": commands}
+
+def shaping_elements(
+    generation: int, classes: list[tuple], removed_tx: list[str], added_tx: dict[str, int], removed_rx: list[str], added_rx: dict[str, int],
+) -> dict:
+    """
+    Builds the document moving devices between the classes of the current policy in a single transaction,
+    without loading the policy again
+
+    Args:
+        generation (int): number of the current policy
+        classes (list[tuple]): (bytes, packets) per second of each class of the current policy
+        removed_tx (list[str]): MAC addresses to remove from the map of the traffic sent
+        added_tx (dict[str, int]): MAC address -> class of the devices to add, for the traffic they send
+        removed_rx (list[str]): IP addresses to remove from the map of the traffic received
+        added_rx (dict[str, int]): IP address -> class of the devices to add, for the traffic they receive
+
+    Returns:
+        dict: the JSON document, to be loaded with Nftables.json_cmd
+    """
+    chains, _ = shaping_objects(generation, classes)
+    commands = []
+    # Elements are removed first, so that a device can be added back with another class
+    for name, removed in ((SHAPING_TX, removed_tx), (SHAPING_RX, removed_rx)):
+        if removed:
+            commands.append({"delete": {"element": {"family": FAMILY, "table": TABLE, "name": name, "elem": list(removed)}}})
+    for name, added in ((SHAPING_TX, added_tx), (SHAPING_RX, added_rx)):
+        if added:
+            commands.append({"add": {"element": {"family": FAMILY, "table": TABLE, "name": name, "elem": [
+                [key, {"jump": {"target": chains[2 * index + (name == SHAPING_RX)]}}]
+                for key, index in added.items()
+            ]}}})
+    return {"nftables": commands}
+
+def shaping_cleanup(chains: list[str], meters: list[str], maps: bool) -> dict:
+    """
+    Builds the document removing the shaping classes left by a previous run, whose generations are unknown
+
+    Args:
+        chains (list[str]): chains of the classes
+        meters (list[str]): meters of the classes
+        maps (bool): whether the verdict maps are kept (and emptied), instead of deleted
+
+    Returns:
+        dict: the JSON document, to be loaded with Nftables.json_cmd
+    """
+    action = "flush" if maps else "delete"
+    commands = [{action: {"map": {"family": FAMILY, "table": TABLE, "name": name}}} for name in (SHAPING_TX, SHAPING_RX)]
+    commands.extend({"delete": {"chain": {"family": FAMILY, "table": TABLE, "name": name}}} for name in chains)
+    commands.extend({"delete": {"set": {"family": FAMILY, "table": TABLE, "name": name}}} for name in meters)
+    return {"nftables": commands}
+
+def remove_portail_ruleset(
+    single_map: bool = False, ingress: bool = False, flowtable: bool = False, reject_meter: bool = False, counters: bool = False,
+    shaping: tuple[int, list[tuple]] | None = None, games: bool = False,
+) -> dict:
+    """
+    Builds the document removing netcontrol's chains, set, map and flowtable from the table, and the ingress table if any.
+    shaping gives the generation and classes of the shaping policy, if shaping is enabled.
+    """
+    commands = [
+        {"delete": {"chain": {"family": FAMILY, "table": TABLE, "name": name}}}
+        for name in CHAINS
+    ]
+    # Regular chains and the meter can only be deleted once the rules using them are
+    commands.append({"delete": {"chain": {"family": FAMILY, "table": TABLE, "name": REJECT_CHAIN}}})
+    if games:
+        commands.append({"delete": {"chain": {"family": FAMILY, "table": TABLE, "name": GAMES_CHAIN}}})
+        for name in GAMES_SETS.values():
+            commands.append({"delete": {"set": {"family": FAMILY, "table": TABLE, "name": name}}})
+    if reject_meter:
+        commands.append({"delete": {"set": {"family": FAMILY, "table": TABLE, "name": REJECT_METER}}})
+    if counters:
+        for name in (COUNTERS_TX, COUNTERS_RX):
+            commands.append({"delete": {"set": {"family": FAMILY, "table": TABLE, "name": name}}})
+    if shaping is not None:
+        # The class chains are referenced by the elements of the maps
+        for name in (SHAPING_TX, SHAPING_RX):
+            commands.append({"delete": {"map": {"family": FAMILY, "table": TABLE, "name": name}}})
+        chains, meters = shaping_objects(*shaping)
+        commands.extend({"delete": {"chain": {"family": FAMILY, "table": TABLE, "name": name}}} for name in chains)
+        commands.extend({"delete": {"set": {"family": FAMILY, "table": TABLE, "name": name}}} for name in meters)
+    if not single_map:
+        commands.append({"delete": {"set": {"family": FAMILY, "table": TABLE, "name": "netcontrol-auth"}}})
+    commands.append({"delete": {"map": {"family": FAMILY, "table": TABLE, "name": "netcontrol-mac2mark"}}})
+    # The flowtable can only be deleted once the rule using it is
+    if flowtable:
+        commands.append({"delete": {"flowtable": {"family": FAMILY, "table": TABLE, "name": FLOWTABLE}}})
+    if ingress:
+        commands.append({"delete": {"table": {"family": INGRESS_FAMILY, "name": TABLE}}})
+    return {"nftables": commands}
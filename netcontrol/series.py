@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from array import array
+from fastapi import HTTPException
+from .nft import Nft
+
+# Seconds between two samples of the counters, at least 1
+SERIES_INTERVAL = max(1, int(os.getenv("SERIES_INTERVAL") or 10))
+# (bucket duration in seconds, number of buckets) of each resolution, the finest first:
+# 1 hour at the sampling interval (a single bucket if the interval is longer), 12 hours by minute, a week by 10 minutes
+SERIES_RESOLUTIONS = ((SERIES_INTERVAL, max(1, 3600 // SERIES_INTERVAL)), (60, 720), (600, 1008))
+FIELDS = ("tx_bytes", "tx_packets", "rx_bytes", "rx_packets")
+
+class Ring:
+    """
+    Fixed-size ring of buckets of the same duration, holding the traffic of each mark during each bucket.
+    Values are kept in arrays of unsigned 64-bit integers, one per mark and field.
+    """
+    def __init__(self, duration: int, size: int) -> None:
+        self.duration = duration
+        self.size = size
+        self.times = array("d", bytes(8 * size))
+        self.values: dict[int, list[array]] = {}
+        # Index of the next bucket to write, and number of buckets written
+        self.head = 0
+        self.count = 0
+
+    def append(self, start: float, traffic: dict[int, list[int]]) -> None:
+        """
+        Writes a bucket over the oldest one
+
+        Args:
+            start (float): time at which the bucket started
+            traffic (dict[int, list[int]]): mark -> traffic of each field during the bucket
+        """
+        index = self.head
+        self.times[index] = start
+        for mark in traffic.keys() - self.values.keys():
+            self.values[mark] = [array("Q", bytes(8 * self.size)) for _ in FIELDS]
+        for mark, series in self.values.items():
+            sample = traffic.get(mark)
+            for field, values in enumerate(series):
+                values[index] = sample[field] if sample is not None else 0
+        self.head = (index + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def last(self, count: int) -> dict:
+        """
+        Returns the last buckets, the oldest first
+
+        Args:
+            count (int): number of buckets
+
+        Returns:
+            dict: the "interval" of the buckets, their start "time", and the traffic of each mark by field
+        """
+        count = min(count, self.count)
+        indexes = [(self.head - count + offset) % self.size for offset in range(count)]
+        return {
+            "interval": self.duration,
+            "time": [self.times[index] for index in indexes],
+            "marks": {
+                mark: {field: [values[index] for index in indexes] for field, values in zip(FIELDS, series)}
+                for mark, series in self.values.items()
+            },
+        }
+
+class MarkSeries:
+    """
+    Samples the traffic counters of the devices at a fixed interval, and keeps the traffic of each mark
+    in ring buffers of decreasing resolution: each sample is added to the current bucket of every
+    resolution, which is written once its duration has passed.
+    """
+    def __init__(self, nft: Nft, logger: logging.Logger, interval: int = SERIES_INTERVAL, resolutions: tuple = SERIES_RESOLUTIONS) -> None:
+        self.nft = nft
+        self.logger = logger
+        self.interval = interval
+        self.rings = [Ring(duration, size) for duration, size in resolutions]
+        # Traffic of the current bucket of each resolution, and its start
+        self.pending: list[dict[int, list[int]]] = [{} for _ in self.rings]
+        self.pending_start: list[float] = [0.0 for _ in self.rings]
+        # Last counters read for each device (MAC address), to compute the traffic between two samples,
+        # None until the first sample, whose counters hold the traffic since the meters were created
+        self.previous: dict[str, tuple] | None = None
+        self.task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        """
+        Starts the sampling task, if the counters are enabled
+        """
+        if not self.nft.counters:
+            self.logger.info("Counters are disabled, the traffic of the marks will not be recorded")
+            return
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops the sampling task
+        """
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    def add(self, now: float, devices: list[dict], marks: dict[str, int]) -> None:
+        """
+        Adds a sample of the counters
+
+        Args:
+            now (float): time of the sample
+            devices (list[dict]): counters of the devices, as returned by Nft.read_counters
+            marks (dict[str, int]): current mark of each device
+        """
+        traffic: dict[int, list[int]] = {}
+        previous = {}
+        for device in devices:
+            if device["mac"] is None:
+                continue
+            counters = tuple(device[field] for field in FIELDS)
+            previous[device["mac"]] = counters
+            mark = marks.get(device["mac"])
+            if mark is None or self.previous is None:
+                continue
+            last = self.previous.get(device["mac"])
+            # Counters start again from 0 if the meter was recreated
+            if last is not None and all(value >= old for value, old in zip(counters, last)):
+                counters = tuple(value - old for value, old in zip(counters, last))
+            # The traffic of a device which moved is counted in its new mark for the whole interval
+            total = traffic.setdefault(mark, [0] * len(FIELDS))
+            for field, value in enumerate(counters):
+                total[field] += value
+        if self.previous is None:
+            self.previous = previous
+            self.pending_start = [now for _ in self.rings]
+            return
+        self.previous = previous
+
+        for pending in self.pending:
+            for mark, values in traffic.items():
+                total = pending.setdefault(mark, [0] * len(FIELDS))
+                for field, value in enumerate(values):
+                    total[field] += value
+        for level, ring in enumerate(self.rings):
+            # Samples are never exactly one interval apart, allow some jitter
+            if now - self.pending_start[level] >= ring.duration - self.interval / 2:
+                ring.append(self.pending_start[level], self.pending[level])
+                self.pending[level] = {}
+                self.pending_start[level] = now
+
+    def series(self, minutes: int) -> dict:
+        """
+        Returns the traffic of each mark during the last minutes, at the finest resolution covering them
+
+        Args:
+            minutes (int): length of the series
+
+        Raises:
+            HTTPException: if the counters are disabled
+
+        Returns:
+            dict: the "interval" of the buckets, their start "time", and the traffic of each mark by field
+        """
+        if self.task is None:
+            raise HTTPException(status_code=404, detail="Counters are disabled (NFT_COUNTERS)")
+        seconds = minutes * 60
+        ring = next((ring for ring in self.rings if ring.duration * ring.size >= seconds), self.rings[-1])
+        return ring.last(math.ceil(seconds / ring.duration))
+
+    async def _run(self) -> None:
+        """
+        Samples the counters every interval
+        """
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                devices = await asyncio.to_thread(self.nft.read_counters)
+            except Exception as e:
+                self.logger.warning(f"Could not read the counters: {e}")
+                continue
+            self.add(time.time(), devices, self.nft.state())
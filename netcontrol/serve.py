@@ -0,0 +1,30 @@
+"""
+Starts netcontrol on a unix socket instead of TCP.
+The socket is created here rather than by uvicorn, which would make it world-writable:
+its permissions are what restricts access to the API.
+"""
+import os
+import socket
+import sys
+import uvicorn
+
+socket_file = os.environ["NETCONTROL_SOCKET_FILE"]
+# Only the owner and the group of the socket (root by default) can talk to netcontrol
+socket_mode = int(os.getenv("NETCONTROL_SOCKET_MODE", "660"), 8)
+
+package_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(package_dir))
+
+if os.path.exists(socket_file):
+    os.unlink(socket_file)
+os.makedirs(os.path.dirname(socket_file), exist_ok=True)
+
+sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+umask = os.umask(0o777 & ~socket_mode)
+try:
+    sock.bind(socket_file)
+finally:
+    os.umask(umask)
+os.chmod(socket_file, socket_mode)
+
+uvicorn.run(f"{os.path.basename(package_dir)}.main:app", fd=sock.fileno())
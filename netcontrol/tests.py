@@ -0,0 +1,1009 @@
+"""
+Tests of the batches applied to the map, run from the parent directory of netcontrol:
+    python -m unittest netcontrol.tests
+"""
+import asyncio
+import importlib
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest.mock import mock_open, patch
+
+# The variables are read from /variables.json when nft is imported
+with patch("builtins.open", mock_open(read_data='{"ip_range": "10.0.0.0/8"}')):
+    from . import nft as nft_module
+    from .nft import MockedNft, Nft, NftablesException
+    from .writer import NftWriter
+from . import arp as arp_module
+from .arp import Arp
+from .metrics import REGISTRY, Counter, Gauge, Histogram
+from .netlink import Address
+from . import prober as prober_module
+from .prober import Prober
+from . import series as series_module
+from .series import MarkSeries, Ring
+from .ruleset import FLOWTABLE, METER_TIMEOUT, ingress_ruleset, portail_ruleset, shaping_ruleset
+
+logger = logging.getLogger("netcontrol.tests")
+logger.addHandler(logging.NullHandler())
+
+
+def import_main():
+    """
+    Imports the app with the network mocked, without running its lifespan
+    """
+    with patch.dict(os.environ, {"MOCK_NETWORK": "1"}):
+        from . import main
+    return main
+
+
+MAC = "aa:bb:cc:dd:ee:01"
+OTHER = "aa:bb:cc:dd:ee:02"
+
+
+class RecordingNft(MockedNft):
+    """
+    MockedNft keeping the commands it was given, and failing the transactions holding a given MAC address
+    """
+    def __init__(self) -> None:
+        super().__init__(logger)
+        self.commands: list[list[str]] = []
+        self.failing: set[str] = set()
+        self.documents: list[dict] = []
+        # Output of "list table insalan"
+        self.table: list[dict] = []
+
+    def _execute_nft_cmd(self, cmd: str) -> dict:
+        if cmd == "list table insalan":
+            return self.table
+        lines = cmd.split("\n")
+        if any(mac in line for line in lines for mac in self.failing):
+            raise NftablesException(1, "Error: Could not process rule")
+        self.commands.append(lines)
+        return {}
+
+    def _execute_nft_json(self, document: dict, label: str = "json") -> dict:
+        self.documents.append(document)
+        return {}
+
+    def _read_map(self) -> None:
+        pass
+
+
+PROC_ARP = """IP address       HW type     Flags       HW address            Mask     Device
+10.0.0.1         0x1         0x2         aa:bb:cc:dd:ee:01     *        eth0
+10.0.0.3         0x1         0x0         00:00:00:00:00:00     *        eth0
+"""
+
+
+class TestArp(unittest.TestCase):
+    """
+    Cache of the ARP table, read from a fake /proc/net/arp with a clock moved by hand
+    """
+    def setUp(self):
+        self.now = 1000.0
+        self.reads = 0
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "arp")
+        self.write(PROC_ARP)
+
+        def fake_open(path, mode="r"):
+            self.assertEqual(path, "/proc/net/arp")
+            self.reads += 1
+            return open(self.path, mode)
+
+        clock = SimpleNamespace(monotonic=lambda: self.now, perf_counter=time.perf_counter)
+        for patcher in (patch.object(arp_module, "open", fake_open, create=True), patch.object(arp_module, "time", clock)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.arp = Arp(logger)
+
+    def write(self, content):
+        with open(self.path, "w") as f:
+            f.write(content)
+
+    def test_ttl(self):
+        self.assertEqual(self.arp.get_mac("10.0.0.1"), {"mac": MAC})
+        self.assertEqual(self.arp.get_ip(MAC.upper()), {"ip": "10.0.0.1"})
+        self.assertEqual(self.reads, 1)
+        self.now += 1.9
+        self.arp.get_mac("10.0.0.1")
+        self.assertEqual(self.reads, 1)
+        # Once expired, the table is read again
+        self.now += 0.2
+        self.arp.get_mac("10.0.0.1")
+        self.assertEqual(self.reads, 2)
+        self.assertEqual(self.arp.stats(), {"hits": 2, "misses": 2, "entries": 1})
+
+    def test_miss(self):
+        self.arp.get_mac("10.0.0.1")
+        self.write(PROC_ARP + "10.0.0.2         0x1         0x2         aa:bb:cc:dd:ee:02     *        eth0\n")
+        # Right after a read, unknown and incomplete entries are answered from the table
+        for ip in ("10.0.0.2", "10.0.0.3", "10.0.0.4"):
+            with self.assertRaises(Exception) as error:
+                self.arp.get_mac(ip)
+            self.assertEqual(error.exception.status_code, 404)
+        self.assertEqual(self.reads, 1)
+        # Later on, a miss reads the table again, before it expires
+        self.now += 0.5
+        self.assertEqual(self.arp.get_mac("10.0.0.2"), {"mac": OTHER})
+        self.assertEqual(self.reads, 2)
+        self.assertEqual(self.arp.stats(), {"hits": 0, "misses": 5, "entries": 2})
+
+    def test_concurrent_reads(self):
+        # Lookups which missed on the same generation read the table once
+        generation = self.arp.generation
+        self.arp._refresh(generation)
+        self.arp._refresh(generation)
+        self.assertEqual(self.reads, 1)
+        self.assertEqual(self.arp.generation, generation + 1)
+
+    def test_stats_endpoint(self):
+        from fastapi.testclient import TestClient
+        main = import_main()
+        arp = main.arp
+
+        arp.hits, arp.misses = 3, 1
+        self.addCleanup(setattr, arp, "hits", 0)
+        self.addCleanup(setattr, arp, "misses", 0)
+        response = TestClient(main.app).get("/arp_stats")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"hits": 3, "misses": 1, "entries": 0})
+
+
+def parse_metrics(text):
+    """
+    Samples of a page in the Prometheus text format, by name and labels, and the type of each metric
+    """
+    samples, types = {}, {}
+    for line in text.splitlines():
+        if line.startswith("# TYPE "):
+            _, _, name, kind = line.split(" ")
+            types[name] = kind
+        elif line and not line.startswith("#"):
+            series, value = line.rsplit(" ", 1)
+            samples[series] = float(value)
+    return samples, types
+
+
+class TestMetrics(unittest.TestCase):
+    def metric(self, metric):
+        self.addCleanup(REGISTRY.remove, metric)
+        return metric
+
+    def test_render(self):
+        counter = self.metric(Counter("netcontrol_test_total", "Test \\ counter\nof things", ("path", "code")))
+        counter.inc('/a"b\\c\nd', 200)
+        counter.inc('/a"b\\c\nd', 200, amount=2)
+        self.assertEqual(counter.render(), "\n".join([
+            "# HELP netcontrol_test_total Test \\\\ counter\\nof things",
+            "# TYPE netcontrol_test_total counter",
+            'netcontrol_test_total{path="/a\\"b\\\\c\\nd",code="200"} 3',
+        ]))
+
+    def test_function(self):
+        # Values are read when rendering, from a single value or from labels
+        values = {("101",): 0.5}
+        gauge = self.metric(Gauge("netcontrol_test_ratio", "Test ratio", ("mark",), function=lambda: values))
+        single = self.metric(Gauge("netcontrol_test_size", "Test size", function=lambda: len(values)))
+        values[("102",)] = 0.25
+        self.assertEqual(gauge.samples(), ['netcontrol_test_ratio{mark="101"} 0.5', 'netcontrol_test_ratio{mark="102"} 0.25'])
+        self.assertEqual(single.samples(), ["netcontrol_test_size 2"])
+
+    def test_histogram(self):
+        histogram = self.metric(Histogram("netcontrol_test_seconds", "Test duration", buckets=(0.1, 1)))
+        for value in (0.05, 0.5, 0.5, 2):
+            histogram.observe(value)
+        samples, _ = parse_metrics(histogram.render())
+        self.assertEqual(samples, {
+            'netcontrol_test_seconds_bucket{le="0.1"}': 1,
+            'netcontrol_test_seconds_bucket{le="1"}': 3,
+            'netcontrol_test_seconds_bucket{le="+Inf"}': 4,
+            "netcontrol_test_seconds_sum": 3.05,
+            "netcontrol_test_seconds_count": 4,
+        })
+
+    def test_endpoint(self):
+        from fastapi.testclient import TestClient
+        client = TestClient(import_main().app)
+        client.get("/state")
+        client.get("/get_ip", params={"mac": MAC})
+        response = client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["content-type"], "text/plain; version=0.0.4; charset=utf-8")
+        samples, types = parse_metrics(response.text)
+        self.assertGreaterEqual(samples['netcontrol_requests_total{endpoint="/state"}'], 1)
+        self.assertGreaterEqual(samples['netcontrol_request_duration_seconds_count{endpoint="/get_ip"}'], 1)
+        self.assertEqual(samples["netcontrol_auth_set_size"], 0)
+        self.assertEqual(samples['netcontrol_reject_policy{policy="reject"}'], 1)
+        self.assertEqual(samples["netcontrol_queue_depth"], 0)
+        self.assertEqual(types["netcontrol_arp_lookups_total"], "counter")
+        self.assertEqual(types["netcontrol_request_duration_seconds"], "histogram")
+
+
+class TestApplyBatch(unittest.TestCase):
+    def setUp(self):
+        self.nft = RecordingNft()
+
+    def test_connect(self):
+        results = self.nft.apply_batch([{"action": "connect", "mac": MAC.upper(), "mark": 100}])
+        self.assertEqual(results[0]["status"], 200)
+        self.assertEqual(self.nft.mac2mark, {MAC: 100})
+        self.assertEqual(self.nft.commands, [[
+            f"add element insalan netcontrol-mac2mark {{ {MAC} : 100 }}",
+            f"add element insalan netcontrol-auth {{ {MAC} }}",
+        ]])
+
+    def test_merge(self):
+        # A connect followed by a set_mark is a single insertion with the final mark
+        results = self.nft.apply_batch([
+            {"action": "connect", "mac": MAC, "mark": 100},
+            {"action": "set_mark", "mac": MAC, "mark": 101},
+            {"action": "connect", "mac": OTHER, "mark": 100},
+            {"action": "disconnect", "mac": OTHER},
+        ])
+        self.assertEqual([result["status"] for result in results], [200] * 4)
+        self.assertEqual(self.nft.mac2mark, {MAC: 101})
+        self.assertEqual(self.nft.commands, [[
+            f"add element insalan netcontrol-mac2mark {{ {MAC} : 101 }}",
+            f"add element insalan netcontrol-auth {{ {MAC} }}",
+        ]])
+
+    def test_set_mark(self):
+        self.nft.apply_batch([{"action": "connect", "mac": MAC, "mark": 100}])
+        self.nft.apply_batch([{"action": "set_mark", "mac": MAC, "mark": 101}])
+        # The device stays in the auth set
+        self.assertEqual(self.nft.commands[1], [
+            f"delete element insalan netcontrol-mac2mark {{ {MAC} }}",
+            f"add element insalan netcontrol-mac2mark {{ {MAC} : 101 }}",
+        ])
+
+    def test_single_transaction(self):
+        # A mark change and a removal are sent as one transaction, deleting then adding the elements
+        self.nft.ingress = "lan0"
+        self.nft.apply_batch([
+            {"action": "connect", "mac": MAC, "mark": 100},
+            {"action": "connect", "mac": OTHER, "mark": 100},
+        ])
+        self.nft.apply_batch([
+            {"action": "set_mark", "mac": MAC, "mark": 101},
+            {"action": "disconnect", "mac": OTHER},
+        ])
+        self.assertEqual(self.nft.commands[1], [
+            f"delete element insalan netcontrol-mac2mark {{ {MAC} }}",
+            f"add element insalan netcontrol-mac2mark {{ {MAC} : 101 }}",
+            f"delete element insalan netcontrol-mac2mark {{ {OTHER} }}",
+            f"delete element insalan netcontrol-auth {{ {OTHER} }}",
+            f"delete element netdev insalan netcontrol-auth {{ {OTHER} }}",
+        ])
+        self.assertEqual(self.nft.mac2mark, {MAC: 101})
+
+    def test_single_map(self):
+        # The keys of the map are the authenticated devices, there is no set to keep in sync
+        self.nft.single_map = True
+        self.nft.apply_batch([{"action": "connect", "mac": MAC, "mark": 100, "timeout": 600}])
+        self.nft.apply_batch([{"action": "set_mark", "mac": MAC, "mark": 101}, {"action": "connect", "mac": OTHER, "mark": 100}])
+        self.nft.apply_batch([{"action": "disconnect", "mac": MAC}])
+        self.assertEqual(self.nft.commands[0], [f"add element insalan netcontrol-mac2mark {{ {MAC} timeout 600s : 100 }}"])
+        self.assertEqual(len(self.nft.commands[1]), 3)
+        self.assertEqual(self.nft.commands[1][0], f"delete element insalan netcontrol-mac2mark {{ {MAC} }}")
+        self.assertRegex(self.nft.commands[1][1], rf"add element insalan netcontrol-mac2mark {{ {MAC} timeout 59\ds : 101 }}")
+        self.assertEqual(self.nft.commands[1][2], f"add element insalan netcontrol-mac2mark {{ {OTHER} : 100 }}")
+        self.assertEqual(self.nft.commands[2], [f"delete element insalan netcontrol-mac2mark {{ {MAC} }}"])
+
+    def test_no_change(self):
+        self.nft.apply_batch([{"action": "connect", "mac": MAC, "mark": 100}])
+        results = self.nft.apply_batch([{"action": "connect", "mac": MAC, "mark": 100}])
+        self.assertEqual(results[0]["status"], 200)
+        self.assertEqual(len(self.nft.commands), 1)
+
+    def test_timeout(self):
+        self.nft.apply_batch([{"action": "connect", "mac": MAC, "mark": 100, "timeout": 600}])
+        self.assertIn(MAC, self.nft.expires)
+        # A new mark keeps the remaining time
+        self.nft.apply_batch([{"action": "set_mark", "mac": MAC, "mark": 101}])
+        self.assertIn(MAC, self.nft.expires)
+        self.assertRegex(self.nft.commands[1][1], rf"add element insalan netcontrol-mac2mark {{ {MAC} timeout 59\ds : 101 }}")
+
+    def test_permanent_reconnect(self):
+        # Connecting a timed device again without a timeout replaces its elements with permanent ones
+        self.nft.apply_batch([{"action": "connect", "mac": MAC, "mark": 100, "timeout": 600}])
+        results = self.nft.apply_batch([{"action": "connect", "mac": MAC, "mark": 100}])
+        self.assertEqual(results[0]["status"], 200)
+        self.assertNotIn(MAC, self.nft.expires)
+        self.assertEqual(self.nft.commands[1], [
+            f"delete element insalan netcontrol-mac2mark {{ {MAC} }}",
+            f"delete element insalan netcontrol-auth {{ {MAC} }}",
+            f"add element insalan netcontrol-mac2mark {{ {MAC} : 100 }}",
+            f"add element insalan netcontrol-auth {{ {MAC} }}",
+        ])
+        # The desired state replayed at startup is permanent too
+        self.nft.apply_batch([{"action": "connect", "mac": OTHER, "mark": 100, "timeout": 600}])
+        self.assertEqual(self.nft.diff_state({MAC: 100, OTHER: 100}), [
+            {"action": "upsert", "mac": OTHER, "mark": 100, "name": "state"},
+        ])
+
+    def test_errors(self):
+        self.nft.apply_batch([{"action": "connect", "mac": MAC, "mark": 100}])
+        results = self.nft.apply_batch([
+            {"action": "connect", "mac": MAC, "mark": 101},
+            {"action": "disconnect", "mac": OTHER},
+            {"action": "unknown", "mac": OTHER},
+            {"action": "connect", "mac": OTHER},
+            {"action": "connect", "mac": OTHER, "mark": 100, "timeout": 0},
+            {"action": "refresh", "mac": MAC},
+        ])
+        self.assertEqual([(result["status"], result["detail"]) for result in results], [
+            (409, "Device already connected with another mark"),
+            (404, "Device was not previously connected"),
+            (400, "Unknown action"),
+            (400, "Missing mark"),
+            (400, "Invalid timeout"),
+            (400, "Missing timeout"),
+        ])
+        self.assertEqual(self.nft.mac2mark, {MAC: 100})
+        self.assertEqual(len(self.nft.commands), 1)
+
+    def test_failure(self):
+        self.nft.failing.add(MAC)
+        with self.assertRaises(Exception) as error:
+            self.nft.apply_batch([{"action": "connect", "mac": MAC, "mark": 100}])
+        self.assertEqual(error.exception.status_code, 500)
+        # Nothing was applied, so the mirror is unchanged
+        self.assertEqual(self.nft.mac2mark, {})
+
+    def test_diff_state(self):
+        self.nft.apply_batch([
+            {"action": "connect", "mac": MAC, "mark": 100},
+            {"action": "connect", "mac": OTHER, "mark": 100},
+        ])
+        operations = self.nft.diff_state({MAC.upper(): 101})
+        self.assertEqual(operations, [
+            {"action": "disconnect", "mac": OTHER},
+            {"action": "upsert", "mac": MAC, "mark": 101, "name": "state"},
+        ])
+
+
+def objects(document, kind, action="add"):
+    """
+    Names of the objects of a kind (table, set, map, chain, flowtable) added or deleted by a document
+    """
+    return [
+        command[action][kind]["name"] for command in document["nftables"]
+        if action in command and kind in command[action]
+    ]
+
+
+def rules(document, chain):
+    """
+    Expressions of the rules added to a chain by a document
+    """
+    return [
+        command["add"]["rule"]["expr"] for command in document["nftables"]
+        if "add" in command and "rule" in command["add"] and command["add"]["rule"]["chain"] == chain
+    ]
+
+
+class TestRuleset(unittest.TestCase):
+    """
+    Documents loaded by setup_portail, which nft only checks when they are loaded on the head
+    """
+    HOST_IPS = ["172.16.1.1", "172.17.0.1"]
+
+    def build(self, **options):
+        return portail_ruleset(self.HOST_IPS, "172.17.0.1", "10.0.0.0/8", **options)
+
+    def test_legacy(self):
+        document = self.build()
+        self.assertEqual(objects(document, "set"), ["netcontrol-auth", "netcontrol-games-tcp", "netcontrol-games-udp"])
+        self.assertEqual(objects(document, "map"), ["netcontrol-mac2mark"])
+        self.assertEqual(objects(document, "chain"), [
+            "netcontrol-filter", "netcontrol-nat", "netcontrol-forward", "netcontrol-reject", "netcontrol-games",
+        ])
+        # The chains and sets of the options left disabled are removed, along with the ingress table
+        self.assertEqual(objects(document, "set", "delete"), ["netcontrol-games-tcp", "netcontrol-games-udp"])
+        self.assertEqual(objects(document, "chain", "delete"), ["netcontrol-games"])
+        self.assertEqual(objects(document, "table", "delete"), ["insalan"])
+        self.assertEqual(objects(document, "flowtable"), [])
+        # Packets of authenticated devices are marked from the map, the others are rejected in forward
+        mark, api = rules(document, "netcontrol-filter")
+        self.assertIn({"match": {"op": "==", "left": {"payload": {"protocol": "ether", "field": "saddr"}}, "right": "@netcontrol-auth"}}, mark)
+        self.assertEqual(mark[-1]["mangle"]["value"], {"map": {"key": {"payload": {"protocol": "ether", "field": "saddr"}}, "data": "@netcontrol-mac2mark"}})
+        self.assertEqual(api[-1], {"drop": None})
+        forward = rules(document, "netcontrol-forward")
+        self.assertEqual(len(forward), 1)
+        self.assertEqual(forward[0][-2]["match"]["right"], "@netcontrol-auth")
+        self.assertEqual(forward[0][-1], {"goto": {"target": "netcontrol-reject"}})
+        self.assertEqual(rules(document, "netcontrol-reject"), [[{"reject": None}]])
+
+    def test_single_map(self):
+        document = self.build(single_map=True, tcp_api=False)
+        # The set of the legacy layout is removed, the map is matched instead
+        self.assertEqual(objects(document, "set", "delete")[-1], "netcontrol-auth")
+        self.assertEqual(rules(document, "netcontrol-filter"), [[
+            {"match": {"op": "!=", "left": {"payload": {"protocol": "ip", "field": "daddr"}}, "right": {"prefix": {"addr": "172.16.1.0", "len": 24}}}},
+            {"mangle": {"key": {"meta": {"key": "mark"}}, "value": {"map": {"key": {"payload": {"protocol": "ether", "field": "saddr"}}, "data": "@netcontrol-mac2mark"}}}},
+        ]])
+        forward = rules(document, "netcontrol-forward")[0]
+        self.assertIn({"match": {"op": "==", "left": {"meta": {"key": "mark"}}, "right": 0}}, forward)
+        self.assertEqual(forward[-2]["match"]["right"], "@netcontrol-mac2mark")
+
+    def test_flowtable(self):
+        document = self.build(flowtable=["lan0", "wan0"])
+        flowtables = [command["add"]["flowtable"] for command in document["nftables"] if "flowtable" in command.get("add", {})]
+        self.assertEqual(flowtables, [{"family": "ip", "table": "insalan", "name": FLOWTABLE, "hook": "ingress", "prio": 0, "dev": ["lan0", "wan0"]}])
+        self.assertEqual(rules(document, "netcontrol-forward")[-1][-1], {"flow": {"op": "add", "flowtable": f"@{FLOWTABLE}"}})
+
+    def test_options(self):
+        document = self.build(reject_policy="rate-limited", reject_rate="5/minute", counters=True, shaping=True, games=True)
+        self.assertEqual(objects(document, "map"), ["netcontrol-mac2mark", "netcontrol-shaping-tx", "netcontrol-shaping-rx"])
+        self.assertEqual(objects(document, "set", "delete"), [])
+        limit, drop = rules(document, "netcontrol-reject")
+        self.assertEqual(limit[0]["meter"]["stmt"], {"limit": {"rate": 5, "per": "minute"}})
+        self.assertEqual(drop, [{"drop": None}])
+        self.assertEqual(rules(document, "netcontrol-filter")[1][-1]["meter"]["name"], "netcontrol-counters-tx")
+        forward = rules(document, "netcontrol-forward")
+        self.assertEqual([rule[-1] for rule in forward[:2]], [
+            {"meter": {"name": "netcontrol-counters-rx", "key": {"elem": {"val": {"payload": {"protocol": "ip", "field": "daddr"}}, "timeout": METER_TIMEOUT}}, "stmt": {"counter": None}}},
+            {"goto": {"target": "netcontrol-reject"}},
+        ])
+        # The elements of the devices which left expire from every meter
+        meters = [expr["meter"] for chain in ("netcontrol-filter", "netcontrol-reject") for rule in rules(document, chain) for expr in rule if "meter" in expr]
+        self.assertEqual([meter["name"] for meter in meters], ["netcontrol-counters-tx", "netcontrol-reject-rate"])
+        self.assertTrue(all(meter["key"]["elem"]["timeout"] == METER_TIMEOUT for meter in meters))
+        self.assertEqual(forward[2], [{"jump": {"target": "netcontrol-games"}}])
+        self.assertEqual([rule[0]["vmap"]["data"] for rule in forward[3:]], ["@netcontrol-shaping-tx", "@netcontrol-shaping-rx"])
+        self.assertEqual(len(rules(document, "netcontrol-games")), 4)
+
+    def test_ingress(self):
+        commands = ingress_ruleset("lan0", ["172.16.1.1", "172.17.0.1", "172.17.0.0/16"], "10.0.0.0/8")
+        chain = next(command["add"]["chain"] for command in commands if "chain" in command.get("add", {}))
+        self.assertEqual(chain, {"family": "netdev", "table": "insalan", "name": "netcontrol-ingress", "type": "filter", "hook": "ingress", "dev": "lan0", "prio": 0})
+        drop = [command["add"]["rule"]["expr"] for command in commands if "rule" in command.get("add", {})][-1]
+        # The docker0 address is merged into the docker subnet, an anonymous set refuses overlapping elements
+        self.assertIn({"match": {"op": "!=", "left": {"payload": {"protocol": "ip", "field": "daddr"}}, "right": {"set": [
+            {"prefix": {"addr": "172.16.1.1", "len": 32}}, {"prefix": {"addr": "172.17.0.0", "len": 16}},
+        ]}}}, drop)
+        self.assertEqual(drop[-2]["match"]["right"], "@netcontrol-auth")
+        self.assertEqual(drop[-1], {"drop": None})
+        # The table is loaded along with the others
+        document = self.build(ingress="lan0")
+        self.assertEqual(objects(document, "table"), ["insalan", "insalan"])
+        self.assertNotIn("insalan", objects(document, "table", "delete"))
+
+    def test_setup_counters(self):
+        # Counting the traffic disables the flowtable, whose packets would skip the meters
+        nft = RecordingNft()
+        with patch.object(nft_module, "dump_addresses", return_value=[Address("lan0", "172.16.1.1", 24)]), \
+                patch.object(nft_module, "NFT_MAP_MODE", "legacy"), \
+                patch.object(nft_module, "NFT_FLOWTABLE_INTERFACES", ["lan0", "wan0"]), \
+                patch.object(nft_module, "NFT_COUNTERS", True):
+            Nft.setup_portail(nft)
+        document = nft.documents[0]
+        self.assertEqual(objects(document, "flowtable"), [])
+        self.assertEqual(nft.flowtable, [])
+        self.assertIsNone(nft.flusher)
+        self.assertNotIn({"flow": {"op": "add", "flowtable": f"@{FLOWTABLE}"}}, [rule[-1] for rule in rules(document, "netcontrol-forward")])
+        self.assertEqual(rules(document, "netcontrol-filter")[1][-1]["meter"]["name"], "netcontrol-counters-tx")
+
+
+# Output of "nft -j list meter" for both meters, the second one listed as a dynamic set by recent versions
+COUNTERS_LISTING = {"nftables": [
+    {"metainfo": {"version": "1.0.9", "release_name": "Old Doc Yak #3", "json_schema_version": 1}},
+    {"meter": {
+        "family": "ip", "name": "netcontrol-counters-tx", "table": "insalan", "type": "ether_addr", "handle": 7,
+        "size": 65535, "flags": ["timeout", "dynamic"],
+        "elem": [
+            {"elem": {"val": MAC, "timeout": 3600, "expires": 3598, "counter": {"packets": 10, "bytes": 12000}}},
+            {"elem": {"val": OTHER, "timeout": 3600, "expires": 1200, "counter": {"packets": 900, "bytes": 90000}}},
+        ],
+    }},
+    {"metainfo": {"version": "1.0.9", "release_name": "Old Doc Yak #3", "json_schema_version": 1}},
+    {"set": {
+        "family": "ip", "name": "netcontrol-counters-rx", "table": "insalan", "type": "ipv4_addr", "handle": 8,
+        "size": 65535, "flags": ["timeout", "dynamic"],
+        "elem": [
+            {"elem": {"val": "10.0.0.1", "timeout": 3600, "expires": 3599, "counter": {"packets": 50, "bytes": 500000}}},
+            {"elem": {"val": "10.0.0.9", "timeout": 3600, "expires": 10, "counter": {"packets": 3, "bytes": 180}}},
+        ],
+    }},
+]}
+
+
+class ListingHandle:
+    """
+    nftables handle answering every command with a recorded JSON output
+    """
+    def __init__(self, output: dict) -> None:
+        self.output = output
+        self.commands: list[str] = []
+
+    def cmd(self, cmd: str) -> tuple:
+        self.commands.append(cmd)
+        return 0, json.dumps(self.output), ""
+
+
+class ListingNft(MockedNft):
+    """
+    MockedNft running its commands through the parsing of Nft, against a recorded output
+    """
+    _execute_nft_cmd = Nft._execute_nft_cmd
+
+    def __init__(self, output: dict) -> None:
+        super().__init__(logger)
+        self.nft = ListingHandle(output)
+        self.lock = threading.Lock()
+        self.counters = True
+        self.resolve_ip = {MAC: "10.0.0.1", OTHER: "10.0.0.2"}.get
+
+
+class TestCounters(unittest.TestCase):
+    def setUp(self):
+        self.nft = ListingNft(COUNTERS_LISTING)
+
+    def test_read(self):
+        devices = self.nft.read_counters()
+        self.assertEqual(self.nft.nft.commands, ["list meter insalan netcontrol-counters-tx\nlist meter insalan netcontrol-counters-rx"])
+        self.assertEqual(devices, [
+            {"mac": MAC, "ip": "10.0.0.1", "tx_bytes": 12000, "tx_packets": 10, "rx_bytes": 500000, "rx_packets": 50},
+            # The traffic received is matched by IP address, which may not have received anything
+            {"mac": OTHER, "ip": "10.0.0.2", "tx_bytes": 90000, "tx_packets": 900, "rx_bytes": 0, "rx_packets": 0},
+            # An address whose MAC address is unknown only has the traffic it received
+            {"mac": None, "ip": "10.0.0.9", "tx_bytes": 0, "tx_packets": 0, "rx_bytes": 180, "rx_packets": 3},
+        ])
+
+    def test_disabled(self):
+        self.nft.counters = False
+        with self.assertRaises(Exception) as error:
+            self.nft.read_counters()
+        self.assertEqual(error.exception.status_code, 404)
+        self.assertEqual(self.nft.nft.commands, [])
+
+    def test_top(self):
+        from fastapi.testclient import TestClient
+        main = import_main()
+        client = TestClient(main.app)
+        with patch.object(main, "nft", self.nft):
+            by_bytes = client.get("/counters/top", params={"n": 2}).json()
+            by_packets = client.get("/counters/top", params={"by": "packets"}).json()
+            invalid = client.get("/counters/top", params={"by": "flows"})
+        self.assertEqual([device["mac"] for device in by_bytes], [MAC, OTHER])
+        self.assertEqual([device["mac"] for device in by_packets], [OTHER, MAC, None])
+        self.assertEqual(invalid.status_code, 422)
+
+
+def counters(mac, tx_bytes, rx_bytes=0):
+    """
+    Counters of a device as read by Nft.read_counters, with a packet per 100 bytes
+    """
+    return {
+        "mac": mac, "ip": None,
+        "tx_bytes": tx_bytes, "tx_packets": tx_bytes // 100, "rx_bytes": rx_bytes, "rx_packets": rx_bytes // 100,
+    }
+
+
+class TestSeries(unittest.TestCase):
+    def test_ring(self):
+        ring = Ring(10, 3)
+        ring.append(0, {100: [1, 2, 3, 4]})
+        ring.append(10, {100: [5, 6, 7, 8]})
+        self.assertEqual(ring.last(5), {
+            "interval": 10, "time": [0, 10],
+            "marks": {100: {"tx_bytes": [1, 5], "tx_packets": [2, 6], "rx_bytes": [3, 7], "rx_packets": [4, 8]}},
+        })
+        # Once full, each bucket is written over the oldest one, and a new mark had nothing before
+        ring.append(20, {})
+        ring.append(30, {101: [9, 9, 9, 9]})
+        last = ring.last(3)
+        self.assertEqual(last["time"], [10, 20, 30])
+        self.assertEqual(last["marks"][100]["tx_bytes"], [5, 0, 0])
+        self.assertEqual(last["marks"][101]["tx_bytes"], [0, 0, 9])
+        self.assertEqual(ring.last(1)["time"], [30])
+
+    def test_interval(self):
+        # An empty interval is the default one, and an interval over an hour still gets a bucket
+        for value, resolution in (("", (10, 360)), ("7200", (7200, 1)), ("0", (1, 3600))):
+            with patch.dict(os.environ, {"SERIES_INTERVAL": value}):
+                importlib.reload(series_module)
+            self.assertEqual(series_module.SERIES_RESOLUTIONS[0], resolution)
+        importlib.reload(series_module)
+
+    def test_downsampling(self):
+        # Buckets of 10 seconds, and of 30 seconds made of 3 samples
+        series = MarkSeries(RecordingNft(), logger, 10, ((10, 4), (30, 2)))
+        marks = {MAC: 100, OTHER: 101}
+        # The first sample only gives the counters to start from
+        series.add(0, [counters(MAC, 1000), counters(OTHER, 5000)], marks)
+        for step in range(1, 8):
+            series.add(10 * step, [counters(MAC, 1000 + 100 * step, 10 * step), counters(OTHER, 5000 + 1000 * step)], marks)
+        fine, coarse = series.rings
+        self.assertEqual(fine.last(10)["time"], [30, 40, 50, 60])
+        self.assertEqual(fine.last(10)["marks"][100], {"tx_bytes": [100] * 4, "tx_packets": [1] * 4, "rx_bytes": [10] * 4, "rx_packets": [0] * 4})
+        self.assertEqual(coarse.last(10)["time"], [0, 30])
+        self.assertEqual(coarse.last(10)["marks"][101]["tx_bytes"], [3000, 3000])
+        self.assertEqual(coarse.last(10)["marks"][101]["tx_packets"], [30, 30])
+
+    def test_reset(self):
+        # Counters lower than the last ones were started again, they are the whole traffic of the interval
+        series = MarkSeries(RecordingNft(), logger, 10, ((10, 4),))
+        series.add(0, [counters(MAC, 5000)], {MAC: 100})
+        series.add(10, [counters(MAC, 300)], {MAC: 100})
+        # A device which moved is counted in its new mark
+        series.add(20, [counters(MAC, 700)], {MAC: 101})
+        marks = series.rings[0].last(4)["marks"]
+        self.assertEqual(marks[100]["tx_bytes"], [300, 0])
+        self.assertEqual(marks[101]["tx_bytes"], [0, 400])
+
+    def test_endpoint(self):
+        from fastapi.testclient import TestClient
+        main = import_main()
+        client = TestClient(main.app)
+        series = MarkSeries(RecordingNft(), logger, 10, ((10, 360), (60, 720)))
+        with patch.object(main, "series", series):
+            self.assertEqual(client.get("/marks/series").status_code, 404)
+            # Started, without sampling by itself
+            series.task = asyncio.Future
+            for step in range(100):
+                series.add(10 * step, [counters(MAC, 100 * step)], {MAC: 100})
+            recent = client.get("/marks/series", params={"minutes": 5}).json()
+            older = client.get("/marks/series", params={"minutes": 120}).json()
+        # The finest resolution covering the minutes asked for
+        self.assertEqual((recent["interval"], len(recent["time"])), (10, 30))
+        self.assertEqual(recent["marks"]["100"]["tx_bytes"], [100] * 30)
+        self.assertEqual((older["interval"], len(older["time"])), (60, 16))
+        self.assertEqual(older["marks"]["100"]["tx_bytes"], [600] * 16)
+
+
+class TestLeftovers(unittest.TestCase):
+    def setUp(self):
+        self.nft = RecordingNft()
+        self.nft.table = [
+            {"table": {"family": "ip", "name": "insalan"}},
+            {"set": {"family": "ip", "table": "insalan", "name": "netcontrol-reject-rate"}},
+            {"set": {"family": "ip", "table": "insalan", "name": "netcontrol-counters-tx"}},
+            {"set": {"family": "ip", "table": "insalan", "name": "netcontrol-counters-rx"}},
+        ]
+
+    def test_disabled(self):
+        self.nft._clear_leftovers()
+        self.assertEqual(self.nft.commands, [[
+            "delete set insalan netcontrol-reject-rate",
+            "delete set insalan netcontrol-counters-tx",
+            "delete set insalan netcontrol-counters-rx",
+        ]])
+
+    def test_enabled(self):
+        self.nft.reject_policy = "rate-limited"
+        self.nft.counters = True
+        self.nft._clear_leftovers()
+        self.assertEqual(self.nft.commands, [])
+
+
+class TestShaping(unittest.TestCase):
+    def setUp(self):
+        self.nft = RecordingNft()
+        self.nft.shaping = True
+        self.ips = {MAC: "10.0.0.1", OTHER: "10.0.0.2"}
+        self.nft.resolve_ip = self.ips.get
+        self.nft.set_shaping([{"mac": MAC, "bytes": 1000}, {"mac": OTHER, "bytes": 2000}])
+        self.documents = self.nft.documents
+        self.documents.clear()
+
+    def elements(self, document):
+        return [
+            (action, value["element"]["name"], [elem if isinstance(elem, str) else (elem[0], elem[1]["jump"]["target"]) for elem in value["element"]["elem"]])
+            for command in document["nftables"] for action, value in command.items()
+        ]
+
+    def test_meters(self):
+        # Each device is a key of the meters of its class, until it sends no packet for METER_TIMEOUT
+        document = shaping_ruleset(1, [(1000, 10)], {MAC: 0}, {"10.0.0.1": 0})
+        meters = [expr["meter"] for command in document["nftables"] for expr in command.get("add", {}).get("rule", {}).get("expr", []) if "meter" in expr]
+        self.assertEqual([meter["name"] for meter in meters], [
+            "netcontrol-shaping-1-0-tx-bytes", "netcontrol-shaping-1-0-tx-packets",
+            "netcontrol-shaping-1-0-rx-bytes", "netcontrol-shaping-1-0-rx-packets",
+        ])
+        self.assertTrue(all(meter["key"]["elem"]["timeout"] == METER_TIMEOUT for meter in meters))
+
+    def test_patch(self):
+        # A device moved to another class only changes its elements
+        result = self.nft.patch_shaping([{"mac": MAC.upper(), "bytes": 2000}, {"mac": OTHER}])
+        self.assertEqual(result, {"classes": 2, "devices": 1, "unresolved": []})
+        self.assertEqual(self.elements(self.documents[0]), [
+            ("delete", "netcontrol-shaping-tx", [MAC, OTHER]),
+            ("delete", "netcontrol-shaping-rx", ["10.0.0.1", "10.0.0.2"]),
+            ("add", "netcontrol-shaping-tx", [(MAC, "netcontrol-shaping-1-1-tx")]),
+            ("add", "netcontrol-shaping-rx", [("10.0.0.1", "netcontrol-shaping-1-1-rx")]),
+        ])
+        self.assertEqual(self.nft.shaping_devices, {MAC: (2000, None)})
+        # Nothing changed
+        self.nft.patch_shaping([{"mac": MAC, "bytes": 2000}])
+        self.assertEqual(len(self.documents), 1)
+
+    def test_patch_new_class(self):
+        # A device needing a new class loads the whole policy again
+        self.nft.patch_shaping([{"mac": MAC, "packets": 10}])
+        self.assertEqual(self.nft.shaping_generation, 2)
+        self.assertEqual(self.nft.shaping_classes, [(None, 10), (2000, None)])
+        self.assertEqual(self.nft.shaping_devices, {MAC: (None, 10), OTHER: (2000, None)})
+
+    def test_refresh(self):
+        # The traffic received is matched again when DHCP gives the address to another device
+        self.ips[MAC], self.ips[OTHER] = "10.0.0.2", "10.0.0.3"
+        self.nft.refresh_shaping()
+        self.assertEqual(self.nft.shaping_ips, {MAC: "10.0.0.2", OTHER: "10.0.0.3"})
+        deleted = [elements for action, name, elements in self.elements(self.documents[0]) if (action, name) == ("delete", "netcontrol-shaping-rx")]
+        added = [elements for action, name, elements in self.elements(self.documents[0]) if (action, name) == ("add", "netcontrol-shaping-rx")]
+        self.assertCountEqual(deleted[0], ["10.0.0.1", "10.0.0.2"])
+        self.assertCountEqual(added[0], [("10.0.0.2", "netcontrol-shaping-1-0-rx"), ("10.0.0.3", "netcontrol-shaping-1-1-rx")])
+        self.nft.refresh_shaping()
+        self.assertEqual(len(self.documents), 1)
+
+
+class TestFlush(unittest.TestCase):
+    def setUp(self):
+        self.nft = RecordingNft()
+        self.nft.flowtable = ["lan0", "wan0"]
+        self.flushed = []
+        self.nft._flush_connections = self.flushed.append
+
+    def test_evicted(self):
+        # Connections are ended by the flusher, not by the writer
+        self.nft.apply_batch([{"action": "connect", "mac": MAC, "mark": 100}])
+        self.assertTrue(self.nft.flush_queue.empty())
+        self.nft.apply_batch([{"action": "set_mark", "mac": MAC, "mark": 101}])
+        self.nft.apply_batch([{"action": "disconnect", "mac": MAC}])
+        self.assertEqual(self.nft.flush_queue.get_nowait(), [MAC])
+        self.assertEqual(self.nft.flush_queue.get_nowait(), [MAC])
+        self.assertEqual(self.flushed, [])
+
+    def test_expired(self):
+        self.nft.apply_batch([{"action": "connect", "mac": MAC, "mark": 100, "timeout": 600}])
+        self.nft.expires[MAC] = time.monotonic() - 1
+        self.assertEqual(self.nft._expired_devices(), [MAC])
+        self.assertEqual(self.nft._expired_devices(), [])
+        # The writer forgets the expired device without flushing it again
+        self.nft.apply_batch([{"action": "connect", "mac": OTHER, "mark": 100}])
+        self.assertEqual(self.nft.mac2mark, {OTHER: 100})
+        self.assertTrue(self.nft.flush_queue.empty())
+
+    def test_expired_unseen(self):
+        # Devices which expired before the flusher looked are queued by the writer
+        self.nft.apply_batch([{"action": "connect", "mac": MAC, "mark": 100, "timeout": 600}])
+        self.nft.expires[MAC] = time.monotonic() - 1
+        self.nft.apply_batch([{"action": "connect", "mac": OTHER, "mark": 100}])
+        self.assertEqual(self.nft.flush_queue.get_nowait(), [MAC])
+
+    def test_loop(self):
+        # Everything waiting is flushed at once, until None is queued
+        self.nft.flush_queue.put([OTHER])
+        self.nft.flush_queue.put([MAC, OTHER])
+        self.nft.flush_queue.put(None)
+        thread = threading.Thread(target=self.nft._flush_loop)
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.flushed, [[MAC, OTHER]])
+
+
+class TestWriter(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.nft = RecordingNft()
+        self.writer = NftWriter(self.nft, logger)
+
+    async def asyncTearDown(self):
+        if self.writer.task is not None:
+            await self.writer.stop()
+
+    async def test_merge_requests(self):
+        # Requests waiting for the writer are applied in a single transaction
+        first = asyncio.create_task(self.writer.submit([{"action": "connect", "mac": MAC, "mark": 100}]))
+        second = asyncio.create_task(self.writer.submit([{"action": "connect", "mac": OTHER, "mark": 101}]))
+        await asyncio.sleep(0)
+        self.writer.start()
+        self.assertEqual((await first)[0]["status"], 200)
+        self.assertEqual((await second)[0]["status"], 200)
+        self.assertEqual(len(self.nft.commands), 1)
+        self.assertEqual(self.nft.mac2mark, {MAC: 100, OTHER: 101})
+
+    async def test_failure_isolated(self):
+        # A request failing the transaction only fails itself
+        self.nft.failing.add(OTHER)
+        first = asyncio.create_task(self.writer.submit([{"action": "connect", "mac": MAC, "mark": 100}]))
+        second = asyncio.create_task(self.writer.submit([{"action": "connect", "mac": OTHER, "mark": 101}]))
+        await asyncio.sleep(0)
+        self.writer.start()
+        self.assertEqual((await first)[0]["status"], 200)
+        with self.assertRaises(Exception) as error:
+            await second
+        self.assertEqual(error.exception.status_code, 500)
+        self.assertEqual(self.nft.mac2mark, {MAC: 100})
+
+    async def test_call(self):
+        # Calls are run alone, after the batches queued before them
+        order = []
+        batch = asyncio.create_task(self.writer.submit([{"action": "connect", "mac": MAC, "mark": 100}]))
+        call = asyncio.create_task(self.writer.call(lambda: order.append(dict(self.nft.mac2mark)) or "done"))
+        await asyncio.sleep(0)
+        self.writer.start()
+        await batch
+        self.assertEqual(await call, "done")
+        self.assertEqual(order, [{MAC: 100}])
+
+    async def test_backpressure(self):
+        # The queue is bounded by the number of operations, not of requests
+        self.writer.max_size = 3
+        connect = lambda mac: {"action": "connect", "mac": mac, "mark": 100}
+        first = asyncio.create_task(self.writer.submit([connect(MAC), connect(OTHER)]))
+        await asyncio.sleep(0)
+        with self.assertRaises(Exception) as error:
+            await self.writer.submit([connect("aa:bb:cc:dd:ee:03"), connect("aa:bb:cc:dd:ee:04")])
+        self.assertEqual(error.exception.status_code, 503)
+        self.assertEqual(error.exception.headers, {"Retry-After": "1"})
+        second = asyncio.create_task(self.writer.submit([connect("aa:bb:cc:dd:ee:03")]))
+        await asyncio.sleep(0)
+        self.assertEqual(self.writer.depth(), {"depth": 3, "requests": 2, "max_size": 3})
+        self.writer.start()
+        await asyncio.gather(first, second)
+        self.assertEqual(self.writer.pending, 0)
+        # A batch larger than the bound is accepted when nothing is waiting
+        results = await self.writer.submit([connect(f"aa:bb:cc:dd:ee:1{i}") for i in range(5)])
+        self.assertEqual([result["status"] for result in results], [200] * 5)
+
+
+
+def run(*command, namespace=None):
+    """
+    Runs a command, in a network namespace if given, and returns its output
+    """
+    if namespace is not None:
+        command = ("ip", "netns", "exec", namespace, *command)
+    return subprocess.run(command, check=True, capture_output=True, text=True).stdout
+
+
+def run_script(namespace, script):
+    """
+    Runs a python script importing netcontrol in a network namespace, and returns its output
+    """
+    env = {**os.environ, "PYTHONPATH": os.path.dirname(os.path.dirname(os.path.abspath(__file__)))}
+    return subprocess.run(
+        ("ip", "netns", "exec", namespace, sys.executable, "-c", script), check=True, capture_output=True, text=True, env=env,
+    ).stdout
+
+
+def add_namespaces(test, *namespaces):
+    """
+    Creates empty network namespaces, deleted when the test ends
+    """
+    def teardown():
+        for namespace in namespaces:
+            subprocess.run(("ip", "netns", "del", namespace), stderr=subprocess.DEVNULL)
+
+    teardown()
+    test.addCleanup(teardown)
+    for namespace in namespaces:
+        run("ip", "netns", "add", namespace)
+
+
+# Resolves the peer and an address nobody holds, without ever reading /proc/net/arp, and prints the results
+RESOLVE_SCRIPT = """
+import json, logging
+from fastapi import HTTPException
+from netcontrol import arp
+
+def procfs(*args, **kwargs):
+    raise AssertionError("/proc/net/arp was read")
+
+arp.open = procfs
+resolver = arp.NetlinkArp(logging.getLogger())
+results = {}
+for ip in ("10.9.0.2", "10.9.0.3"):
+    try:
+        results[ip] = resolver.get_mac(ip)
+    except HTTPException as e:
+        results[ip] = e.status_code
+results["cached"] = resolver.get_mac("10.9.0.2")
+results["stats"] = resolver.stats()
+print(json.dumps(results))
+"""
+
+
+@unittest.skipUnless(os.name == "posix" and os.geteuid() == 0 and shutil.which("ip"), "network namespaces need root and ip")
+class TestNetlinkArp(unittest.TestCase):
+    def test_resolve(self):
+        """
+        A device which never talked to the head is resolved by an ARP probe, read back over netlink
+        """
+        head, lan = "nctest-arp-head", "nctest-arp-lan"
+        add_namespaces(self, head, lan)
+        run("ip", "link", "add", "lan0", "netns", head, "type", "veth", "peer", "name", "eth0", "netns", lan)
+        run("ip", "addr", "add", "10.9.0.1/24", "dev", "lan0", namespace=head)
+        run("ip", "addr", "add", "10.9.0.2/24", "dev", "eth0", namespace=lan)
+        run("ip", "link", "set", "lan0", "up", namespace=head)
+        run("ip", "link", "set", "eth0", "up", namespace=lan)
+        mac = json.loads(run("ip", "-j", "link", "show", "eth0", namespace=lan))[0]["address"]
+
+        results = json.loads(run_script(head, RESOLVE_SCRIPT))
+        self.assertEqual(results["10.9.0.2"]["mac"], mac)
+        self.assertIn(results["10.9.0.2"]["state"], ("REACHABLE", "STALE", "DELAY"))
+        self.assertEqual(results["10.9.0.3"], 404)
+        self.assertEqual(results["cached"]["mac"], mac)
+        # The second lookup of the peer is a hit, only the first one of each address probed
+        self.assertEqual(results["stats"]["hits"], 1)
+        self.assertEqual((results["stats"]["probes"], results["stats"]["probe_failures"]), (2, 1))
+
+
+class TestProberSettings(unittest.TestCase):
+    def test_empty(self):
+        # Compose passes the variables missing from .env as empty values
+        with patch.dict(os.environ, {"PROBE_INTERVAL": "", "PROBE_TIMEOUT": ""}):
+            importlib.reload(prober_module)
+        self.assertEqual((prober_module.PROBE_INTERVAL, prober_module.PROBE_TIMEOUT), (5, 2))
+        importlib.reload(prober_module)
+
+
+# Probes every mark of the head namespace a few times, and prints the summary
+PROBE_SCRIPT = """
+import asyncio, json, logging
+from netcontrol.prober import Prober
+
+async def main():
+    prober = Prober(lambda: [], logging.getLogger(), ["198.51.100.1:443"], [101, 102], timeout=0.5)
+    for _ in range(3):
+        await prober.round()
+    print(json.dumps(prober.summary()))
+
+asyncio.run(main())
+"""
+
+
+@unittest.skipUnless(os.name == "posix" and os.geteuid() == 0, "SO_MARK and network namespaces need root")
+class TestProber(unittest.IsolatedAsyncioTestCase):
+    async def test_probe(self):
+        prober = Prober(lambda: [], logger, timeout=0.5)
+        with socket.socket() as server:
+            server.bind(("127.0.0.1", 0))
+            server.listen()
+            port = server.getsockname()[1]
+            # An accepted connection and a reset are both answers from the target
+            self.assertIsNotNone(await prober.probe(100, "127.0.0.1", port))
+        self.assertIsNotNone(await prober.probe(100, "127.0.0.1", port))
+
+    @unittest.skipUnless(shutil.which("ip"), "ip is needed to create the namespaces")
+    def test_marks(self):
+        """
+        Each mark is routed through its own link to the target by an ip rule, as on the head: the link of
+        mark 101 reaches it, and the neighbour behind the link of mark 102 never answers
+        """
+        head, net = "nctest-head", "nctest-net"
+        add_namespaces(self, head, net)
+        run("ip", "addr", "add", "198.51.100.1/32", "dev", "lo", namespace=net)
+        run("ip", "link", "set", "lo", "up", namespace=net)
+        for index, mark in enumerate((101, 102)):
+            run("ip", "link", "add", f"t{mark}", "netns", head, "type", "veth", "peer", "name", f"n{mark}", "netns", net)
+            run("ip", "addr", "add", f"10.{index}.0.1/30", "dev", f"t{mark}", namespace=head)
+            run("ip", "link", "set", f"t{mark}", "up", namespace=head)
+            run("ip", "link", "set", f"n{mark}", "up", namespace=net)
+            run("ip", "route", "add", "default", "via", f"10.{index}.0.2", "table", str(mark), namespace=head)
+            run("ip", "rule", "add", "fwmark", str(mark), "lookup", str(mark), namespace=head)
+        run("ip", "addr", "add", "10.0.0.2/30", "dev", "n101", namespace=net)
+
+        summary = json.loads(run_script(head, PROBE_SCRIPT))
+        self.assertEqual((summary["101"]["sent"], summary["101"]["lost"]), (3, 0))
+        self.assertIsNotNone(summary["101"]["rtt_p50"])
+        self.assertEqual((summary["102"]["sent"], summary["102"]["lost"]), (3, 3))
+        self.assertIsNone(summary["102"]["rtt_p50"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,4 +6,14 @@ class Variables:
             self.data: dict = json.load(file)
     
     def ip_range(self) -> str:
-        return self.data["ip_range"]
\ No newline at end of file
+        return self.data["ip_range"]
+
+    def reject_policy(self) -> str:
+        """
+        What happens to the forwarded traffic of unauthenticated devices: "drop", "reject",
+        or "rate-limited" (rejected up to reject_rate packets per device, dropped beyond)
+        """
+        return self.data.get("reject_policy", "reject")
+
+    def reject_rate(self) -> str:
+        return self.data.get("reject_rate", "10/second")
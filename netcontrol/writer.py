@@ -0,0 +1,218 @@
+import asyncio
+import functools
+import logging
+import os
+from typing import Callable
+from fastapi import HTTPException
+from .nft import Nft
+
+# Maximum number of operations waiting for the writer, a call counting as one
+NFT_QUEUE_SIZE = int(os.getenv("NFT_QUEUE_SIZE", "1024"))
+# Delay suggested to the clients when the queue is full, in seconds
+NFT_RETRY_AFTER = os.getenv("NFT_RETRY_AFTER", "1")
+
+class NftWriter:
+    """
+    Single writer of the nftables ruleset.
+    Requests are put in a queue bounded by the number of operations waiting, and one task drains everything that is waiting and
+    applies it as a single batch, so that commits never interleave and redundant operations
+    on the same MAC address are merged. If the batch fails, the requests are applied one by one,
+    so that a bad request only fails itself.
+    Other changes of the ruleset (shaping policy, ports of the games) are queued as calls, run alone
+    in the order they were queued.
+    A request larger than the bound is only accepted when nothing is waiting, so that it is applied
+    as a single transaction instead of being rejected forever.
+    """
+    def __init__(self, nft: Nft, logger: logging.Logger, max_size: int = NFT_QUEUE_SIZE) -> None:
+        self.nft = nft
+        self.logger = logger
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.max_size = max_size
+        # Number of operations waiting in the queue
+        self.pending = 0
+        self.task: asyncio.Task | None = None
+        # Tasks queuing calls at regular intervals
+        self.periodic: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        """
+        Starts the writer task
+        """
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops the writer task, once the pending requests are applied
+        """
+        for task in self.periodic:
+            task.cancel()
+        await asyncio.gather(*self.periodic, return_exceptions=True)
+        self.periodic = []
+        await self.queue.join()
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    def depth(self) -> dict:
+        """
+        Returns the number of operations and requests waiting for the writer
+        """
+        return {"depth": self.pending, "requests": self.queue.qsize(), "max_size": self.max_size}
+
+    async def submit(self, operations: list[dict]) -> list[dict]:
+        """
+        Queues operations and waits for them to be applied
+
+        Args:
+            operations (list[dict]): operations, as accepted by Nft.apply_batch
+
+        Raises:
+            HTTPException: 503 if the queue cannot hold the operations, or the error of the nftables transaction
+
+        Returns:
+            list[dict]: one result per operation
+        """
+        return await self._queue(operations)
+
+    async def call(self, function: Callable, *args):
+        """
+        Queues a call changing the ruleset, and waits for it to be run
+
+        Args:
+            function (Callable): function to call with args, in a thread
+
+        Raises:
+            HTTPException: 503 if the queue is full, or the error raised by the function
+
+        Returns:
+            the value returned by the function
+        """
+        return await self._queue(functools.partial(function, *args))
+
+    def every(self, interval: float, function: Callable) -> None:
+        """
+        Queues a call every interval seconds, until the writer is stopped. Errors are logged.
+
+        Args:
+            interval (float): seconds between two calls
+            function (Callable): function to call, without arguments
+        """
+        async def repeat():
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    await self.call(function)
+                except Exception as e:
+                    self.logger.warning(f"Periodic {function.__name__} failed: {e}")
+        self.periodic.append(asyncio.create_task(repeat()))
+
+    @staticmethod
+    def _weight(request: list[dict] | functools.partial) -> int:
+        """
+        Returns the number of operations of a request, a call counting as one
+        """
+        return 1 if isinstance(request, functools.partial) else len(request)
+
+    async def _queue(self, request: list[dict] | functools.partial):
+        weight = self._weight(request)
+        if self.pending and self.pending + weight > self.max_size:
+            self.logger.warning(f"nftables queue full ({self.pending} of {self.max_size} operations), rejecting {weight} operations")
+            raise HTTPException(status_code=503, detail="Too many pending operations", headers={"Retry-After": NFT_RETRY_AFTER})
+        future = asyncio.get_running_loop().create_future()
+        self.pending += weight
+        self.queue.put_nowait((request, future))
+        return await future
+
+    async def submit_one(self, operation: dict) -> None:
+        """
+        Queues a single operation and waits for it to be applied
+
+        Args:
+            operation (dict): operation, as accepted by Nft.apply_batch
+
+        Raises:
+            HTTPException: if the operation failed, with its status and detail
+        """
+        result = (await self.submit([operation]))[0]
+        if result["status"] != 200:
+            raise HTTPException(status_code=result["status"], detail=result["detail"])
+
+    async def _run(self) -> None:
+        """
+        Drains the queue, applying the waiting requests between two calls in a single batch
+        """
+        while True:
+            requests = [await self.queue.get()]
+            while not self.queue.empty():
+                requests.append(self.queue.get_nowait())
+            self.pending -= sum(self._weight(request) for request, _ in requests)
+
+            try:
+                batch = []
+                for request in requests:
+                    if isinstance(request[0], functools.partial):
+                        await self._apply(batch)
+                        batch = []
+                        await self._call(*request)
+                    else:
+                        batch.append(request)
+                await self._apply(batch)
+            finally:
+                for _ in requests:
+                    self.queue.task_done()
+
+    async def _apply(self, requests: list[tuple]) -> None:
+        """
+        Applies requests in a single batch
+        """
+        if not requests:
+            return
+        operations = [operation for request, _ in requests for operation in request]
+        try:
+            # The handle is only ever used from this task, one batch at a time
+            results = await asyncio.to_thread(self.nft.apply_batch, operations)
+        except Exception as e:
+            if len(requests) > 1:
+                # A request failing the whole transaction must not fail the others with it
+                self.logger.warning(f"Batch of {len(requests)} requests failed, applying them one by one")
+                await self._apply_each(requests)
+            else:
+                self._fail(requests[0][1], e)
+        else:
+            start = 0
+            for request, future in requests:
+                if not future.done():
+                    future.set_result(results[start:start + len(request)])
+                start += len(request)
+
+    async def _call(self, function: functools.partial, future: asyncio.Future) -> None:
+        """
+        Runs a queued call
+        """
+        try:
+            result = await asyncio.to_thread(function)
+        except Exception as e:
+            self._fail(future, e)
+        else:
+            if not future.done():
+                future.set_result(result)
+
+    async def _apply_each(self, requests: list[tuple]) -> None:
+        """
+        Applies requests one transaction each, so that only those which fail get an error
+        """
+        for operations, future in requests:
+            try:
+                results = await asyncio.to_thread(self.nft.apply_batch, operations)
+            except Exception as e:
+                self._fail(future, e)
+            else:
+                if not future.done():
+                    future.set_result(results)
+
+    @staticmethod
+    def _fail(future: asyncio.Future, error: Exception) -> None:
+        if not future.done():
+            future.set_exception(error)